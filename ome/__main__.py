@@ -1,21 +1,22 @@
 # ome - Object Message Expressions
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
-import glob
-import hashlib
+# Only what every command needs is imported here. Package building, the
+# server, the optimiser and the target and backend modules are imported when
+# they are first used, which keeps --version and --print-ast fast.
+
 import os
 import sys
 import time
 from . import build
 from . import compiler
-from . import optimise
 from .build_options import get_build_options_from_command
 from .build_shell import BuildShell
 from .command import argparser
 from .error import OmeError
-from .ome_ast import BuiltInBlock, format_sexpr
-from .package import SourcePackageBuilder
+from .sexpr import format_sexpr
 from .terminal import stderr
+from .timing import PassTimer
 from .util import get_terminal_width, get_cache_dir, find_executable
 from .version import version
 
@@ -38,10 +39,17 @@ class OmeApp(object):
         self.start = time.time()
         self.args = args
         self.package_dir = os.path.join(get_cache_dir('ome'), 'libs')
-        self.target = build.get_target(self.args.target)
         self.options = get_build_options_from_command(self.args)
+        if self.args.time_passes or self.args.time_passes_json:
+            self.options.timer = PassTimer()
         self.shell = BuildShell(self.args.show_build_commands)
 
+    @property
+    def target(self):
+        if not hasattr(self, '_target'):
+            self._target = build.get_target(self.args.target)
+        return self._target
+
     def initialize_backend(self):
         self.backend = build.get_backend(self.target, self.args.platform, self.args.backend, get_backend_tool(self.args))
         self.prefix_dir = self.get_prefix_dir(self.backend.tools)
@@ -49,6 +57,7 @@ class OmeApp(object):
         self.options.library_dirs.append(os.path.join(self.prefix_dir, 'lib'))
 
     def get_prefix_dir(self, tools):
+        import hashlib
         s = '\0'.join('{}={}'.format(*tool) for tool in sorted(tools.items()))
         m = hashlib.md5()
         m.update(s.encode('utf8'))
@@ -67,29 +76,38 @@ class OmeApp(object):
             raise OmeError('--backend must be specified when --backend-tool is used')
         if len(self.args.file) == 0:
             raise OmeError('no input files')
-        if len(self.args.file) > 1:
-            raise OmeError('too many input files')
-        self.args.infile = self.args.file[0]
+        if self.args.jobs < 1:
+            raise OmeError('--jobs must be at least 1')
+        if len(self.args.file) > 1 and self.args.output and not self.is_output_dir():
+            raise OmeError('output must be a directory when compiling multiple files')
+
+    def is_output_dir(self):
+        return self.args.output.endswith(os.sep) or os.path.isdir(self.args.output)
 
-    def get_output(self):
-        if not self.args.output:
-            self.args.output = self.backend.output_name(self.args.infile, self.options)
-            if self.args.infile == self.args.output:
-                raise OmeError('input file name is same as output')
-        return self.args.output
+    def get_output(self, infile):
+        if self.args.output and not self.is_output_dir():
+            return self.args.output
+        output = self.backend.output_name(infile, self.options)
+        if self.args.output:
+            output = os.path.join(self.args.output, os.path.basename(output))
+        if os.path.abspath(infile) == os.path.abspath(output):
+            raise OmeError('input file name is same as output', infile)
+        return output
 
     def print_ast(self, filename):
         ast = compiler.parse_file(filename)
         print(format_sexpr(ast.sexpr(), max_width=get_terminal_width()))
 
     def print_resolved_ast(self, filename):
-        builtin_block = BuiltInBlock(self.target.get_builtin().methods)
+        from .ome_ast import BuiltInBlock
+        builtin_block = BuiltInBlock(self.target.get_builtin(self.options.cache_dir).methods)
         ast = compiler.parse_file(filename)
         ast = ast.resolve_free_vars(builtin_block)
         ast = ast.resolve_block_refs(builtin_block)
         print(format_sexpr(ast.sexpr(), max_width=get_terminal_width()))
 
     def print_intermediate_code(self, filename):
+        from . import optimise
         ast = compiler.parse_file(filename)
         program = compiler.Program(ast, self.target, '', self.options)
         for block in sorted(program.block_list, key=lambda block: block.tag_id):
@@ -116,20 +134,135 @@ class OmeApp(object):
         elif self.args.print_target_code:
             self.print_target_code(filename)
         else:
-            return
-        sys.exit()
+            return False
+        return True
 
     def build_packages(self):
         libraries = []
-        if self.backend.build_packages and self.target.packages:
+        packages = self.target.get_packages() if self.backend.build_packages else []
+        if packages:
+            import glob
+            from .package import SourcePackageBuilder
             self.print_verbose('building packages')
             sources_dir = os.path.join(self.package_dir, 'sources')
             package_builder = SourcePackageBuilder(sources_dir, self.prefix_dir, self.backend)
-            package_builder.build_packages(self.target.packages)
+            package_builder.build_packages(packages)
             libraries = glob.glob(os.path.join(self.prefix_dir, 'lib', '*' + self.backend.lib_extension))
             self.options.objects.extend(libraries)
         return libraries
 
+    def build_runtime(self):
+        if self.options.link and not self.args.no_shared_runtime and hasattr(self.backend, 'build_runtime'):
+            self.options.shared_runtime = True
+            code = compiler.get_runtime_text(self.target, self.options.cache_dir)
+            self.options.objects.append(self.backend.build_runtime(self.shell, code, self.prefix_dir, self.options))
+
+    def compile_files(self, infiles, num_units):
+        """
+        Run the frontend for each input file, in a process pool if there are
+        several files and more than one job. Returns a list of (infile,
+        units, error) tuples.
+        """
+        if len(infiles) > 1 and self.options.jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(self.options.jobs) as executor:
+                futures = [executor.submit(compile_file_units, infile, self.target.name, num_units, self.options)
+                           for infile in infiles]
+                results = []
+                for infile, future in zip(infiles, futures):
+                    result, error = get_result(future)
+                    if result:
+                        units, timer = result
+                        self.options.timer.merge(timer)
+                        results.append((infile, units, None))
+                    else:
+                        results.append((infile, None, error))
+                return results
+        results = []
+        for infile in infiles:
+            try:
+                results.append((infile, compiler.compile_file_units(infile, self.target, num_units, self.options), None))
+            except OmeError as error:
+                results.append((infile, None, error))
+        return results
+
+    def build_output(self, infile, units):
+        output = self.get_output(infile)
+        self.print_verbose('building output', output)
+        if len(units) > 1:
+            self.backend.build_units(self.shell, units, output, self.options)
+        else:
+            self.backend.build_string(self.shell, units[0], output, self.options)
+
+    def stream_output(self, infile):
+        output = self.get_output(infile)
+        self.print_verbose('streaming output', output)
+        def write_code(out):
+            compiler.compile_file_to_stream(infile, self.target, out, self.options)
+        self.backend.build_stream(self.shell, write_code, output, self.options)
+
+    def stream_outputs(self, infiles):
+        """
+        Build each file with the frontend writing straight into the backend.
+        Returns a list of (infile, error) tuples.
+        """
+        results = []
+        for infile in infiles:
+            try:
+                self.stream_output(infile)
+                results.append((infile, None))
+            except OmeError as error:
+                results.append((infile, error))
+        return results
+
+    def build_outputs(self, results):
+        """
+        Run the backend for each file that compiled, concurrently if there
+        are several. Returns a list of (infile, error) tuples.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(self.options.jobs) as executor:
+            futures = [(infile, executor.submit(self.build_output, infile, units))
+                       for infile, units, error in results if not error]
+            return [(infile, get_result(future)[1]) for infile, future in futures]
+
+    def compile_and_build(self, infiles):
+        """Run the frontend then the backend. Returns True if any file failed."""
+        compile_start = time.time()
+        if len(infiles) == 1 and self.options.link and hasattr(self.backend, 'build_units'):
+            num_units = self.options.jobs
+        else:
+            num_units = 1
+        results = self.compile_files(infiles, num_units)
+        self.print_verbose('frontend compilation completed in %.2fs' % (time.time() - compile_start))
+
+        build_start = time.time()
+        failed = False
+        for infile, units, error in results:
+            if error:
+                self.report_error(infile, error)
+                failed = True
+        for infile, error in self.build_outputs(results):
+            if error:
+                self.report_error(infile, error)
+                failed = True
+        self.print_verbose('backend build completed in %.2fs' % (time.time() - build_start))
+        return failed
+
+    def report_timing(self):
+        if self.args.time_passes:
+            self.options.timer.report(sys.stderr)
+        if self.args.time_passes_json:
+            with open(self.args.time_passes_json, 'w') as f:
+                f.write(self.options.timer.to_json())
+                f.write('\n')
+
+    def report_error(self, infile, error):
+        if error.filename == 'ome':
+            error.filename = infile
+        error.write_ansi(stderr)
+        stderr.reset()
+
     def main(self):
         stderr.reset()
 
@@ -137,30 +270,63 @@ class OmeApp(object):
             self.print_version()
 
         self.check_args()
-        self.print_command(self.args.infile)
+        try:
+            self.run(self.args.file)
+        finally:
+            self.report_timing()
+
+    def run(self, infiles):
+        if any([self.print_command(infile) for infile in infiles]):
+            sys.exit()
         self.initialize_backend()
-        output = self.get_output()
+        for infile in infiles:
+            self.get_output(infile)
 
         self.print_verbose('using target {}'.format(self.target.name))
         self.print_verbose('using backend {} {}'.format(self.backend.name, self.backend.version))
 
         self.build_packages()
+        self.build_runtime()
 
-        self.print_verbose('compiling {}'.format(self.args.infile))
-        compile_start = time.time()
-        input = compiler.compile_file(self.args.infile, self.target, self.options)
-        self.print_verbose('frontend compilation completed in %.2fs' % (time.time() - compile_start))
-
-        self.print_verbose('building output', output)
-        build_start = time.time()
-        self.backend.build_string(self.shell, input, output, self.options)
-        self.print_verbose('backend build completed in %.2fs' % (time.time() - build_start))
+        self.print_verbose('compiling {}'.format(', '.join(infiles)))
+        if self.args.stream and hasattr(self.backend, 'build_stream'):
+            failed = False
+            for infile, error in self.stream_outputs(infiles):
+                if error:
+                    self.report_error(infile, error)
+                    failed = True
+        else:
+            failed = self.compile_and_build(infiles)
 
         self.print_verbose('completed in %.2fs' % (time.time() - self.start))
+        if failed:
+            sys.exit(1)
+
+def compile_file_units(infile, target_name, num_units, options):
+    """Run the frontend in a worker process. Returns the units and the pass timings."""
+    if isinstance(options.timer, PassTimer):
+        options.timer = PassTimer()
+    options.jobs = 1  # The other jobs are compiling the other files
+    units = compiler.compile_file_units(infile, build.get_target(target_name), num_units, options)
+    return units, options.timer
 
-def main():
+def get_result(future):
     try:
-        app = OmeApp(argparser.parse_args())
+        return future.result(), None
+    except OmeError as error:
+        return None, error
+
+def main(argv=None):
+    try:
+        args = argparser.parse_args(argv)
+        if args.connect:
+            from . import server
+            sys.exit(server.run_client(sys.argv[1:] if argv is None else argv))
+        if args.server:
+            from . import server
+            server.run_server(args.socket, args.verbose)
+            return
+        app = OmeApp(args)
         app.main()
     except OmeError as error:
         error.write_ansi(stderr)
@@ -2,60 +2,27 @@
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
 import re
-from .error import OmeParseError
+from .source import Source, SourcePosition
 
-re_newline = re.compile(r'\r\n|\r|\n')
-
-class ParserState(object):
-    def __init__(self, state):
-        self.set_state(state)
-
-    def set_state(self, state):
-        self.stream = state.stream
-        self.stream_name = state.stream_name
-        self.pos = state.pos
-        self.line_pos = state.line_pos
-        self.line_number = state.line_number
-
-    def copy_state(self):
-        return ParserState(self)
-
-    @property
-    def current_line(self):
-        m = re_newline.search(self.stream, self.pos)
-        return self.stream[self.line_pos : m.start() if m else len(self.stream)]
-
-    @property
-    def column(self):
-        return self.pos - self.line_pos
-
-    def error(self, message):
-        raise OmeParseError(message, self)
-
-class BaseParser(ParserState):
+class BaseParser(object):
     re_spaces = re.compile('\s*')
 
-    def __init__(self, stream, stream_name):
+    def __init__(self, stream, stream_name, first_line=1):
         self.stream = stream
         self.stream_name = stream_name
-        self._pos = 0           # Current position
-        self.line_pos = 0       # Position of the 1st character of the current line
-        self.line_number = 1    # Current line number (starting from 1)
+        self.source = Source(stream, stream_name, first_line)
+        self.pos = 0            # Current position
         self._string_re = {}
 
     @property
-    def pos(self):
-        return self._pos
-
-    @pos.setter
-    def pos(self, pos):
-        assert pos >= self._pos
-        m = None
-        for m in re_newline.finditer(self.stream, self._pos, pos):
-            self.line_number += 1
-        if m:
-            self.line_pos = m.end()
-        self._pos = pos
+    def line_number(self):
+        return self.source.line_number(self.pos)
+
+    def position(self):
+        return SourcePosition(self.source, self.pos)
+
+    def error(self, message):
+        self.position().error(message)
 
     def get_re(self, pattern):
         if isinstance(pattern, str):
@@ -1,7 +1,7 @@
 # ome - Object Message Expressions
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
-import subprocess
+import importlib
 from .error import OmeError
 from .target import target_map
 
@@ -9,7 +9,9 @@ def get_target(target_name):
     target_name = target_name.lower()
     if target_name not in target_map:
         raise OmeError("unknown target '{}'".format(target_name))
-    return target_map[target_name]
+    return importlib.import_module(target_map[target_name], __package__ + '.target')
+
+_backend_versions = {}
 
 def get_backend_version(backend):
     if not hasattr(backend, 'version') and hasattr(backend, 'version_args'):
@@ -19,13 +21,18 @@ def get_backend_version(backend):
         if not executable:
             raise OmeError("backend tool '{}' not found".format(args[0]))
         args[0] = executable
+        key = (backend.name, tuple(args))
+        if key in _backend_versions:
+            backend.version = _backend_versions[key]
+            return
+        import subprocess
         try:
             process = subprocess.Popen(args, stdout=subprocess.PIPE)
             outs, errs = process.communicate()
             if process.returncode == 0:
                 m = backend.version_re.match(outs.decode('ascii'))
                 if m:
-                    backend.version = m.group(1)
+                    backend.version = _backend_versions[key] = m.group(1)
                     return
         except OSError as e:
             reason = str(e)
@@ -34,7 +41,9 @@ def get_backend_version(backend):
         raise OmeError("backend '{}' is not available: {}".format(backend.name, reason))
 
 def _get_backend(target, backend_name, backend_tools):
-    return target.backends[backend_name](backend_tools)
+    module_name, class_name = target.backends[backend_name]
+    module = importlib.import_module(module_name, target.__name__)
+    return getattr(module, class_name)(backend_tools)
 
 def get_backend(target, platform, backend_name=None, backend_tools={}):
     platform = platform.lower()
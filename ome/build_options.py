@@ -1,5 +1,7 @@
 import platform
 from .ome_types import CompileOptions
+from .timing import null_timer
+from .util import get_cache_dir
 
 platform_defines = {
     'linux':  [
@@ -18,7 +20,7 @@ class BuildOptions(CompileOptions):
                   link=False, static=False, use_musl=False, musl_path=None,
                   verbose=False, verbose_backend=False,
                   include_dirs=(), library_dirs=(), libraries=(), objects=(),
-                  defines=()):
+                  defines=(), cache_dir=None, shared_runtime=False, jobs=1):
         self.platform = platform.lower()
         self.variant = variant
         self.link = link
@@ -32,6 +34,10 @@ class BuildOptions(CompileOptions):
         self.libraries = list(libraries)
         self.objects = list(objects)
         self.defines = list(defines)
+        self.cache_dir = cache_dir
+        self.shared_runtime = shared_runtime
+        self.jobs = jobs
+        self.timer = null_timer
         if self.debug:
             self.defines.append(('DEBUG', ''))
             self.defines.append(('_DEBUG', ''))
@@ -74,7 +80,9 @@ def get_build_options_from_command(args):
         include_dirs = args.include_dir,
         library_dirs = args.library_dir,
         libraries = args.library,
-        defines = [d.split('=', 1) if '=' in d else (d, '') for d in args.define])
+        defines = [d.split('=', 1) if '=' in d else (d, '') for d in args.define],
+        cache_dir = None if args.no_cache else get_cache_dir('ome'),
+        jobs = args.jobs)
     options.set_ome_defines(
         debug_gc = args.debug_gc,
         gc_stats = args.gc_stats,
@@ -2,6 +2,7 @@ import os
 import shlex
 import shutil
 import subprocess
+from contextlib import contextmanager
 from .error import OmeError
 
 def run_shell_command(args, input=None, output=None, **kwargs):
@@ -48,3 +49,32 @@ class BuildShell(object):
         args = get_args_list(args)
         self.print_command(args)
         return run_shell_command(args, input, output, cwd=self._pwd)
+
+    @contextmanager
+    def pipe(self, *args):
+        """
+        Run a command, yielding a binary file that is piped to its standard
+        input. The command is killed if the body raises an exception.
+        """
+        args = get_args_list(args)
+        self.print_command(args)
+        process = subprocess.Popen(args, stdin=subprocess.PIPE, cwd=self._pwd)
+        broken_pipe = False
+        try:
+            yield process.stdin
+            process.stdin.close()
+        except BrokenPipeError:
+            broken_pipe = True
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+            process.wait()
+        if process.returncode != 0:
+            raise OmeError('command failed with return code {}'.format(process.returncode))
+        if broken_pipe:
+            raise OmeError('command exited before reading all of its input')
@@ -58,11 +58,6 @@ static int OME_mp_init_from_integer(mp_int *out, mp_digit *dp, OME_Value n)
     return 0;
 }
 
-static int OME_is_small_integer(intptr_t n)
-{
-    return OME_MIN_SMALL_INTEGER <= n && n <= OME_MAX_SMALL_INTEGER;
-}
-
 static OME_Value OME_inequality(int cmp)
 {
     return cmp < 0 ? OME_Less : (cmp > 0 ? OME_Greater : OME_Equal);
@@ -113,7 +108,7 @@ static int mp_remainder(mp_int *a, mp_int *b, mp_int *c)
     OME_mp_init_from_large_integer(&n, self);
     int size;
     mp_radix_size(&n, 10, &size);
-    OME_String *string = OME_allocate_string(size);
+    OME_String *string = OME_allocate_string(size - 1);  // size includes the terminating NUL
     OME_LOAD_LOCAL(0, self);
     n.dp = ((OME_Large_Integer *) OME_untag_pointer(self))->digits;
     mp_toradix(&n, string->data, 10);
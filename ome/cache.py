@@ -0,0 +1,110 @@
+# ome - Object Message Expressions
+# Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from .util import make_path, remove
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+package_file_extensions = ('.py', '.c', '.h')
+
+def get_hash(*parts):
+    """Hash a sequence of strings and byte strings into a hex digest."""
+    m = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf8')
+        m.update(str(len(part)).encode('ascii'))
+        m.update(b':')
+        m.update(part)
+    return m.hexdigest()
+
+_package_hash = None
+
+def get_package_hash():
+    """
+    Hash the compiler sources, runtime and builtins. Any change to these
+    invalidates everything in the cache.
+    """
+    global _package_hash
+    if _package_hash is None:
+        parts = []
+        for dirpath, dirnames, filenames in os.walk(package_dir):
+            dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+            for filename in sorted(filenames):
+                if filename.endswith(package_file_extensions):
+                    path = os.path.join(dirpath, filename)
+                    with open(path, 'rb') as f:
+                        parts.append(os.path.relpath(path, package_dir))
+                        parts.append(f.read())
+        _package_hash = get_hash(*parts)
+    return _package_hash
+
+class Cache(object):
+    """
+    Content-addressed store of files in a directory. Entries are written
+    atomically so concurrent builds can share the same cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, key, write, mode_path=None):
+        path = self.get_path(key)
+        try:
+            make_path(os.path.dirname(path))
+            fd, temp_path = tempfile.mkstemp(prefix='.ome-cache.', dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    write(f)
+                if mode_path:
+                    shutil.copymode(mode_path, temp_path)
+                os.replace(temp_path, path)
+            except BaseException:
+                remove(temp_path)
+                raise
+        except OSError:
+            pass
+
+    def put(self, key, data):
+        self._write(key, lambda f: f.write(data))
+
+    def get_file(self, key, dest_path):
+        """Copy a cached file to dest_path. Returns False if not cached."""
+        path = self.get_path(key)
+        try:
+            shutil.copyfile(path, dest_path)
+            shutil.copymode(path, dest_path)
+            return True
+        except OSError:
+            return False
+
+    def put_file(self, key, src_path):
+        def write(f):
+            with open(src_path, 'rb') as src:
+                shutil.copyfileobj(src, f)
+        self._write(key, write, src_path)
+
+    def load(self, key):
+        data = self.get(key)
+        if data is not None:
+            try:
+                return pickle.loads(data)
+            except Exception:
+                remove(self.get_path(key))
+
+    def store(self, key, value):
+        self.put(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
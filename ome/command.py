@@ -32,4 +32,13 @@ argparser.add_argument('--debug-gc', action='store_true')
 argparser.add_argument('--gc-stats', action='store_true')
 argparser.add_argument('--no-traceback', action='store_true')
 argparser.add_argument('--no-source-traceback', action='store_true')
+argparser.add_argument('--no-cache', action='store_true')
+argparser.add_argument('--no-shared-runtime', action='store_true')
+argparser.add_argument('--jobs', '-j', action='store', type=int, default=1)
+argparser.add_argument('--stream', action='store_true')
+argparser.add_argument('--time-passes', action='store_true')
+argparser.add_argument('--time-passes-json', action='store', default=None)
 argparser.add_argument('--output', '-o', action='store', default=None)
+argparser.add_argument('--server', action='store_true')
+argparser.add_argument('--connect', action='store_true')
+argparser.add_argument('--socket', action='store', default=None)
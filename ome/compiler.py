@@ -2,29 +2,44 @@
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
 import io
+import os
 from . import constants
 from .error import OmeError
+from .escape import find_stack_blocks
 from .idalloc import IdAllocator
-from .ome_ast import Block, BuiltInBlock, Method, Send, Sequence
+from .lowering import find_inline_blocks
+from .ome_ast import Block, BuiltInBlock, Method, Send, Sequence, String
 from .ome_types import CompileOptions, TraceBackInfo
-from .parser import Parser
+from .parser import parse_toplevel
+from .reachability import find_reachable_methods
 from .terminal import stderr
+from .util import gc_disabled
+from .version import version
 
 default_compile_options = CompileOptions()
 
-def collect_nodes_of_type(ast, node_type):
-    nodes = []
-    def append_block(node):
-        if isinstance(node, node_type):
-            nodes.append(node)
-    ast.walk(append_block)
-    return nodes
-
-def make_send_traceback_info(send, index):
+def collect_nodes_of_types(ast, *node_types):
+    """Collect the nodes of each type, in a single walk over the AST."""
+    lists = [[] for node_type in node_types]
+    types_and_lists = list(zip(node_types, lists))
+    def append_node(node):
+        for node_type, nodes in types_and_lists:
+            if isinstance(node, node_type):
+                nodes.append(node)
+    ast.walk(append_node)
+    return lists
+
+def make_send_traceback_info(send, index, line_cache):
     ps = send.parse_state
-    line_unstripped = ps.current_line.rstrip()
-    line = line_unstripped.lstrip()
-    column = ps.column - (len(line_unstripped) - len(line))
+    # Sends on the same line share its text, so that a long line (e.g. in
+    # generated code) is not scanned and copied again for every send
+    line_key = (ps.stream_name, ps.line_number)
+    if line_key not in line_cache:
+        line_unstripped = ps.current_line.rstrip()
+        line = line_unstripped.lstrip()
+        line_cache[line_key] = (line, len(line_unstripped) - len(line))
+    line, indent = line_cache[line_key]
+    column = ps.column - indent
     underline = send.symbol.find(':') + 1
     if underline < 1:
         underline = max(len(send.symbol), 1)
@@ -37,6 +52,31 @@ def make_send_traceback_info(send, index):
         column = column,
         underline = underline)
 
+def print_warning(filename, message):
+    stderr.bold()
+    stderr.write('{}: '.format(filename))
+    stderr.colour('magenta')
+    stderr.write('warning: ')
+    stderr.reset()
+    stderr.write(message + '\n')
+
+def emit_constants(out, target, builtin, ids, shared_runtime=False, split_program=False):
+    if shared_runtime or split_program:
+        target.emit_constant(out, 'SHARED_RUNTIME', 1)
+    if split_program:
+        target.emit_constant(out, 'SPLIT_PROGRAM', 1)
+    for name, value in sorted(constants.__dict__.items()):
+        if isinstance(value, int):
+            target.emit_constant(out, name, value)
+    for name in ids.tag_names:
+        target.emit_constant(out, 'Tag_' + name.replace('-', '_'), ids.tags[name])
+    target.emit_constant(out, 'Pointer_Tag', ids.pointer_tag_id)
+    for name in ids.constant_names:
+        target.emit_constant(out, 'Constant_' + name.replace('-', '_'), ids.constants[name])
+    out.write('\n')
+    target.emit_builtin_header(out, builtin)
+    out.write('\n')
+
 class Program(object):
     def __init__(self, ast, target, filename='', options=default_compile_options):
         self.target = target
@@ -45,35 +85,52 @@ class Program(object):
         self.code_table = []  # list of (symbol, [list of (tag, method)])
         self.data_table = target.DataTable()
         self.traceback_table = {}
-        self.builtin = target.get_builtin()
+        self.warnings = []
+        self.builtin = target.get_builtin(options.cache_dir)
         self.ids = IdAllocator(self.builtin)
 
         self.builtin_block = BuiltInBlock(self.builtin.methods)
         self.builtin_block.tag_id = self.ids.tags['BuiltIn']
         self.builtin_block.constant_id = self.ids.constants['BuiltIn']
-
-        ast = Method('', [], ast)
-        ast = ast.resolve_free_vars(self.builtin_block)
-        ast = ast.resolve_block_refs(self.builtin_block)
-        self.toplevel_method = ast
-        self.send_list = collect_nodes_of_type(ast, Send)
-        self.block_list = collect_nodes_of_type(ast, Block)
-        self.ids.allocate_block_ids(self.block_list)
-
-        self.message('allocated {} tag IDs, {} constant IDs'.format(
-            self.ids.num_tag_ids, self.ids.num_constant_ids))
-
-        toplevel_block = ast.expr
-        if isinstance(toplevel_block, Sequence):
-            toplevel_block = self.toplevel_block.statements[-1]
-        if 'main' not in toplevel_block.symbols:
-            self.error('no main method defined')
-
-        if self.options.traceback:
-            self.compile_traceback_info()
-
-        self.find_used_methods()
-        self.build_code_table()
+        self.builtin_messages = frozenset(method.symbol for method in self.builtin.messages)
+
+        # The passes over the AST only add to it, so there is nothing for the
+        # cyclic garbage collector to find while they run
+        with gc_disabled():
+            timer = options.timer
+            ast = Method('', [], ast)
+            with timer.time('resolve_free_vars'):
+                ast = ast.resolve_free_vars(self.builtin_block)
+            with timer.time('resolve_block_refs'):
+                ast = ast.resolve_block_refs(self.builtin_block)
+            self.toplevel_method = ast
+            with timer.time('collect_nodes'):
+                self.send_list, self.block_list = collect_nodes_of_types(ast, Send, Block)
+            with timer.time('allocate_block_ids'):
+                self.ids.allocate_block_ids(self.block_list)
+            self.constant_blocks = dict((block.tag_id, block) for block in self.block_list if block.is_constant)
+
+            self.message('allocated {} tag IDs, {} constant IDs'.format(
+                self.ids.num_tag_ids, self.ids.num_constant_ids))
+
+            toplevel_block = ast.expr
+            if isinstance(toplevel_block, Sequence):
+                toplevel_block = self.toplevel_block.statements[-1]
+            if 'main' not in toplevel_block.symbols:
+                self.error('no main method defined')
+
+            if self.options.traceback:
+                with timer.time('compile_traceback_info'):
+                    self.compile_traceback_info()
+
+            with timer.time('find_inline_blocks'):
+                self.find_inline_blocks()
+            with timer.time('find_reachable_methods'):
+                self.find_reachable_methods()
+            with timer.time('find_stack_blocks'):
+                self.find_stack_blocks()
+            with timer.time('build_code_table'):
+                self.build_code_table()
 
     def message(self, message):
         if self.options.verbose:
@@ -83,14 +140,11 @@ class Program(object):
         raise OmeError(message, self.filename)
 
     def warning(self, message):
-        stderr.bold()
-        stderr.write('{}: '.format(self.filename))
-        stderr.colour('magenta')
-        stderr.write('warning: ')
-        stderr.reset()
-        stderr.write(message + '\n')
+        self.warnings.append(message)
+        print_warning(self.filename, message)
 
     def compile_traceback_info(self):
+        line_cache = {}
         for send in self.send_list:
             if send.parse_state:
                 ps = send.parse_state
@@ -98,43 +152,54 @@ class Program(object):
                 if key in self.traceback_table:
                     tbinfo = self.traceback_table[key]
                 else:
-                    tbinfo = make_send_traceback_info(send, len(self.traceback_table))
+                    tbinfo = make_send_traceback_info(send, len(self.traceback_table), line_cache)
                     self.traceback_table[key] = tbinfo
                 send.traceback_info = tbinfo
 
-    def find_used_methods(self):
-        self.sent_messages = set(['main', 'string'])
-        self.sent_messages.update(
-            send.symbol for send in self.send_list if send.receiver and not send.receiver_block)
-
-        called_methods = set(
-            (send.receiver_block.tag_id, send.symbol) for send in self.send_list
-            if send.receiver_block and send.symbol not in self.sent_messages)
-
-        for method in self.builtin.messages:
-            if method.sent_messages and method.symbol in self.sent_messages:
-                self.sent_messages.update(method.sent_messages)
-
-        for symbol in list(self.sent_messages):
-            if symbol in self.builtin.defaults:
-                self.sent_messages.update(self.builtin.defaults[symbol].sent_messages)
-
-        for method in self.builtin.methods:
-            if method.tag_name not in self.ids.tags:
-                raise OmeError("Unknown tag name '{}' in built-in method '{}'".format(method.tag_name, method.symbol))
-            method_tag = self.ids.tags[method.tag_name]
-            if method.sent_messages and (method.symbol in self.sent_messages or (method_tag, method.symbol) in called_methods):
-                self.sent_messages.update(method.sent_messages)
-
-        self.called_methods = set(
-            (send.receiver_block.tag_id, send.symbol) for send in self.send_list
-            if send.receiver_block and send.symbol not in self.sent_messages)
+    def find_inline_blocks(self):
+        count = find_inline_blocks(self.send_list, self.block_list, self.builtin, self.builtin_block)
+        self.message('inlining {} control flow blocks'.format(count))
+
+    def find_reachable_methods(self):
+        reachable = find_reachable_methods(self.toplevel_method, self.send_list, self.block_list, self.builtin, self.ids)
+        self.sent_messages = reachable.sent_messages
+        self.reachable_methods = reachable.methods
+        self.reachable = reachable
+
+    def find_stack_blocks(self):
+        count = find_stack_blocks(self.send_list, self.block_list, self.reachable, self.builtin_block)
+        self.reachable = None
+        self.message('allocating {} blocks on the stack'.format(count))
+
+    def lookup_method(self, tag, symbol):
+        """
+        Get the label of the method that sending symbol to a value with tag
+        runs, or None if it is not a method of the tag. Built-in messages
+        that are not dispatched on the receiver have no methods.
+        """
+        if (tag, symbol) in self.reachable_methods and symbol not in self.builtin_messages:
+            return self.target.make_method_label(tag, symbol)
+
+    def get_constant_string(self, tag, symbol):
+        """
+        Get the string that sending show or string to a constant block with
+        tag gives, if the method that runs just returns a literal string.
+        Blocks without a string method use the default, which sends show.
+        """
+        block = self.constant_blocks.get(tag)
+        if block and symbol in ('show', 'string'):
+            if symbol not in block.symbols:
+                symbol = 'show'
+            for method in block.methods:
+                if method.symbol == symbol and isinstance(method.expr, String):
+                    return method.expr.string
 
     def should_include_method(self, method, tag):
-        return method.symbol in self.sent_messages or (tag, method.symbol) in self.called_methods
+        return (tag, method.symbol) in self.reachable_methods
 
     def build_code_table(self):
         methods = {}
+        dropped = []
 
         for method in self.builtin.methods:
             method_tag = self.ids.tags[method.tag_name]
@@ -142,6 +207,8 @@ class Program(object):
                 if method.symbol not in methods:
                     methods[method.symbol] = []
                 methods[method.symbol].append((method_tag, method))
+            else:
+                dropped.append((method_tag, method))
 
         for block in self.block_list:
             for method in block.methods:
@@ -150,22 +217,36 @@ class Program(object):
                         methods[method.symbol] = []
                     code = method.generate_code(self)
                     methods[method.symbol].append((block.tag_id, code))
+                else:
+                    dropped.append((block.tag_id, method))
 
         for symbol in sorted(methods.keys()):
             self.code_table.append((symbol, methods[symbol]))
 
-    def emit_constants(self, out):
-        for name, value in sorted(constants.__dict__.items()):
-            if isinstance(value, int):
-                self.target.emit_constant(out, name, value)
-        for name in self.ids.tag_names:
-            self.target.emit_constant(out, 'Tag_' + name.replace('-', '_'), self.ids.tags[name])
-        self.target.emit_constant(out, 'Pointer_Tag', self.ids.pointer_tag_id)
-        for name in self.ids.constant_names:
-            self.target.emit_constant(out, 'Constant_' + name.replace('-', '_'), self.ids.constants[name])
-        out.write('\n')
-        self.target.emit_builtin_header(out, self.builtin)
-        out.write('\n')
+        if self.options.verbose:
+            self.message('dropped {} unreachable methods ({} bytes of target code)'.format(
+                len(dropped), self.get_target_code_size(dropped)))
+
+    def get_target_code_size(self, methods):
+        """
+        Get the size of the target code of methods that are not part of the
+        program. Their data is put in a separate table which is thrown away.
+        """
+        data_table = self.data_table
+        self.data_table = self.target.DataTable()
+        try:
+            size = 0
+            for tag, method in methods:
+                label = self.target.make_method_label(tag, method.symbol)
+                if isinstance(method, Method):
+                    method = method.generate_code(self)
+                size += len(method.generate_target_code(label, self.target))
+            return size
+        finally:
+            self.data_table = data_table
+
+    def emit_constants(self, out, split_program=False):
+        emit_constants(out, self.target, self.builtin, self.ids, self.options.shared_runtime, split_program)
 
     def emit_data(self, out):
         self.data_table.emit(out)
@@ -175,6 +256,10 @@ class Program(object):
             self.target.emit_traceback_table(out, traceback_entries, self.options.source_traceback)
             out.write('\n')
 
+    def emit_data_declarations(self, out):
+        self.data_table.emit_declarations(out)
+        out.write('\n')
+
     def emit_code_declarations(self, out):
         methods_set = set()
         messages_set = set(self.sent_messages)
@@ -195,38 +280,55 @@ class Program(object):
         out.write(self.target.generate_lookup_dispatcher(symbol, tags, has_default_method))
         out.write('\n')
 
-    def emit_code_definitions(self, out):
-        self.target.emit_builtin_code(out)
-        out.write('\n')
-        for s in self.builtin.code:
-            out.write(s)
+    def emit_builtin_code(self, out):
+        if not self.options.shared_runtime:
+            self.target.emit_builtin_code(out)
+            out.write('\n')
 
+    def generate_code_definitions(self, release=False):
+        """
+        Generate the target code for each message in turn, consisting of
+        its methods followed by its dispatcher. If release is true the IR of
+        each message is dropped from the code table once it is generated.
+        """
         dispatchers = set()
         for method in self.builtin.messages:
             if method.symbol in self.sent_messages:
-                out.write(method.generate_target_code(self.target.make_message_label(method.symbol), self.target))
-                out.write('\n')
+                yield method.generate_target_code(self.target.make_message_label(method.symbol), self.target, self.options.timer) + '\n'
                 dispatchers.add(method.symbol)
 
-        for symbol, methods in self.code_table:
+        for index, (symbol, methods) in enumerate(self.code_table):
+            if release:
+                self.code_table[index] = None
+            out = io.StringIO()
             for tag, code in methods:
-                out.write(code.generate_target_code(self.target.make_method_label(tag, symbol), self.target))
+                out.write(code.generate_target_code(self.target.make_method_label(tag, symbol), self.target, self.options.timer))
                 out.write('\n')
             if symbol in self.sent_messages:
                 tags = [tag for tag, code in methods]
                 self.emit_dispatcher(out, symbol, tags)
                 dispatchers.add(symbol)
+            yield out.getvalue()
 
         optional_messages = frozenset(['return', 'catch', 'catch:'])
         for symbol in sorted(self.sent_messages):
             if symbol not in dispatchers:
                 if symbol not in optional_messages and symbol not in self.builtin.defaults:
                     self.warning("no methods defined for message '%s'" % symbol)
+                out = io.StringIO()
                 self.emit_dispatcher(out, symbol, [])
+                yield out.getvalue()
+
+    def emit_code_definitions(self, out):
+        self.emit_builtin_code(out)
+        for s in self.builtin.code:
+            out.write(s)
+        for definition in self.generate_code_definitions():
+            out.write(definition)
 
     def emit_toplevel(self, out):
         code = self.toplevel_method.generate_code(self)
-        out.write(code.generate_target_code('OME_toplevel', self.target))
+        out.write(code.generate_target_code('OME_toplevel', self.target, self.options.timer))
         out.write('\n')
         self.target.emit_builtin_main(out)
 
@@ -237,26 +339,106 @@ class Program(object):
         self.emit_code_definitions(out)
         self.emit_toplevel(out)
 
+    def emit_program_stream(self, out):
+        """
+        Write the target code to out one section at a time, releasing the
+        AST once the top-level code is generated and the IR of each message
+        once it is written, so the program text and IR are never held in
+        memory all at once. The program cannot be emitted again afterwards.
+        """
+        toplevel = io.StringIO()
+        self.emit_toplevel(toplevel)
+        self.toplevel_method = self.send_list = self.block_list = None
+        self.emit_constants(out)
+        self.emit_data(out)
+        self.emit_code_declarations(out)
+        self.emit_builtin_code(out)
+        for s in self.builtin.code:
+            out.write(s)
+        for definition in self.generate_code_definitions(release=True):
+            out.write(definition)
+        out.write(toplevel.getvalue())
+
     def get_program_text(self):
         out = io.BytesIO()
         text_out = io.TextIOWrapper(out, encoding=self.target.encoding, write_through=True)
         self.emit_program_text(text_out)
         return out.getvalue()
 
-def parse_string(string, filename='<string>'):
-    return Parser(string, filename).toplevel()
-
-def parse_file(filename):
+    def get_program_units(self, num_units):
+        """
+        Split the target code into at most num_units translation units that
+        can be compiled in parallel. The first unit holds the data, the
+        top-level code and the runtime (unless it is shared), and the
+        definitions of each message are assigned to the smallest unit so far.
+        """
+        if num_units <= 1:
+            return [self.get_program_text()]
+
+        toplevel = io.StringIO()
+        self.emit_toplevel(toplevel)
+        definitions = [[] for i in range(num_units)]
+        sizes = [0] * num_units
+        sizes[0] = len(toplevel.getvalue())
+        for definition in self.generate_code_definitions():
+            index = sizes.index(min(sizes))
+            definitions[index].append(definition)
+            sizes[index] += len(definition)
+
+        units = []
+        for index, unit_definitions in enumerate(definitions):
+            if index > 0 and not unit_definitions:
+                continue
+            out = io.BytesIO()
+            text_out = io.TextIOWrapper(out, encoding=self.target.encoding, write_through=True)
+            self.emit_constants(text_out, split_program=True)
+            if index == 0:
+                self.emit_data(text_out)
+            else:
+                self.emit_data_declarations(text_out)
+            self.emit_code_declarations(text_out)
+            if index == 0:
+                self.emit_builtin_code(text_out)
+            for s in self.builtin.code:
+                text_out.write(s)
+            for definition in unit_definitions:
+                text_out.write(definition)
+            if index == 0:
+                text_out.write(toplevel.getvalue())
+            units.append(out.getvalue())
+        return units
+
+def get_runtime_text(target, cache_dir=None):
+    """
+    Get the target code for the runtime when compiled separately from the
+    program. The runtime only depends on the tag IDs of built-in types,
+    which are the same for every program.
+    """
+    builtin = target.get_builtin(cache_dir)
+    ids = IdAllocator(builtin)
+    ids.allocate_block_ids([])
+    out = io.BytesIO()
+    text_out = io.TextIOWrapper(out, encoding=target.encoding, write_through=True)
+    emit_constants(text_out, target, builtin, ids, shared_runtime=True)
+    target.emit_builtin_code(text_out)
+    return out.getvalue()
+
+def parse_string(string, filename='<string>', jobs=1):
+    return parse_toplevel(string, filename, jobs)
+
+def read_source(filename):
     try:
         with open(filename, encoding='utf8') as f:
-            source = f.read()
+            return f.read()
     except FileNotFoundError:
         raise OmeError('file does not exist', filename)
     except UnicodeDecodeError as e:
         raise OmeError('utf-8 decoding failed at position {0.start}: {0.reason}'.format(e), filename)
     except Exception as e:
         raise OmeError(str(e), filename)
-    return parse_string(source, filename)
+
+def parse_file(filename):
+    return parse_string(read_source(filename), filename)
 
 def compile_ast(ast, target, filename, options):
     return Program(ast, target, filename, options).get_program_text()
@@ -264,5 +446,68 @@ def compile_ast(ast, target, filename, options):
 def compile_string(string, target, filename='<string>', options=default_compile_options):
     return compile_ast(parse_string(string, filename), target, filename, options)
 
+def get_compile_cache_key(source, target, filename, options, num_units=1):
+    from .cache import get_hash, get_package_hash
+    return get_hash(
+        'frontend',
+        '{}.{}.{}'.format(*version),
+        get_package_hash(),
+        target.name,
+        filename,
+        source,
+        str(options.traceback),
+        str(options.source_traceback),
+        str(options.shared_runtime),
+        str(num_units))
+
 def compile_file(filename, target, options=default_compile_options):
-    return compile_ast(parse_file(filename), target, filename, options)
+    return compile_file_units(filename, target, 1, options)[0]
+
+def compile_file_to_stream(filename, target, out, options=default_compile_options):
+    """
+    Compile a source file, writing the target code to the binary file out as
+    it is generated. The output is not cached.
+    """
+    timer = options.timer
+    with timer.time('parse'):
+        ast = parse_string(read_source(filename), filename, options.jobs)
+    program = Program(ast, target, filename, options)
+    del ast
+    text_out = io.TextIOWrapper(out, encoding=target.encoding)
+    with timer.time('emit'):
+        program.emit_program_stream(text_out)
+        text_out.flush()
+    text_out.detach()
+
+def compile_file_units(filename, target, num_units, options=default_compile_options):
+    """
+    Compile a source file to a list of at most num_units translation units
+    of target code. If options.cache_dir is set the output is cached, keyed
+    on the source text, the compiler and the options that affect the
+    generated code.
+    """
+    timer = options.timer
+    source = read_source(filename)
+    if options.cache_dir:
+        from .cache import Cache
+        with timer.time('frontend cache'):
+            cache = Cache(os.path.join(options.cache_dir, 'frontend'))
+            key = get_compile_cache_key(source, target, filename, options, num_units)
+            entry = cache.load(key)
+        if entry:
+            units, warnings = entry
+            if options.verbose:
+                print('ome: using cached frontend output for', filename)
+            for message in warnings:
+                print_warning(filename, message)
+            return units
+
+    with timer.time('parse'):
+        ast = parse_string(source, filename, options.jobs)
+    program = Program(ast, target, filename, options)
+    with timer.time('emit'):
+        units = program.get_program_units(num_units)
+    if options.cache_dir:
+        with timer.time('frontend cache'):
+            cache.store(key, (units, program.warnings))
+    return units
@@ -99,8 +99,7 @@ class CPreParser(BaseParser):
         leading, m = self.search(re_end_method)
         if not m:
             self.error('reached end of file while parsing method')
-        refparser = CMethodRefParser(leading, self.stream_name)
-        refparser.line_number = line_number
+        refparser = CMethodRefParser(leading, self.stream_name, line_number)
         refs, code = refparser.parse()
         return BuiltInMethod(tag_name, symbol, argnames, refs, code)
 
@@ -3,6 +3,8 @@
 
 import io
 from contextlib import contextmanager
+from .optimise import eliminate_redundant_loads, eliminate_tail_calls, fold_constants, resolve_sends
+from .timing import null_timer
 
 class CodeEmitter(object):
     def __init__(self, indent=' ' * 4, indent_level=0):
@@ -68,9 +70,9 @@ class MethodCode(object):
         self.instructions = instructions
         self.num_args = num_args
 
-    def generate_target_code(self, label, target):
+    def generate_target_code(self, label, target, timer=null_timer):
         emit = ProcedureCodeEmitter(indent=target.indent)
-        codegen = target.ProcedureCodegen(emit)
+        codegen = target.ProcedureCodegen(emit, timer)
         codegen.optimise(self)
         codegen.begin(label, self.num_args)
         for ins in self.instructions:
@@ -85,12 +87,33 @@ class MethodCodeBuilder(object):
         self.num_locals = num_args + num_locals + 1
         self.program = program
         self.instructions = []
+        self.num_labels = 0
+        self.inline_frames = []  # local index -> local, for each method being inlined
+        self.inline_calls = []   # methods inlined at static sends
+        self.inline_sends = []   # traceback info of each send whose code is being inlined
 
     def add_temp(self):
         local = self.num_locals
         self.num_locals += 1
         return local
 
+    def add_label(self):
+        label = self.num_labels
+        self.num_labels += 1
+        return label
+
+    def get_local(self, index):
+        if self.inline_frames:
+            return self.inline_frames[-1][index]
+        return index
+
+    def get_traceback_info(self, traceback_info):
+        # Errors in inlined code are returned from the sends it was inlined
+        # at too, innermost first, as if their methods had been called
+        if self.inline_sends and traceback_info:
+            return (traceback_info,) + tuple(info for info in reversed(self.inline_sends) if info)
+        return traceback_info
+
     def add_instruction(self, instruction):
         self.instructions.append(instruction)
 
@@ -115,5 +138,14 @@ class MethodCodeBuilder(object):
     def make_method_label(self, tag, symbol):
         return self.program.target.make_method_label(tag, symbol)
 
-    def get_code(self):
+    def get_code(self, label=None):
+        timer = self.program.options.timer
+        with timer.time('eliminate_redundant_loads'):
+            eliminate_redundant_loads(self.instructions)
+        with timer.time('fold_constants'):
+            fold_constants(self)
+        with timer.time('resolve_sends'):
+            resolve_sends(self.instructions, self.program.ids.tags, self.program.lookup_method)
+        with timer.time('eliminate_tail_calls'):
+            eliminate_tail_calls(self, label)
         return MethodCode(self.instructions, self.num_args)
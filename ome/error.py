@@ -1,8 +1,16 @@
+def restore_error(cls, state):
+    error = cls.__new__(cls)
+    error.__dict__.update(state)
+    return error
+
 class OmeError(Exception):
     def __init__(self, message, filename='ome'):
         self.message = message
         self.filename = filename
 
+    def __reduce__(self):
+        return (restore_error, (self.__class__, self.__dict__))
+
     def __str__(self):
         return '{}: error: {}'.format(self.filename, self.message)
 
@@ -0,0 +1,114 @@
+# ome - Object Message Expressions
+# Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
+
+from .ome_ast import Array, Block, LocalVariable, Self, Send, Sequence, SlotGet, SlotSet
+from .ome_types import BuiltInMethod
+
+# Built-in methods that only send messages to their block argument, with the
+# block as the receiver, and return nothing but the results of those sends
+non_retaining_methods = frozenset([
+    ('True', 'if:'),
+    ('False', 'if:'),
+    ('True', 'then:'),
+    ('False', 'then:'),
+    ('True', 'else:'),
+    ('False', 'else:'),
+    ('BuiltIn', 'for:'),
+    ('BuiltIn', 'catch:'),
+    ('BuiltIn', 'try:'),
+    ('Array', 'each:'),
+    ('Array', 'enumerate:'),
+])
+
+class StackBlocks(object):
+    """
+    Find the blocks that can be allocated in the frame of the method that
+    creates them instead of on the heap.
+
+    A block cannot outlive its creator if it is only passed as an argument to
+    built-in methods that do not retain it (such as if:, for: and each:), and
+    its own methods, which those built-in methods call, never let it go
+    anywhere else. Inside its methods a block may be used as the receiver of
+    its own methods and its slots may be read and written, but it may not be
+    returned, passed as an argument or stored. Nested blocks that refer to it
+    keep it in one of their slots, so they must be allocated on the stack too,
+    which is why inner blocks are decided first.
+    """
+
+    def __init__(self, reachable, builtin_block):
+        self.reachable = reachable
+        self.builtin_block = builtin_block
+        self.block_args = {}  # block -> send it is an argument of
+
+    def find(self, send_list, block_list):
+        for send in send_list:
+            for arg in send.args:
+                # Blocks with variables are the last statement of a sequence
+                # that initialises them
+                while isinstance(arg, Sequence):
+                    arg = arg.statements[-1]
+                if isinstance(arg, Block) and not arg.is_constant:
+                    self.block_args[arg] = send
+        count = 0
+        for block in reversed(block_list):  # Nested blocks come after their parents
+            send = self.block_args.get(block)
+            if send and not self.send_retains_args(send) and not self.leaks_self(block):
+                block.on_stack = True
+                count += 1
+        return count
+
+    def send_retains_args(self, send):
+        symbol = send.symbol
+        if send.receiver_block:
+            return send.receiver_block is not self.builtin_block or ('BuiltIn', symbol) not in non_retaining_methods
+        reachable = self.reachable
+        if symbol in reachable.message_methods:
+            return True
+        for tag in reachable.symbol_tags.get(symbol, ()):
+            if (tag, symbol) in reachable.methods:
+                method = reachable.tag_methods[tag][symbol]
+                if not isinstance(method, BuiltInMethod) or (method.tag_name, symbol) not in non_retaining_methods:
+                    return True
+        return False
+
+    def leaks_self(self, block):
+        # Each item is (expr, block whose method contains it, whether a
+        # reference to block is allowed as the value of expr)
+        stack = [(method.expr, block, False) for method in block.methods]
+        while stack:
+            expr, context, allowed = stack.pop()
+            if context is block:
+                is_ref = expr is Self
+            else:
+                is_ref = expr is context.block_refs.get(block)
+            if is_ref:
+                if not allowed:
+                    return True
+            elif isinstance(expr, Send):
+                if expr.receiver:
+                    receiver_allowed = expr.receiver_block is block or (
+                        not expr.receiver_block and expr.symbol in block.symbols)
+                    stack.append((expr.receiver, context, receiver_allowed))
+                stack.extend((arg, context, False) for arg in expr.args)
+            elif isinstance(expr, Sequence):
+                stack.extend((statement, context, True) for statement in expr.statements[:-1])
+                stack.append((expr.statements[-1], context, allowed))
+            elif isinstance(expr, LocalVariable):
+                stack.append((expr.expr, context, False))
+            elif isinstance(expr, SlotGet):
+                stack.append((expr.obj_expr, context, True))
+            elif isinstance(expr, SlotSet):
+                stack.append((expr.obj_expr, context, True))
+                stack.append((expr.set_expr, context, False))
+            elif isinstance(expr, Array):
+                stack.extend((elem, context, False) for elem in expr.elems)
+            elif isinstance(expr, Block):
+                stack.extend((var.init_ref, context, expr.on_stack) for var in expr.slots)
+                # Blocks that refer to block keep a reference to it for
+                # their nested blocks, so others can be skipped
+                if block in expr.block_refs:
+                    stack.extend((method.expr, expr, False) for method in expr.methods)
+        return False
+
+def find_stack_blocks(send_list, block_list, reachable, builtin_block):
+    return StackBlocks(reachable, builtin_block).find(send_list, block_list)
@@ -7,6 +7,8 @@ def format_instruction_args(args):
 class Instruction(object):
     args = ()
     is_leaf = True
+    is_label = False
+    is_jump = False
     check_error = False
     dest_from_heap = False
     load_list = ()
@@ -28,6 +30,17 @@ class ALLOC(Instruction):
     def __str__(self):
         return '%{} = ALLOC(size:{}, tag:{})'.format(self.dest, self.size, self.tag)
 
+class STACK_ALLOC(Instruction):
+    # An object in the frame of the procedure, which the garbage collector
+    # never moves, so it is not reloaded after calls
+    def __init__(self, dest, size, tag):
+        self.dest = dest
+        self.size = size
+        self.tag = tag
+
+    def __str__(self):
+        return '%{} = STACK_ALLOC(size:{}, tag:{})'.format(self.dest, self.size, self.tag)
+
 class ARRAY(Instruction):
     is_leaf = False
     dest_from_heap = True
@@ -44,17 +57,27 @@ class CALL(Instruction):
     is_leaf = False
     dest_from_heap = True
 
-    def __init__(self, dest, args, call_label, traceback_info, check_error=True, check_tag=None):
+    def __init__(self, dest, args, call_label, traceback_info, check_error=True, check_tag=None, symbol=None):
         self.dest = dest
         self.args = args
         self.call_label = call_label
         self.traceback_info = traceback_info
         self.check_error = check_error
         self.check_tag = check_tag
+        self.symbol = symbol      # Set for sends that are dispatched on the receiver
+        self.tag_labels = None    # [(tag, label), (tag, label)] when the receiver has one of two tags
+        self.tail_call = False    # The result is returned by the caller as it is
+        self.slow_path_save_list = ()   # Set for calls that have a fast path
+        self.slow_path_clear_list = ()
+        self.slow_path_load_list = ()
 
     def __str__(self):
         dest = '%{} = '.format(self.dest) if self.dest else ''
-        return '{}CALL {}({})'.format(dest, self.call_label, format_instruction_args(self.args))
+        if self.tag_labels:
+            call_label = ' | '.join('{}:{}'.format(tag, label) for tag, label in self.tag_labels)
+        else:
+            call_label = self.call_label
+        return '{}{}CALL {}({})'.format(dest, 'TAIL ' if self.tail_call else '', call_label, format_instruction_args(self.args))
 
 class CONCAT(Instruction):
     is_leaf = False
@@ -78,10 +101,11 @@ class LOAD_VALUE(Instruction):
         return '%{} = TAG({}, {})'.format(self.dest, self.tag, self.value)
 
 class LOAD_LABEL(Instruction):
-    def __init__(self, dest, tag, label):
+    def __init__(self, dest, tag, label, value=None):
         self.dest = dest
         self.tag = tag
         self.label = label
+        self.value = value  # The integer or string at the label, for constant folding
 
     def __str__(self):
         return '%{} = TAG({}, {})'.format(self.dest, self.tag, self.label)
@@ -89,10 +113,11 @@ class LOAD_LABEL(Instruction):
 class GET_SLOT(Instruction):
     dest_from_heap = True
 
-    def __init__(self, dest, object, slot_index):
+    def __init__(self, dest, object, slot_index, mutable=True):
         self.dest = dest
         self.args = [object]
         self.slot_index = slot_index
+        self.mutable = mutable
 
     def __str__(self):
         return '%{} = GETSLOT(%{}, {})'.format(self.dest, self.object, self.slot_index)
@@ -155,3 +180,71 @@ class ALIAS(Instruction):
     @property
     def source(self):
         return self.args[0]
+
+class MOVE(Instruction):
+    # Unlike ALIAS, the destination may be assigned more than once, e.g. in
+    # each branch of an if or in each iteration of a loop
+    dest_from_heap = True
+
+    def __init__(self, dest, source):
+        self.dest = dest
+        self.args = [source]
+
+    def __str__(self):
+        return '%{} := %{}'.format(self.dest, self.source)
+
+    @property
+    def source(self):
+        return self.args[0]
+
+class LABEL(Instruction):
+    is_label = True
+
+    def __init__(self, label):
+        self.label = label
+
+    def __str__(self):
+        return 'L{}:'.format(self.label)
+
+class JUMP(Instruction):
+    is_jump = True
+
+    def __init__(self, label):
+        self.label = label
+
+    def __str__(self):
+        return 'JUMP L{}'.format(self.label)
+
+class TAIL_JUMP(JUMP):
+    """Jump back to the start of the procedure in place of a call of itself."""
+
+    def __init__(self, label, traceback_info):
+        self.label = label
+        self.traceback_info = traceback_info
+
+    def __str__(self):
+        return 'TAIL JUMP L{}'.format(self.label)
+
+class BRANCH(Instruction):
+    """Jump to true_label if the value is True and false_label if it is False, otherwise carry on."""
+    is_jump = True
+
+    def __init__(self, value, true_label, false_label):
+        self.args = [value]
+        self.true_label = true_label
+        self.false_label = false_label
+
+    def __str__(self):
+        return 'BRANCH %{} L{} L{}'.format(self.value, self.true_label, self.false_label)
+
+    @property
+    def value(self):
+        return self.args[0]
+
+class ERROR(Instruction):
+    def __init__(self, error, traceback_info):
+        self.error = error
+        self.traceback_info = traceback_info
+
+    def __str__(self):
+        return 'ERROR {}'.format(self.error)
@@ -0,0 +1,110 @@
+# ome - Object Message Expressions
+# Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
+
+from .ome_ast import Array, Block, LocalVariable, Self, Send, Sequence, SlotGet, SlotSet
+
+# The methods that the built-in control flow methods send to their block
+# argument, as (required, optional) for each message
+control_flow_methods = {
+    'for:': (('while', 'do'), ('return',)),
+    'if:': (('then', 'else'), ()),
+    'then:': (('do',), ()),
+    'else:': (('do',), ()),
+}
+
+def get_literal_block(expr):
+    # Blocks with variables are the last statement of a sequence that
+    # initialises them
+    while isinstance(expr, Sequence):
+        expr = expr.statements[-1]
+    if isinstance(expr, Block):
+        return expr
+
+def get_inline_methods(block, symbol):
+    """
+    Get the methods of block that the built-in method for symbol sends to it,
+    if those are all the methods it defines apart from the generated ones.
+    """
+    required, optional = control_flow_methods[symbol]
+    generated = set(block.instance_vars)
+    generated.update(name + ':' for name, var in block.instance_vars.items() if var.mutable)
+    generated.add('show')
+    methods = {method.symbol: method for method in block.methods if method.symbol not in generated}
+    if all(s in methods for s in required) and all(s in required or s in optional for s in methods):
+        return methods
+
+def refers_to_self(block, methods, inlined):
+    """
+    Check if the methods of block use it for anything but getting and setting
+    its slots. Nested blocks may only refer to it if they are inlined too and
+    never created, in which case their methods are checked as well.
+    """
+    stack = [(method.expr, block, False) for method in methods]
+    while stack:
+        expr, context, allowed = stack.pop()
+        if expr is (Self if context is block else context.block_refs.get(block)):
+            if not allowed:
+                return True
+        elif isinstance(expr, Send):
+            if expr.receiver:
+                stack.append((expr.receiver, context, False))
+            stack.extend((arg, context, False) for arg in expr.args)
+        elif isinstance(expr, Sequence):
+            stack.extend((statement, context, False) for statement in expr.statements)
+        elif isinstance(expr, LocalVariable):
+            stack.append((expr.expr, context, False))
+        elif isinstance(expr, SlotGet):
+            stack.append((expr.obj_expr, context, True))
+        elif isinstance(expr, SlotSet):
+            stack.append((expr.obj_expr, context, True))
+            stack.append((expr.set_expr, context, False))
+        elif isinstance(expr, Array):
+            stack.extend((elem, context, False) for elem in expr.elems)
+        elif isinstance(expr, Block):
+            # Blocks nested any deeper refer to it through this one
+            if block in expr.block_refs:
+                if expr not in inlined:
+                    return True
+                stack.extend((var.init_ref, context, True) for var in expr.slots)
+                stack.extend((method.expr, expr, False) for method in inlined[expr])
+            else:
+                stack.extend((var.init_ref, context, False) for var in expr.slots)
+    return False
+
+def find_inline_blocks(send_list, block_list, builtin, builtin_block):
+    """
+    Find the sends of built-in control flow methods whose block argument is
+    a literal block, and mark them to be compiled to branches and loops with
+    the methods of the block inlined.
+
+    for: is always sent to BuiltIn, but the others are dynamic sends. If the
+    receiver turns out not to be a boolean, the message is still sent to it
+    with the block, unless nothing else understands the message, in which
+    case the result is the same error without creating the block.
+    """
+    understood = set(method.symbol for method in builtin.methods if method.tag_name not in ('True', 'False'))
+    understood.update(method.symbol for method in builtin.messages)
+    understood.update(builtin.defaults)
+    for block in block_list:
+        understood.update(method.symbol for method in block.methods)
+
+    inlined = {}  # block -> inlined methods, for blocks that are never created
+    count = 0
+    for send in reversed(send_list):  # Nested sends come after their parents
+        if send.symbol not in control_flow_methods:
+            continue
+        if send.symbol == 'for:':
+            if send.receiver_block is not builtin_block:
+                continue
+        elif send.receiver_block:
+            continue
+        block = get_literal_block(send.args[0])
+        if block:
+            methods = get_inline_methods(block, send.symbol)
+            if methods and not refers_to_self(block, methods.values(), inlined):
+                send.inline_block = block
+                send.inline_fallback = send.symbol != 'for:' and send.symbol in understood
+                if not send.inline_fallback:
+                    inlined[block] = list(methods.values())
+                count += 1
+    return count
@@ -2,31 +2,72 @@
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
 from .constants import *
-from .emit import MethodCodeBuilder
 from .error import OmeError
 from .instructions import *
 from .sexpr import format_sexpr
+from .source import SourcePosition
 from .symbol import is_private_symbol
+from .traverse import run_pass, pop_results
 
 class ASTNode(object):
+    # Each pass is run by run_pass() (see traverse.py), which calls the
+    # enter_<pass> method of each node instead of recursing
+    __slots__ = ()
+
     def __str__(self):
         return format_sexpr(self.sexpr())
 
+    def sexpr(self):
+        return run_pass('sexpr', self)
+
+    def resolve_free_vars(self, parent):
+        return run_pass('resolve_free_vars', self, parent)
+
+    def resolve_block_refs(self, parent):
+        return run_pass('resolve_block_refs', self, parent)
+
+    def walk(self, visitor):
+        run_pass('walk', self, visitor)
+
+    def generate_code(self, code):
+        return run_pass('generate_code', self, code)
+
 class Send(ASTNode):
+    # The source position is kept as an offset into the shared Source rather
+    # than a SourcePosition object per send
+    __slots__ = ('receiver', 'symbol', 'args', 'source', 'pos', 'receiver_block',
+                 'traceback_info', 'private_receiver_block', 'method', 'check_tag_block',
+                 'inline_block', 'inline_fallback')
+
     def __init__(self, receiver, symbol, args, parse_state=None):
         self.receiver = receiver
         self.symbol = symbol
         self.args = args
-        self.parse_state = parse_state
+        self.source = parse_state.source if parse_state else None
+        self.pos = parse_state.pos if parse_state else 0
         self.receiver_block = None
         self.traceback_info = None
         self.private_receiver_block = None
+        self.inline_block = None  # Set by find_inline_blocks() to the block argument to inline
+        self.inline_fallback = False  # Whether the message is still sent to receivers that are not booleans
 
-    def sexpr(self):
+    @property
+    def parse_state(self):
+        if self.source:
+            return SourcePosition(self.source, self.pos)
+
+    def enter_sexpr(self, arg, stack, results):
+        stack.append((self.leave_sexpr, arg))
+        for expr in reversed(self.args):
+            stack.append((expr.enter_sexpr, arg))
+        if self.receiver:
+            stack.append((self.receiver.enter_sexpr, arg))
+
+    def leave_sexpr(self, arg, stack, results):
+        args = tuple(pop_results(results, len(self.args)))
+        receiver = results.pop() if self.receiver else '<free>'
         call = 'call' if self.receiver_block else 'send'
-        receiver = self.receiver.sexpr() if self.receiver else '<free>'
-        args = tuple(arg.sexpr() for arg in self.args)
-        return (call, self.symbol, receiver) + args
+        results.append((call, self.symbol, receiver) + args)
 
     def error(self, message):
         if self.parse_state:
@@ -34,12 +75,26 @@ class Send(ASTNode):
         else:
             raise OmeError(message)
 
-    def resolve_free_vars(self, parent):
+    def enter_resolve_free_vars(self, parent, stack, results):
         self.method = parent.find_method()
-        for i, arg in enumerate(self.args):
-            self.args[i] = arg.resolve_free_vars(parent)
+        if not self.receiver and not self.args:
+            # Most sends are variable references with no children
+            results.append(self.resolve_symbol(parent))
+            return
+        stack.append((self.leave_resolve_free_vars, parent))
+        if self.receiver:
+            stack.append((self.receiver.enter_resolve_free_vars, parent))
+        for arg in reversed(self.args):
+            stack.append((arg.enter_resolve_free_vars, parent))
+
+    def leave_resolve_free_vars(self, parent, stack, results):
+        if self.receiver:
+            self.receiver = results.pop()
+        self.args[:] = pop_results(results, len(self.args))
+        results.append(self.resolve_symbol(parent))
+
+    def resolve_symbol(self, parent):
         if self.receiver:
-            self.receiver = self.receiver.resolve_free_vars(parent)
             if self.symbol == 'self':
                 return self.receiver
             if is_private_symbol(self.symbol):
@@ -61,11 +116,24 @@ class Send(ASTNode):
                 self.error("receiver could not be resolved for '%s'" % self.symbol)
         return self
 
-    def resolve_block_refs(self, parent):
-        for i, arg in enumerate(self.args):
-            self.args[i] = arg.resolve_block_refs(parent)
+    def enter_resolve_block_refs(self, parent, stack, results):
+        if not self.receiver and not self.args:
+            results.append(self.resolve_block_ref(parent))
+            return
+        stack.append((self.leave_resolve_block_refs, parent))
+        if self.receiver:
+            stack.append((self.receiver.enter_resolve_block_refs, parent))
+        for arg in reversed(self.args):
+            stack.append((arg.enter_resolve_block_refs, parent))
+
+    def leave_resolve_block_refs(self, parent, stack, results):
+        if self.receiver:
+            self.receiver = results.pop()
+        self.args[:] = pop_results(results, len(self.args))
+        results.append(self.resolve_block_ref(parent))
+
+    def resolve_block_ref(self, parent):
         if self.receiver:
-            self.receiver = self.receiver.resolve_block_refs(parent)
             if is_private_symbol(self.symbol):
                 self.check_tag_block = parent.find_block()
         elif self.receiver_block:
@@ -84,43 +152,196 @@ class Send(ASTNode):
                     return SlotSet(self.receiver, var.slot_index, self.args[0])
         return self
 
-    def walk(self, visitor):
+    def enter_walk(self, visitor, stack, results):
         visitor(self)
+        for arg in reversed(self.args):
+            stack.append((arg.enter_walk, visitor))
         if self.receiver:
-            self.receiver.walk(visitor)
-        for arg in self.args:
-            arg.walk(visitor)
-
-    def generate_code(self, code):
-        receiver = self.receiver.generate_code(code)
-        args = [arg.generate_code(code) for arg in self.args]
+            stack.append((self.receiver.enter_walk, visitor))
+
+    def enter_generate_code(self, code, stack, results):
+        if self.inline_block:
+            self.enter_inline_code(code, stack, results)
+            return
+        stack.append((self.leave_generate_code, code))
+        for arg in reversed(self.args):
+            stack.append((arg.enter_generate_code, code))
+        stack.append((self.receiver.enter_generate_code, code))
+
+    def leave_generate_code(self, code, stack, results):
+        args = pop_results(results, len(self.args))
+        receiver = results.pop()
+        if not self.receiver_block:
+            # The methods of True and False that only choose a value
+            if self.symbol == 'and:':
+                self.generate_branches(code, stack, receiver, args, args[0], receiver)
+                return
+            if self.symbol == 'or:':
+                self.generate_branches(code, stack, receiver, args, receiver, args[0])
+                return
+            if self.symbol == 'not':
+                false = code.add_temp()
+                code.add_instruction(LOAD_VALUE(false, code.get_tag('Constant'), code.get_constant('False')))
+                true = code.add_temp()
+                code.add_instruction(LOAD_VALUE(true, code.get_tag('Constant'), code.get_constant('True')))
+                self.generate_branches(code, stack, receiver, args, false, true)
+                return
+        elif isinstance(self.receiver_block, Block):
+            method = self.receiver_block.get_method(self.symbol)
+            if method and can_inline_method(code, method):
+                push_inlined_call(code, stack, method, self.traceback_info, [receiver] + args)
+                return
+        results.append(self.generate_call(code, [receiver] + args))
+
+    def generate_call(self, code, args):
         dest = code.add_temp()
 
         check_tag = None
+        symbol = None
         if self.receiver_block:
             label = code.make_method_label(self.receiver_block.tag_id, self.symbol)
         else:
             label = code.make_message_label(self.symbol)
+            symbol = self.symbol
             if self.private_receiver_block:
                 check_tag = self.private_receiver_block.tag_id
 
-        code.add_instruction(CALL(dest, [receiver] + args, label, self.traceback_info, check_tag=check_tag))
+        code.add_instruction(CALL(dest, args, label, code.get_traceback_info(self.traceback_info), check_tag=check_tag, symbol=symbol))
         return dest
 
+    # Sends of built-in control flow methods with a literal block (see
+    # lowering.py) are compiled to branches and loops, with the methods of
+    # the block inlined. The block's variables are evaluated first, in the
+    # same order as when the block is created.
+
+    def enter_inline_code(self, code, stack, results):
+        arg = self.args[0]
+        statements = []
+        while isinstance(arg, Sequence):
+            statements.extend(arg.statements[:-1])
+            arg = arg.statements[-1]
+        stack.append((self.leave_inline_args, (code, len(statements))))
+        for var in reversed(self.inline_block.slots):
+            stack.append((var.init_ref.enter_generate_code, code))
+        for statement in reversed(statements):
+            stack.append((statement.enter_generate_code, code))
+        if self.symbol != 'for:':
+            stack.append((self.receiver.enter_generate_code, code))
+
+    def leave_inline_args(self, arg, stack, results):
+        code, num_statements = arg
+        block = self.inline_block
+        inline = InlinedBlock(code, block, pop_results(results, len(block.slots)))
+        del results[len(results) - num_statements:]
+        methods = {method.symbol: method for method in block.methods}
+        if self.symbol == 'for:':
+            top_label = code.add_label()
+            code.add_instruction(LABEL(top_label))
+            stack.append((self.leave_loop_condition, (code, inline, methods, top_label)))
+            push_inline_method(code, stack, methods['while'], inline, self.traceback_info)
+            return
+        receiver = results.pop()
+        if self.symbol == 'if:':
+            arms = methods['then'], methods['else']
+        elif self.symbol == 'then:':
+            arms = methods['do'], receiver
+        else:
+            arms = receiver, methods['do']
+        self.generate_branches(code, stack, receiver, [], arms[0], arms[1], inline)
+
+    def leave_loop_condition(self, arg, stack, results):
+        code, inline, methods, top_label = arg
+        body_label = code.add_label()
+        exit_label = code.add_label()
+        code.add_instruction(BRANCH(results.pop(), body_label, exit_label))
+        code.add_instruction(ERROR('Type_Error', code.get_traceback_info(self.traceback_info)))
+        code.add_instruction(LABEL(body_label))
+        stack.append((self.leave_loop_body, (code, inline, methods, top_label, exit_label)))
+        push_inline_method(code, stack, methods['do'], inline, self.traceback_info)
+
+    def leave_loop_body(self, arg, stack, results):
+        code, inline, methods, top_label, exit_label = arg
+        results.pop()
+        code.add_instruction(JUMP(top_label))
+        code.add_instruction(LABEL(exit_label))
+        if 'return' in methods:
+            push_inline_method(code, stack, methods['return'], inline, self.traceback_info)
+        else:
+            dest = code.add_temp()
+            code.add_instruction(LOAD_VALUE(dest, code.get_tag('Constant'), code.get_constant('Empty')))
+            results.append(dest)
+
+    def generate_branches(self, code, stack, receiver, args, true_arm, false_arm, inline=None):
+        """
+        Choose the value of the send by whether the receiver is True or
+        False. Each arm is a local or a method of the inlined block. Other
+        receivers are sent the message as usual, so the inlined block is
+        created for them, unless they cannot understand it.
+        """
+        result = code.add_temp()
+        true_label = code.add_label()
+        false_label = code.add_label()
+        end_label = code.add_label()
+        code.add_instruction(BRANCH(receiver, true_label, false_label))
+        if inline and not self.inline_fallback:
+            code.add_instruction(ERROR('Not_Understood', code.get_traceback_info(self.traceback_info)))
+        else:
+            if inline:
+                args = [inline.generate_object(code)]
+            code.add_instruction(MOVE(result, self.generate_call(code, [receiver] + args)))
+            code.add_instruction(JUMP(end_label))
+        stack.append((self.leave_branches, (code, result, end_label)))
+        stack.append((self.enter_branch, (code, false_label, false_arm, inline, result, None)))
+        stack.append((self.enter_branch, (code, true_label, true_arm, inline, result, end_label)))
+
+    def enter_branch(self, arg, stack, results):
+        code, label, arm, inline, result, end_label = arg
+        code.add_instruction(LABEL(label))
+        if isinstance(arm, Method):
+            stack.append((self.leave_branch, (code, result, end_label)))
+            push_inline_method(code, stack, arm, inline, self.traceback_info)
+        else:
+            self.leave_branch((code, result, end_label), stack, [arm])
+
+    def leave_branch(self, arg, stack, results):
+        code, result, end_label = arg
+        code.add_instruction(MOVE(result, results.pop()))
+        if end_label is not None:
+            code.add_instruction(JUMP(end_label))
+
+    def leave_branches(self, arg, stack, results):
+        code, result, end_label = arg
+        code.add_instruction(LABEL(end_label))
+        results.append(result)
+
 class Concat(Send):
+    __slots__ = ()
+
     def __init__(self, args, parse_state=None):
         super(Concat, self).__init__(None, '', args, parse_state)
 
-    def sexpr(self):
-        return ('concat',) + tuple(arg.sexpr() for arg in self.args)
+    def enter_sexpr(self, arg, stack, results):
+        stack.append((self.leave_sexpr, arg))
+        for expr in reversed(self.args):
+            stack.append((expr.enter_sexpr, arg))
 
-    def generate_code(self, code):
-        args = [arg.generate_code(code) for arg in self.args]
+    def leave_sexpr(self, arg, stack, results):
+        results.append(('concat',) + tuple(pop_results(results, len(self.args))))
+
+    def enter_generate_code(self, code, stack, results):
+        stack.append((self.leave_generate_code, code))
+        for arg in reversed(self.args):
+            stack.append((arg.enter_generate_code, code))
+
+    def leave_generate_code(self, code, stack, results):
+        args = pop_results(results, len(self.args))
         dest = code.add_temp()
-        code.add_instruction(CONCAT(dest, args, self.traceback_info))
-        return dest
+        code.add_instruction(CONCAT(dest, args, code.get_traceback_info(self.traceback_info)))
+        results.append(dest)
 
 class BlockVariable(object):
+    __slots__ = ('name', 'mutable', 'slot_index', 'init_ref', 'self_ref')
+
     def __init__(self, name, mutable, index, init_ref=None):
         self.name = name
         self.mutable = mutable
@@ -128,10 +349,11 @@ class BlockVariable(object):
         self.init_ref = init_ref
         self.self_ref = SlotGet(Self, index, mutable)
 
-    def generate_code(self, code):
-        return self.init_ref.generate_code(code)
-
 class Block(ASTNode):
+    __slots__ = ('slots', 'methods', 'instance_vars', 'closure_vars', 'block_refs', 'blocks_needed',
+                 'symbols', 'free_vars', 'receivers', 'constant', 'parent', 'constant_ref', 'tag_id',
+                 'constant_id', 'on_stack')
+
     def __init__(self, slots, methods):
         self.slots = slots  # list of BlockVariables for instance vars, closure vars and block references
         self.methods = methods
@@ -141,6 +363,13 @@ class Block(ASTNode):
         self.blocks_needed = set()
         self.symbols = set(self.instance_vars)  # Set of all symbols this block defines
         self.symbols.update(method.symbol for method in self.methods)
+        # Lookups that leave this block are resolved once per symbol and
+        # remembered, since the enclosing scopes cannot change while the
+        # block is being resolved
+        self.free_vars = {}  # symbol -> ref, or None if there is no such variable
+        self.receivers = {}  # symbol -> receiver block, or None
+        self.constant = None
+        self.on_stack = False  # Set by find_stack_blocks() if it never outlives its creator
 
         # Generate getter and setter methods
         for var in slots:
@@ -165,53 +394,80 @@ class Block(ASTNode):
                 concat_args.append(String('}'))
                 self.methods.append(Method('show', [], Concat(concat_args)))
 
-    def sexpr(self):
-        methods = tuple(method.sexpr() for method in self.methods)
+    def enter_sexpr(self, arg, stack, results):
+        stack.append((self.leave_sexpr, arg))
+        for method in reversed(self.methods):
+            stack.append((method.enter_sexpr, arg))
+
+    def leave_sexpr(self, arg, stack, results):
+        methods = tuple(pop_results(results, len(self.methods)))
         slots = tuple(slot.name for slot in self.slots)
         if slots:
-            return ('block', ('slots',) + slots) + methods
+            results.append(('block', ('slots',) + slots) + methods)
         else:
-            return ('block',) + methods
+            results.append(('block',) + methods)
 
     @property
     def is_constant(self):
-        return len(self.slots) == 0 and all(block.is_constant for block in self.blocks_needed)
+        # Only used once free variables are resolved, after which it cannot
+        # change. It is remembered because otherwise each block needed gets
+        # checked again for every path to it, which is exponential in depth.
+        if self.constant is None:
+            self.constant = len(self.slots) == 0 and all(block.is_constant for block in self.blocks_needed)
+        return self.constant
 
     def find_block(self):
         return self
 
-    def resolve_free_vars(self, parent):
+    def get_method(self, symbol):
+        for method in self.methods:
+            if method.symbol == symbol:
+                return method
+
+    def enter_resolve_free_vars(self, parent, stack, results):
         for var in self.slots:
             var.init_ref = parent.lookup_var(var.name)
         self.parent = parent
-        for method in self.methods:
-            method.resolve_free_vars(self)
-        return self
+        stack.append((self.leave_methods, parent))
+        for method in reversed(self.methods):
+            stack.append((method.enter_resolve_free_vars, self))
 
-    def resolve_block_refs(self, parent):
+    def enter_resolve_block_refs(self, parent, stack, results):
         if self.is_constant:
             self.constant_ref = ConstantBlock(self)
-        for method in self.methods:
-            method.resolve_block_refs(self)
-        return self
+        stack.append((self.leave_methods, parent))
+        for method in reversed(self.methods):
+            stack.append((method.enter_resolve_block_refs, self))
+
+    def leave_methods(self, parent, stack, results):
+        del results[-len(self.methods):]
+        results.append(self)
 
     def lookup_var(self, symbol):
-        if symbol in self.closure_vars:
-            return self.closure_vars[symbol].self_ref
-        if symbol not in self.symbols:
-            ref = self.parent.lookup_var(symbol)
-            if ref:
-                var = BlockVariable(symbol, False, len(self.slots), ref)
-                self.closure_vars[symbol] = var
-                self.slots.append(var)
-                return var.self_ref
+        if symbol in self.free_vars:
+            return self.free_vars[symbol]
+        if symbol in self.symbols:
+            return None
+        ref = self.parent.lookup_var(symbol)
+        if ref:
+            var = BlockVariable(symbol, False, len(self.slots), ref)
+            self.closure_vars[symbol] = var
+            self.slots.append(var)
+            ref = var.self_ref
+        self.free_vars[symbol] = ref
+        return ref
 
     def lookup_receiver(self, symbol, add_blocks_needed=True):
         if symbol in self.symbols:
             return self
+        if symbol in self.receivers:
+            return self.receivers[symbol]
         block = self.parent.lookup_receiver(symbol, add_blocks_needed)
-        if block and add_blocks_needed:
-            self.blocks_needed.add(block)
+        if add_blocks_needed:
+            # Only remembered once the blocks up to the receiver need it
+            if block:
+                self.blocks_needed.add(block)
+            self.receivers[symbol] = block
         return block
 
     def get_block_ref(self, block):
@@ -225,50 +481,202 @@ class Block(ASTNode):
         self.slots.append(var)
         return var.self_ref
 
-    def walk(self, visitor):
+    def enter_walk(self, visitor, stack, results):
         visitor(self)
-        for method in self.methods:
-            method.walk(visitor)
+        for method in reversed(self.methods):
+            stack.append((method.enter_walk, visitor))
 
-    def generate_code(self, code):
+    def enter_generate_code(self, code, stack, results):
         dest = code.add_temp()
+        # Each slot value is popped again once it is stored, which leaves
+        # dest as the value of the block
+        results.append(dest)
         if self.is_constant:
             code.add_instruction(LOAD_VALUE(dest, code.get_tag('Constant'), self.constant_id))
         else:
-            code.add_instruction(ALLOC(dest, len(self.slots), self.tag_id))
-            for index, slot in enumerate(self.slots):
-                value = slot.generate_code(code)
-                code.add_instruction(SET_SLOT(dest, index, value))
+            alloc = STACK_ALLOC if self.on_stack else ALLOC
+            code.add_instruction(alloc(dest, len(self.slots), self.tag_id))
+            for index in reversed(range(len(self.slots))):
+                stack.append((self.leave_slot_code, (code, dest, index)))
+                stack.append((self.slots[index].init_ref.enter_generate_code, code))
+
+    def leave_slot_code(self, arg, stack, results):
+        code, dest, index = arg
+        code.add_instruction(SET_SLOT(dest, index, results.pop()))
+
+class InlinedBlock(object):
+    """
+    Stands for a block whose methods are inlined where it is passed to a
+    built-in control flow method. Its slots are locals of the enclosing
+    method, and it is only created if the message has to be sent after all.
+    """
+    __slots__ = ('block', 'slot_locals')
+
+    def __init__(self, code, block, slot_values):
+        self.block = block
+        self.slot_locals = []
+        for var, value in zip(block.slots, slot_values):
+            if var.mutable:
+                local = code.add_temp()
+                code.add_instruction(MOVE(local, value))
+                value = local
+            self.slot_locals.append(value)
+
+    def get_slot(self, code, index):
+        local = self.slot_locals[index]
+        if self.block.slots[index].mutable:
+            # Copied since the slot may be set again before the value is used
+            copy = code.add_temp()
+            code.add_instruction(MOVE(copy, local))
+            return copy
+        return local
+
+    def set_slot(self, code, index, value):
+        code.add_instruction(MOVE(self.slot_locals[index], value))
+
+    def generate_object(self, code):
+        block = self.block
+        dest = code.add_temp()
+        if block.is_constant:
+            code.add_instruction(LOAD_VALUE(dest, code.get_tag('Constant'), block.constant_id))
+        else:
+            alloc = STACK_ALLOC if block.on_stack else ALLOC
+            code.add_instruction(alloc(dest, len(block.slots), block.tag_id))
+            for index, local in enumerate(self.slot_locals):
+                code.add_instruction(SET_SLOT(dest, index, local))
         return dest
 
+def push_inline_method(code, stack, method, inline, traceback_info):
+    """
+    Push the steps to generate the code of a method of an inlined block.
+    Errors in the method are returned with the traceback entry of the send
+    of the control flow method as well, as when the block is created.
+    """
+    stack.append((leave_inline_method, code))
+    stack.append((method.expr.enter_generate_code, code))
+    stack.append((enter_inline_method, (code, method, inline, traceback_info)))
+
+# Small methods called by a static send are generated in place of the call,
+# with their arguments and locals mapped to locals of the caller. The size
+# is the number of nodes in the method's code, and methods that create
+# blocks are never inlined.
+max_inline_method_size = 12
+max_inline_depth = 4
+
+def get_method_size(method, limit):
+    """Count the nodes of a method's code, up to just over limit."""
+    size = 0
+    stack = [method.expr]
+    while stack and size <= limit:
+        node = stack.pop()
+        size += 1
+        if isinstance(node, Send):
+            if node.receiver:
+                stack.append(node.receiver)
+            stack.extend(node.args)
+        elif isinstance(node, Sequence):
+            stack.extend(node.statements)
+        elif isinstance(node, LocalVariable):
+            stack.append(node.expr)
+        elif isinstance(node, SlotGet):
+            stack.append(node.obj_expr)
+        elif isinstance(node, SlotSet):
+            stack.append(node.obj_expr)
+            stack.append(node.set_expr)
+        elif isinstance(node, Array):
+            stack.extend(node.elems)
+        elif isinstance(node, Block):
+            return limit + 1
+    return size
+
+def can_inline_method(code, method):
+    if len(code.inline_calls) >= max_inline_depth:
+        return False
+    if any(inlined is method for inlined in code.inline_calls):
+        return False
+    return get_method_size(method, max_inline_method_size) <= max_inline_method_size
+
+def push_inlined_call(code, stack, method, traceback_info, args):
+    """
+    Push the steps to generate the code of a method in place of a call to
+    it. Errors in the method are returned with the traceback entry of the
+    send as well, as if it had been called.
+    """
+    frame = dict(enumerate(args))
+    for ref in method.locals[len(method.args):]:
+        frame[ref.local_index] = code.add_temp()
+    code.inline_frames.append(frame)
+    code.inline_calls.append(method)
+    code.inline_sends.append(traceback_info)
+    stack.append((leave_inlined_call, code))
+    stack.append((method.expr.enter_generate_code, code))
+
+def leave_inlined_call(code, stack, results):
+    code.inline_frames.pop()
+    code.inline_calls.pop()
+    code.inline_sends.pop()
+
+def enter_inline_method(arg, stack, results):
+    code, method, inline, traceback_info = arg
+    frame = {0: inline}
+    for ref in method.locals:
+        frame[ref.local_index] = code.add_temp()
+    code.inline_frames.append(frame)
+    code.inline_sends.append(traceback_info)
+
+def leave_inline_method(code, stack, results):
+    code.inline_frames.pop()
+    code.inline_sends.pop()
+
 class LocalVariable(ASTNode):
+    __slots__ = ('name', 'expr', 'local_ref')
+
     def __init__(self, name, expr):
         self.name = name
         self.expr = expr
 
-    def sexpr(self):
-        return ('local', self.name, self.expr.sexpr())
+    def enter_sexpr(self, arg, stack, results):
+        stack.append((self.leave_sexpr, arg))
+        stack.append((self.expr.enter_sexpr, arg))
 
-    def resolve_free_vars(self, parent):
-        self.expr = self.expr.resolve_free_vars(parent)
+    def leave_sexpr(self, arg, stack, results):
+        results.append(('local', self.name, results.pop()))
+
+    def enter_resolve_free_vars(self, parent, stack, results):
+        stack.append((self.leave_resolve_free_vars, parent))
+        stack.append((self.expr.enter_resolve_free_vars, parent))
+
+    def leave_resolve_free_vars(self, parent, stack, results):
+        self.expr = results.pop()
         self.local_ref = parent.add_local(self.name)
-        return self
+        results.append(self)
 
-    def resolve_block_refs(self, parent):
-        self.expr = self.expr.resolve_block_refs(parent)
-        return self
+    def enter_resolve_block_refs(self, parent, stack, results):
+        stack.append((self.leave_expr, parent))
+        stack.append((self.expr.enter_resolve_block_refs, parent))
 
-    def walk(self, visitor):
+    def leave_expr(self, parent, stack, results):
+        self.expr = results.pop()
+        results.append(self)
+
+    def enter_walk(self, visitor, stack, results):
         visitor(self)
-        self.expr.walk(visitor)
+        stack.append((self.expr.enter_walk, visitor))
 
-    def generate_code(self, code):
-        local = self.local_ref.generate_code(code)
-        expr = self.expr.generate_code(code)
+    def enter_generate_code(self, code, stack, results):
+        stack.append((self.leave_generate_code, code))
+        stack.append((self.expr.enter_generate_code, code))
+        stack.append((self.local_ref.enter_generate_code, code))
+
+    def leave_generate_code(self, code, stack, results):
+        expr = results.pop()
+        local = results.pop()
         code.add_instruction(ALIAS(local, expr))
-        return local
+        results.append(local)
 
 class Method(ASTNode):
+    __slots__ = ('symbol', 'locals', 'args', 'vars', 'expr', 'parent')
+
     def __init__(self, symbol, args, expr):
         self.symbol = symbol
         self.locals = []
@@ -280,8 +688,12 @@ class Method(ASTNode):
             self.vars[arg] = ref
         self.expr = expr
 
-    def sexpr(self):
-        return ('method', (self.symbol,) + tuple(self.args), self.expr.sexpr())
+    def enter_sexpr(self, arg, stack, results):
+        stack.append((self.leave_sexpr, arg))
+        stack.append((self.expr.enter_sexpr, arg))
+
+    def leave_sexpr(self, arg, stack, results):
+        results.append(('method', (self.symbol,) + tuple(self.args), results.pop()))
 
     def add_local(self, name):
         ref = LocalGet(len(self.locals) + 1, name)
@@ -294,14 +706,18 @@ class Method(ASTNode):
     def find_block(self):
         return self.parent.find_block()
 
-    def resolve_free_vars(self, parent):
+    def enter_resolve_free_vars(self, parent, stack, results):
         self.parent = parent
-        self.expr = self.expr.resolve_free_vars(self)
-        return self
+        stack.append((self.leave_expr, parent))
+        stack.append((self.expr.enter_resolve_free_vars, self))
 
-    def resolve_block_refs(self, parent):
-        self.expr = self.expr.resolve_block_refs(self)
-        return self
+    def enter_resolve_block_refs(self, parent, stack, results):
+        stack.append((self.leave_expr, parent))
+        stack.append((self.expr.enter_resolve_block_refs, self))
+
+    def leave_expr(self, parent, stack, results):
+        self.expr = results.pop()
+        results.append(self)
 
     def lookup_var(self, symbol):
         if symbol in self.vars:
@@ -314,21 +730,34 @@ class Method(ASTNode):
     def get_block_ref(self, block):
         return self.parent.get_block_ref(block)
 
-    def walk(self, visitor):
+    def enter_walk(self, visitor, stack, results):
         visitor(self)
-        self.expr.walk(visitor)
+        stack.append((self.expr.enter_walk, visitor))
 
     def generate_code(self, program):
+        # Imported here so that parsing alone does not load the optimiser
+        from .emit import MethodCodeBuilder
         code = MethodCodeBuilder(len(self.args), len(self.locals) - len(self.args), program)
         code.add_instruction(RETURN(self.expr.generate_code(code)))
-        return code.get_code()
+        # The label lets calls of the method from itself become loops
+        label = None
+        if isinstance(self.parent, Block):
+            label = code.make_method_label(self.parent.tag_id, self.symbol)
+        return code.get_code(label)
 
 class Sequence(ASTNode):
+    __slots__ = ('statements', 'parent', 'method', 'vars')
+
     def __init__(self, statements):
         self.statements = statements
 
-    def sexpr(self):
-        return ('begin',) + tuple(statement.sexpr() for statement in self.statements)
+    def enter_sexpr(self, arg, stack, results):
+        stack.append((self.leave_sexpr, arg))
+        for statement in reversed(self.statements):
+            stack.append((statement.enter_sexpr, arg))
+
+    def leave_sexpr(self, arg, stack, results):
+        results.append(('begin',) + tuple(pop_results(results, len(self.statements))))
 
     def add_local(self, name):
         ref = self.method.add_local(name)
@@ -336,23 +765,27 @@ class Sequence(ASTNode):
         return ref
 
     def find_method(self):
-        return self.parent.find_method()
+        return self.method
 
     def find_block(self):
         return self.parent.find_block()
 
-    def resolve_free_vars(self, parent):
+    def enter_resolve_free_vars(self, parent, stack, results):
         self.parent = parent
         self.method = parent.find_method()
         self.vars = {}
-        for i, statement in enumerate(self.statements):
-            self.statements[i] = statement.resolve_free_vars(self)
-        return self
+        stack.append((self.leave_statements, parent))
+        for statement in reversed(self.statements):
+            stack.append((statement.enter_resolve_free_vars, self))
 
-    def resolve_block_refs(self, parent):
-        for i, statement in enumerate(self.statements):
-            self.statements[i] = statement.resolve_block_refs(self)
-        return self
+    def enter_resolve_block_refs(self, parent, stack, results):
+        stack.append((self.leave_statements, parent))
+        for statement in reversed(self.statements):
+            stack.append((statement.enter_resolve_block_refs, self))
+
+    def leave_statements(self, parent, stack, results):
+        self.statements[:] = pop_results(results, len(self.statements))
+        results.append(self)
 
     def lookup_var(self, symbol):
         if symbol in self.vars:
@@ -365,84 +798,113 @@ class Sequence(ASTNode):
     def get_block_ref(self, block):
         return self.parent.get_block_ref(block)
 
-    def walk(self, visitor):
+    def enter_walk(self, visitor, stack, results):
         visitor(self)
-        for statement in self.statements:
-            statement.walk(visitor)
+        for statement in reversed(self.statements):
+            stack.append((statement.enter_walk, visitor))
 
-    def generate_code(self, code):
-        for statement in self.statements[:-1]:
-            statement.generate_code(code)
-        return self.statements[-1].generate_code(code)
+    def enter_generate_code(self, code, stack, results):
+        stack.append((self.leave_generate_code, code))
+        for statement in reversed(self.statements):
+            stack.append((statement.enter_generate_code, code))
+
+    def leave_generate_code(self, code, stack, results):
+        # The value of the sequence is the value of the last statement
+        del results[-len(self.statements):-1]
 
 class Array(ASTNode):
+    __slots__ = ('elems',)
+
     def __init__(self, elems):
         self.elems = elems
 
-    def sexpr(self):
-        return ('array',) + tuple(elem.sexpr() for elem in self.elems)
+    def enter_sexpr(self, arg, stack, results):
+        stack.append((self.leave_sexpr, arg))
+        for elem in reversed(self.elems):
+            stack.append((elem.enter_sexpr, arg))
 
-    def resolve_free_vars(self, parent):
-        for i, elem in enumerate(self.elems):
-            self.elems[i] = elem.resolve_free_vars(parent)
-        return self
+    def leave_sexpr(self, arg, stack, results):
+        results.append(('array',) + tuple(pop_results(results, len(self.elems))))
 
-    def resolve_block_refs(self, parent):
-        for i, elem in enumerate(self.elems):
-            self.elems[i] = elem.resolve_block_refs(parent)
-        return self
+    def enter_resolve_free_vars(self, parent, stack, results):
+        stack.append((self.leave_elems, parent))
+        for elem in reversed(self.elems):
+            stack.append((elem.enter_resolve_free_vars, parent))
 
-    def walk(self, visitor):
+    def enter_resolve_block_refs(self, parent, stack, results):
+        stack.append((self.leave_elems, parent))
+        for elem in reversed(self.elems):
+            stack.append((elem.enter_resolve_block_refs, parent))
+
+    def leave_elems(self, parent, stack, results):
+        self.elems[:] = pop_results(results, len(self.elems))
+        results.append(self)
+
+    def enter_walk(self, visitor, stack, results):
         visitor(self)
-        for elem in self.elems:
-            elem.walk(visitor)
+        for elem in reversed(self.elems):
+            stack.append((elem.enter_walk, visitor))
 
-    def generate_code(self, code):
+    def enter_generate_code(self, code, stack, results):
         dest = code.add_temp()
+        # Each element value is popped again once it is stored, which leaves
+        # dest as the value of the array
+        results.append(dest)
         code.add_instruction(ARRAY(dest, len(self.elems), code.get_tag('Array')))
-        for index, elem in enumerate(self.elems):
-            value = elem.generate_code(code)
-            code.add_instruction(SET_ELEM(dest, index, value))
-        return dest
+        for index in reversed(range(len(self.elems))):
+            stack.append((self.leave_elem_code, (code, dest, index)))
+            stack.append((self.elems[index].enter_generate_code, code))
+
+    def leave_elem_code(self, arg, stack, results):
+        code, dest, index = arg
+        code.add_instruction(SET_ELEM(dest, index, results.pop()))
 
 class TerminalNode(ASTNode):
-    def resolve_free_vars(self, parent):
-        return self
+    __slots__ = ()
 
-    def resolve_block_refs(self, parent):
-        return self
+    def enter_resolve_free_vars(self, parent, stack, results):
+        results.append(self)
 
-    def walk(self, visitor):
+    def enter_resolve_block_refs(self, parent, stack, results):
+        results.append(self)
+
+    def enter_walk(self, visitor, stack, results):
         visitor(self)
 
 class Constant(TerminalNode):
+    __slots__ = ('constant_name',)
+
     def __init__(self, constant_name):
         self.constant_name = constant_name
 
-    def sexpr(self):
-        return self.constant_name
+    def enter_sexpr(self, arg, stack, results):
+        results.append(self.constant_name)
 
-    def generate_code(self, code):
+    def enter_generate_code(self, code, stack, results):
         dest = code.add_temp()
         code.add_instruction(LOAD_VALUE(dest, code.get_tag('Constant'), code.get_constant(self.constant_name)))
-        return dest
+        results.append(dest)
 
 class ConstantBlock(TerminalNode):
+    __slots__ = ('block',)
+
     def __init__(self, block):
         self.block = block
 
-    def sexpr(self):
+    def enter_sexpr(self, arg, stack, results):
         if hasattr(self.block, 'constant_id'):
-            return ('constant', self.block.constant_id)
+            results.append(('constant', self.block.constant_id))
         else:
-            return '<constant>'
+            results.append('<constant>')
 
-    def generate_code(self, code):
+    def enter_generate_code(self, code, stack, results):
         dest = code.add_temp()
         code.add_instruction(LOAD_VALUE(dest, code.get_tag('Constant'), self.block.constant_id))
-        return dest
+        results.append(dest)
 
 class BuiltInBlock(object):
+    __slots__ = ('symbols', 'tag_id', 'constant_id')
+
     is_constant = True
     constant_ref = Constant('BuiltIn')
 
@@ -463,86 +925,134 @@ class BuiltInBlock(object):
         pass
 
 class LocalGet(TerminalNode):
+    __slots__ = ('local_index', 'name')
+
     def __init__(self, index, name):
         self.local_index = index
         self.name = name
 
-    def sexpr(self):
-        return self.name
+    def enter_sexpr(self, arg, stack, results):
+        results.append(self.name)
 
-    def generate_code(self, code):
-        return self.local_index
+    def enter_generate_code(self, code, stack, results):
+        results.append(code.get_local(self.local_index))
 
 class SlotGet(ASTNode):
+    __slots__ = ('obj_expr', 'slot_index', 'mutable')
+
     def __init__(self, obj_expr, slot_index, mutable):
         self.obj_expr = obj_expr
         self.slot_index = slot_index
         self.mutable = mutable
 
-    def sexpr(self):
-        return ('slot-get', self.obj_expr.sexpr(), self.slot_index)
+    def enter_sexpr(self, arg, stack, results):
+        stack.append((self.leave_sexpr, arg))
+        stack.append((self.obj_expr.enter_sexpr, arg))
+
+    def leave_sexpr(self, arg, stack, results):
+        results.append(('slot-get', results.pop(), self.slot_index))
 
     def setter(self, set_expr):
         return SlotSet(self.obj_expr, self.slot_index, set_expr)
 
-    def resolve_free_vars(self, parent):
-        self.obj_expr = self.obj_expr.resolve_free_vars(parent)
-        return self
+    def enter_resolve_free_vars(self, parent, stack, results):
+        stack.append((self.leave_obj_expr, parent))
+        stack.append((self.obj_expr.enter_resolve_free_vars, parent))
 
-    def resolve_block_refs(self, parent):
-        self.obj_expr = self.obj_expr.resolve_block_refs(parent)
-        return self
+    def enter_resolve_block_refs(self, parent, stack, results):
+        stack.append((self.leave_obj_expr, parent))
+        stack.append((self.obj_expr.enter_resolve_block_refs, parent))
 
-    def walk(self, visitor):
+    def leave_obj_expr(self, parent, stack, results):
+        self.obj_expr = results.pop()
+        results.append(self)
+
+    def enter_walk(self, visitor, stack, results):
         visitor(self)
-        self.obj_expr.walk(visitor)
+        stack.append((self.obj_expr.enter_walk, visitor))
 
-    def generate_code(self, code):
-        object = self.obj_expr.generate_code(code)
+    def enter_generate_code(self, code, stack, results):
+        stack.append((self.leave_generate_code, code))
+        stack.append((self.obj_expr.enter_generate_code, code))
+
+    def leave_generate_code(self, code, stack, results):
+        object = results.pop()
+        if isinstance(object, InlinedBlock):
+            results.append(object.get_slot(code, self.slot_index))
+            return
         dest = code.add_temp()
-        code.add_instruction(GET_SLOT(dest, object, self.slot_index))
-        return dest
+        code.add_instruction(GET_SLOT(dest, object, self.slot_index, self.mutable))
+        results.append(dest)
 
 class SlotSet(ASTNode):
+    __slots__ = ('obj_expr', 'slot_index', 'set_expr')
+
     def __init__(self, obj_expr, slot_index, set_expr):
         self.obj_expr = obj_expr
         self.slot_index = slot_index
         self.set_expr = set_expr
 
-    def sexpr(self):
-        return ('slot-set!', self.obj_expr.sexpr(), self.slot_index, self.set_expr.sexpr())
+    def enter_sexpr(self, arg, stack, results):
+        stack.append((self.leave_sexpr, arg))
+        stack.append((self.set_expr.enter_sexpr, arg))
+        stack.append((self.obj_expr.enter_sexpr, arg))
 
-    def resolve_free_vars(self, parent):
-        self.obj_expr = self.obj_expr.resolve_free_vars(parent)
-        self.set_expr = self.set_expr.resolve_free_vars(parent)
-        return self
+    def leave_sexpr(self, arg, stack, results):
+        set_expr = results.pop()
+        obj_expr = results.pop()
+        results.append(('slot-set!', obj_expr, self.slot_index, set_expr))
 
-    def resolve_block_refs(self, parent):
-        self.obj_expr = self.obj_expr.resolve_block_refs(parent)
-        self.set_expr = self.set_expr.resolve_block_refs(parent)
-        return self
+    def enter_resolve_free_vars(self, parent, stack, results):
+        stack.append((self.leave_exprs, parent))
+        stack.append((self.set_expr.enter_resolve_free_vars, parent))
+        stack.append((self.obj_expr.enter_resolve_free_vars, parent))
 
-    def walk(self, visitor):
-        visitor(self)
-        self.obj_expr.walk(visitor)
-        self.set_expr.walk(visitor)
+    def enter_resolve_block_refs(self, parent, stack, results):
+        stack.append((self.leave_exprs, parent))
+        stack.append((self.set_expr.enter_resolve_block_refs, parent))
+        stack.append((self.obj_expr.enter_resolve_block_refs, parent))
 
-    def generate_code(self, code):
-        object = self.obj_expr.generate_code(code)
-        value = self.set_expr.generate_code(code)
-        code.add_instruction(SET_SLOT(object, self.slot_index, value))
-        return value
+    def leave_exprs(self, parent, stack, results):
+        self.set_expr = results.pop()
+        self.obj_expr = results.pop()
+        results.append(self)
+
+    def enter_walk(self, visitor, stack, results):
+        visitor(self)
+        stack.append((self.set_expr.enter_walk, visitor))
+        stack.append((self.obj_expr.enter_walk, visitor))
+
+    def enter_generate_code(self, code, stack, results):
+        stack.append((self.leave_generate_code, code))
+        stack.append((self.set_expr.enter_generate_code, code))
+        stack.append((self.obj_expr.enter_generate_code, code))
+
+    def leave_generate_code(self, code, stack, results):
+        value = results.pop()
+        object = results.pop()
+        if isinstance(object, InlinedBlock):
+            object.set_slot(code, self.slot_index, value)
+        else:
+            code.add_instruction(SET_SLOT(object, self.slot_index, value))
+        results.append(value)
 
 class Number(TerminalNode):
+    __slots__ = ('significand', 'exponent', 'source', 'pos')
+
     def __init__(self, significand, exponent, parse_state):
         self.significand = significand
         self.exponent = exponent
-        self.parse_state = parse_state
+        self.source = parse_state.source
+        self.pos = parse_state.pos
 
-    def sexpr(self):
-        return str(self.significand) + ('e%s' % self.exponent if self.exponent else '')
+    @property
+    def parse_state(self):
+        return SourcePosition(self.source, self.pos)
 
-    def generate_code(self, code):
+    def enter_sexpr(self, arg, stack, results):
+        results.append(str(self.significand) + ('e%s' % self.exponent if self.exponent else ''))
+
+    def enter_generate_code(self, code, stack, results):
         dest = code.add_temp()
         if self.exponent >= 0:
             value = self.significand * 10**self.exponent
@@ -550,23 +1060,25 @@ class Number(TerminalNode):
                 code.add_instruction(LOAD_VALUE(dest, code.get_tag('Small-Integer'), value & MASK_DATA))
             else:
                 label = code.allocate_large_integer(value)
-                code.add_instruction(LOAD_LABEL(dest, code.get_tag('Large-Integer'), label))
+                code.add_instruction(LOAD_LABEL(dest, code.get_tag('Large-Integer'), label, value))
         else:
             self.parse_state.error('decimals not supported yet')
-        return dest
+        results.append(dest)
 
 class String(TerminalNode):
+    __slots__ = ('string',)
+
     def __init__(self, string):
         self.string = string
 
-    def sexpr(self):
-        return repr(self.string)
+    def enter_sexpr(self, arg, stack, results):
+        results.append(repr(self.string))
 
-    def generate_code(self, code):
+    def enter_generate_code(self, code, stack, results):
         dest = code.add_temp()
         label = code.allocate_string(self.string)
-        code.add_instruction(LOAD_LABEL(dest, code.get_tag('String'), label))
-        return dest
+        code.add_instruction(LOAD_LABEL(dest, code.get_tag('String'), label, self.string))
+        results.append(dest)
 
 EmptyBlock = Constant('Empty')
 Self = LocalGet(0, 'self')
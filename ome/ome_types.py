@@ -1,6 +1,8 @@
 # ome - Object Message Expressions
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
+from .timing import null_timer
+
 class BuiltIn(object):
     def __init__(self):
         self.code = []
@@ -19,7 +21,7 @@ class BuiltInMethod(object):
         self.sent_messages = sent_messages
         self.code = code
 
-    def generate_target_code(self, label, target):
+    def generate_target_code(self, label, target, timer=null_timer):
         return target.generate_builtin_method(label, self.arg_names, self.code)
 
     def __repr__(self):
@@ -40,3 +42,7 @@ class CompileOptions(object):
         self.verbose = False
         self.traceback = True
         self.source_traceback = True
+        self.cache_dir = None
+        self.shared_runtime = False
+        self.jobs = 1  # Number of processes the frontend may use
+        self.timer = null_timer
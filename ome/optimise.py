@@ -1,17 +1,33 @@
 # ome - Object Message Expressions
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
+from .constants import MASK_DATA, MIN_SMALL_INTEGER, MAX_SMALL_INTEGER, NUM_DATA_BITS
+from .idalloc import constant_id_to_tag_id
 from .instructions import *
 
+# Messages whose results have known tags: the comparisons always give a
+# boolean (or an error), and arithmetic on small integers gives a small or
+# large integer
+comparison_messages = frozenset(['==', '!=', '<', '<=', '>', '>='])
+integer_messages = frozenset(['+', '-', '*'])
+
 def eliminate_aliases(instructions):
-    """Eliminate all local variable aliases (i.e. ALIAS instructions)."""
+    """
+    Eliminate all local variable aliases (i.e. ALIAS instructions). Aliases
+    of locals assigned by MOVE become copies, since the local may change.
+    """
 
     aliases = {}
     instructions_out = []
+    variables = set(ins.dest for ins in instructions if isinstance(ins, MOVE))
 
     for location, ins in enumerate(instructions):
         if isinstance(ins, ALIAS):
-            aliases[ins.dest] = aliases.get(ins.source, ins.source)
+            source = aliases.get(ins.source, ins.source)
+            if source in variables:
+                instructions_out.append(MOVE(ins.dest, source))
+            else:
+                aliases[ins.dest] = source
         else:
             for i, arg in enumerate(ins.args):
                 if arg in aliases:
@@ -20,6 +36,76 @@ def eliminate_aliases(instructions):
 
     return instructions_out
 
+def get_jump_labels(ins):
+    if isinstance(ins, BRANCH):
+        return (ins.true_label, ins.false_label)
+    return (ins.label,)
+
+def intersect_loads(a, b):
+    return dict((key, load) for key, load in a.items() if b.get(key) == load)
+
+def eliminate_redundant_loads(instructions):
+    """
+    Replace slot loads whose value is already in a local with aliases of
+    that local.
+
+    Immutable slots never change once their block is created, so a load
+    can reuse any earlier load from the same object. Mutable slots can be
+    changed by any call, so their loads, and the values stored to them, are
+    only reused until the next call or store to a slot with the same index.
+
+    A label keeps the loads available on every path to it seen so far. The
+    start of a loop is also reached from the end of the loop, so it only
+    keeps loads of immutable slots from objects that are never reassigned.
+    """
+    variables = set(ins.dest for ins in instructions if isinstance(ins, MOVE))
+    label_locations = {}
+    loop_labels = set()
+    for loc, ins in enumerate(instructions):
+        if ins.is_label:
+            label_locations[ins.label] = loc
+        elif ins.is_jump:
+            loop_labels.update(label for label in get_jump_labels(ins) if label in label_locations)
+
+    available = {}        # (object, slot index) -> (local, mutable)
+    label_available = {}  # label -> loads available on the jumps to it
+    reachable = True      # whether the previous instruction falls through
+    for loc, ins in enumerate(instructions):
+        if ins.is_label:
+            incoming = label_available.pop(ins.label, None)
+            if incoming is not None:
+                available = intersect_loads(available, incoming) if reachable else incoming
+            elif not reachable:
+                available = {}
+            if ins.label in loop_labels:
+                available = dict((key, load) for key, load in available.items()
+                                 if not load[1] and key[0] not in variables)
+        elif isinstance(ins, GET_SLOT):
+            key = (ins.object, ins.slot_index)
+            if key in available:
+                instructions[loc] = ALIAS(ins.dest, available[key][0])
+            else:
+                available[key] = (ins.dest, ins.mutable)
+        elif isinstance(ins, SET_SLOT):
+            available = dict((key, load) for key, load in available.items()
+                             if key[1] != ins.slot_index or not load[1] and key[0] != ins.object)
+            if ins.value not in variables:
+                available[(ins.object, ins.slot_index)] = (ins.value, True)
+        elif isinstance(ins, MOVE):
+            available = dict((key, load) for key, load in available.items()
+                             if key[0] != ins.dest and load[0] != ins.dest)
+        elif isinstance(ins, (CALL, CONCAT)):
+            available = dict((key, load) for key, load in available.items() if not load[1])
+
+        if ins.is_jump:
+            for label in get_jump_labels(ins):
+                if label not in loop_labels:
+                    if label in label_available:
+                        label_available[label] = intersect_loads(label_available[label], available)
+                    else:
+                        label_available[label] = dict(available)
+        reachable = not isinstance(ins, (JUMP, RETURN, ERROR))
+
 def move_constants_to_usage_points(instructions, num_locals):
     """
     Remove LOAD_VALUE/LOAD_LABEL instructions and re-inserts loading to a
@@ -35,6 +121,11 @@ def move_constants_to_usage_points(instructions, num_locals):
         if isinstance(ins, (LOAD_VALUE, LOAD_LABEL)):
             constant_instructions[ins.dest] = ins
         else:
+            if ins.is_label or ins.is_jump:
+                # Constants are loaded before control flow splits or joins,
+                # so that they are loaded on every path to their uses
+                instructions_out.extend(constant_instructions.values())
+                constant_instructions.clear()
             for i, arg in enumerate(ins.args):
                 if arg in constant_instructions:
                     cins = constant_instructions[arg]
@@ -53,6 +144,9 @@ def renumber_locals(instructions, num_args):
         for i, arg in enumerate(ins.args):
             ins.args[i] = locals_map[arg]
         if hasattr(ins, 'dest'):
+            if isinstance(ins, MOVE) and ins.dest in locals_map:
+                ins.dest = locals_map[ins.dest]
+                continue
             assert ins.dest not in locals_map
             new_dest = len(locals_map)
             locals_map[ins.dest] = new_dest
@@ -63,25 +157,394 @@ def renumber_locals(instructions, num_args):
 def find_live_sets(instructions):
     """
     Compute the live set for each instruction.
+
+    A local is live from where it is first assigned until its last use, in
+    the order of the instructions. Jumps only go forwards except at the end
+    of a loop, so this is enough except for locals assigned before a loop and
+    used inside it, which are needed again by the next iteration and so are
+    kept live until the end of the loop.
     """
-    created_at = {}
-    last_used_at = [set() for _ in range(len(instructions))]
+    defined_at = {}
+    last_used_at = {}
+    label_locations = {}
+    loops = []
 
-    seen = set()
-    for loc, ins in reversed(list(enumerate(instructions))):
-        if hasattr(ins, 'dest') and isinstance(ins.dest, int):
-            created_at[loc] = ins.dest
-            if ins.dest not in seen:
-                last_used_at[loc].add(ins.dest)
+    for loc, ins in enumerate(instructions):
         for arg in ins.args:
-            if arg not in seen and isinstance(arg, int):
-                seen.add(arg)
-                last_used_at[loc].add(arg)
+            if isinstance(arg, int):
+                last_used_at[arg] = loc
+        if hasattr(ins, 'dest') and isinstance(ins.dest, int):
+            if ins.dest not in defined_at:
+                defined_at[ins.dest] = loc
+                last_used_at.setdefault(ins.dest, loc)
+        if ins.is_label:
+            label_locations[ins.label] = loc
+        elif isinstance(ins, JUMP) and ins.label in label_locations:
+            loops.append((label_locations[ins.label], loc))
+
+    # Inner loops end first, so locals they extend are seen by outer loops
+    for start, end in loops:
+        for local, last_used in last_used_at.items():
+            if start <= last_used <= end and defined_at.get(local, -1) < start:
+                last_used_at[local] = end + 1
+
+    defined_locals = [[] for _ in range(len(instructions))]
+    dead_locals = [[] for _ in range(len(instructions) + 1)]
+    for local, loc in defined_at.items():
+        defined_locals[loc].append(local)
+    for local, loc in last_used_at.items():
+        dead_locals[loc].append(local)
 
-    live_set = seen - set(created_at.values())
+    live_set = set(local for local in last_used_at if local not in defined_at)
     for loc, ins in enumerate(instructions):
         ins.live_set = frozenset(live_set)
-        if loc in created_at:
-            live_set.add(created_at[loc])
-        live_set.difference_update(last_used_at[loc])
+        live_set.update(defined_locals[loc])
+        live_set.difference_update(dead_locals[loc])
         ins.live_set_after = frozenset(live_set)
+
+def infer_tags(instructions, tag_ids):
+    """
+    Find the tags that each local may have, from the instructions that
+    assign it. Locals that may have any tag (arguments, slots and the
+    results of most calls) are left out.
+
+    Every local but those assigned by MOVE is assigned once, before it is
+    used. Locals assigned by MOVE may have any of the tags of the values
+    moved to them, including along loops, so they start with no tags and
+    the instructions are visited until nothing changes.
+    """
+    small_integer_tags = frozenset([tag_ids['Small-Integer']])
+    integer_tags = frozenset([tag_ids['Small-Integer'], tag_ids['Large-Integer']])
+    boolean_tags = frozenset([tag_ids['True'], tag_ids['False']])
+    string_tags = frozenset([tag_ids['String']])
+    constant_tag = tag_ids['Constant']
+
+    local_tags = dict((ins.dest, frozenset()) for ins in instructions if isinstance(ins, MOVE))
+
+    def get_tags(ins):
+        if isinstance(ins, MOVE):
+            tags = local_tags.get(ins.dest)
+            source_tags = local_tags.get(ins.source)
+            if tags is not None and source_tags is not None:
+                return tags | source_tags
+        elif isinstance(ins, LOAD_VALUE):
+            if ins.tag == constant_tag:
+                return frozenset([constant_id_to_tag_id(ins.value)])
+            return frozenset([ins.tag])
+        elif isinstance(ins, (LOAD_LABEL, ALLOC, STACK_ALLOC, ARRAY)):
+            return frozenset([ins.tag])
+        elif isinstance(ins, CONCAT):
+            return string_tags
+        elif isinstance(ins, ALIAS):
+            return local_tags.get(ins.source)
+        elif isinstance(ins, CALL) and ins.check_error:
+            if ins.symbol in comparison_messages:
+                return boolean_tags
+            if ins.symbol in integer_messages:
+                arg_tags = [local_tags.get(arg) for arg in ins.args]
+                if all(tags is not None and tags <= small_integer_tags for tags in arg_tags):
+                    return integer_tags
+
+    changed = True
+    while changed:
+        changed = False
+        for ins in instructions:
+            dest = getattr(ins, 'dest', None)
+            if dest is None:
+                continue
+            tags = get_tags(ins)
+            if tags is None:
+                if dest in local_tags:
+                    del local_tags[dest]
+                    changed = True
+            elif local_tags.get(dest) != tags:
+                local_tags[dest] = tags
+                changed = True
+
+    return local_tags
+
+def resolve_sends(instructions, tag_ids, lookup_method):
+    """
+    Turn sends to locals with a known tag into direct calls of the method
+    for that tag, without going through the dispatcher. When the receiver
+    may have one of two tags, the call tests the tag and calls the method
+    for each one directly. Sends are left alone if any of the tags has no
+    method for the message, since they need the default method or the
+    error from the dispatcher.
+    """
+    local_tags = infer_tags(instructions, tag_ids)
+    for ins in instructions:
+        if isinstance(ins, CALL) and ins.symbol:
+            tags = local_tags.get(ins.args[0])
+            if not tags or len(tags) > 2:
+                continue
+            if ins.check_tag is not None and tags != frozenset([ins.check_tag]):
+                continue
+            tag_labels = [(tag, lookup_method(tag, ins.symbol)) for tag in sorted(tags)]
+            if all(label for tag, label in tag_labels):
+                ins.check_tag = None
+                if len(tag_labels) == 1:
+                    ins.call_label = tag_labels[0][1]
+                else:
+                    ins.tag_labels = tag_labels
+
+class FoldedConstant(object):
+    """A built-in constant, such as True or Less, that a send was folded to."""
+
+    def __init__(self, name):
+        self.name = name
+
+def is_small_integer(n):
+    return MIN_SMALL_INTEGER <= n <= MAX_SMALL_INTEGER
+
+def truncated_quotient(a, b):
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def compare_constant(a, b):
+    return FoldedConstant('Less' if a < b else 'Greater' if a > b else 'Equal')
+
+def boolean_constant(value):
+    return FoldedConstant('True' if value else 'False')
+
+def fold_send(symbol, args):
+    """
+    Get the result of sending symbol to constant integers and strings, the
+    same as the built-in methods would give, or None if it is not known or
+    would be an error.
+    """
+    if len(args) == 1:
+        value = args[0]
+        if symbol in ('string', 'show') and isinstance(value, int):
+            return str(value)
+        if symbol == 'string' and isinstance(value, str):
+            return value
+        return None
+
+    if len(args) != 2:
+        return None
+    a, b = args
+    if symbol == 'equals:' or symbol == '==':
+        return boolean_constant(type(a) == type(b) and a == b)
+    if symbol == '!=':
+        return boolean_constant(type(a) != type(b) or a != b)
+
+    if isinstance(a, str) and isinstance(b, str):
+        if symbol == '+':
+            return a + b
+        a = a.encode('utf8')
+        b = b.encode('utf8')
+    elif not isinstance(a, int) or not isinstance(b, int):
+        return None
+    elif symbol == '+':
+        return a + b
+    elif symbol == '-':
+        return a - b
+    elif symbol == '*':
+        return a * b
+    elif symbol in ('quotient:', 'remainder:', 'modulo:') and b != 0:
+        small = is_small_integer(a) and is_small_integer(b)
+        if symbol == 'quotient:':
+            q = truncated_quotient(a, b)
+            # The quotient of two small integers wraps around at run time
+            if not small or is_small_integer(q):
+                return q
+        elif symbol == 'remainder:':
+            return a - b * truncated_quotient(a, b)
+        elif small:
+            return a % abs(b)
+        return None
+
+    if symbol == 'compare:':
+        return compare_constant(a, b)
+    if symbol == '<':
+        return boolean_constant(a < b)
+    if symbol == '<=':
+        return boolean_constant(a <= b)
+    if symbol == '>':
+        return boolean_constant(a > b)
+    if symbol == '>=':
+        return boolean_constant(a >= b)
+
+def fold_constants(code):
+    """
+    Evaluate sends of built-in messages to integer and string constants,
+    and string interpolation of constants, at compile time. The results are
+    loaded as constants instead, with new strings and large integers added
+    to the data table. Sends that would give an error are left alone so
+    that they fail at run time as before.
+    """
+    small_integer_tag = code.get_tag('Small-Integer')
+    large_integer_tag = code.get_tag('Large-Integer')
+    string_tag = code.get_tag('String')
+    constant_tag = code.get_tag('Constant')
+
+    values = {}         # local -> integer or string
+    constant_tags = {}  # local -> tag of a constant
+
+    def to_string(local):
+        value = values.get(local)
+        if isinstance(value, (int, str)):
+            return str(value)
+        if local in constant_tags:
+            return code.program.get_constant_string(constant_tags[local], 'string')
+
+    instructions = code.instructions
+    for index, ins in enumerate(instructions):
+        result = None
+        if isinstance(ins, LOAD_VALUE):
+            if ins.tag == small_integer_tag:
+                value = ins.value
+                values[ins.dest] = value - (1 << NUM_DATA_BITS) if value > MAX_SMALL_INTEGER else value
+            elif ins.tag == constant_tag:
+                constant_tags[ins.dest] = constant_id_to_tag_id(ins.value)
+        elif isinstance(ins, LOAD_LABEL):
+            if ins.value is not None:
+                values[ins.dest] = ins.value
+        elif isinstance(ins, ALIAS):
+            if ins.source in values:
+                values[ins.dest] = values[ins.source]
+            elif ins.source in constant_tags:
+                constant_tags[ins.dest] = constant_tags[ins.source]
+        elif isinstance(ins, CALL):
+            if ins.symbol and ins.check_tag is None and ins.args[0] in constant_tags and len(ins.args) == 1:
+                result = code.program.get_constant_string(constant_tags[ins.args[0]], ins.symbol)
+            elif ins.symbol and ins.check_tag is None and all(arg in values for arg in ins.args):
+                result = fold_send(ins.symbol, [values[arg] for arg in ins.args])
+        elif isinstance(ins, CONCAT):
+            parts = [to_string(arg) for arg in ins.args]
+            if all(part is not None for part in parts):
+                result = ''.join(parts)
+
+        if result is None:
+            continue
+        dest = ins.dest
+        if isinstance(result, FoldedConstant):
+            instructions[index] = LOAD_VALUE(dest, constant_tag, code.get_constant(result.name))
+            constant_tags[dest] = code.get_tag(result.name)
+        elif isinstance(result, str):
+            instructions[index] = LOAD_LABEL(dest, string_tag, code.allocate_string(result), result)
+            values[dest] = result
+        elif is_small_integer(result):
+            instructions[index] = LOAD_VALUE(dest, small_integer_tag, result & MASK_DATA)
+            values[dest] = result
+        else:
+            instructions[index] = LOAD_LABEL(dest, large_integer_tag, code.allocate_large_integer(result), result)
+            values[dest] = result
+
+def is_tail_call(instructions, index, label_locations):
+    """
+    Check if the result of the call at index is returned as it is, on the
+    only path from the call through copies of it and forward jumps.
+    """
+    results = set([instructions[index].dest])
+    loc = index + 1
+    while loc < len(instructions):
+        ins = instructions[loc]
+        if isinstance(ins, RETURN):
+            return ins.source in results
+        elif isinstance(ins, (ALIAS, MOVE)):
+            if ins.source not in results:
+                return False
+            results.add(ins.dest)
+        elif isinstance(ins, JUMP):
+            if label_locations[ins.label] < loc:
+                return False
+            loc = label_locations[ins.label]
+        elif not ins.is_label:
+            return False
+        loc += 1
+    return False
+
+def eliminate_tail_calls(code, label):
+    """
+    Turn calls whose result is returned as it is into jumps.
+
+    Calls of the method itself (with the given label) jump back to the
+    start of it, with the arguments moved to locals that replace its own
+    arguments. Errors still need the traceback entry of each call that
+    became a jump, so only calls with the same entry as the first one do,
+    and the target counts the jumps to append the entry that many times.
+
+    Other calls are marked as tail calls, which the target makes with a
+    jump where it can, freeing the frame first. So they must not need a
+    traceback entry, must take as many arguments as the method, and the
+    method must not have any objects in its frame.
+
+    The copies and jumps from a tail call to the RETURN are removed.
+    """
+    instructions = code.instructions
+    label_locations = dict((ins.label, loc) for loc, ins in enumerate(instructions) if ins.is_label)
+    tail_calls = [ins for loc, ins in enumerate(instructions)
+                  if isinstance(ins, CALL) and is_tail_call(instructions, loc, label_locations)]
+    if not tail_calls:
+        return
+
+    self_calls = [ins for ins in tail_calls
+                  if ins.call_label == label and not ins.tag_labels and ins.check_tag is None]
+    if self_calls:
+        traceback_info = self_calls[0].traceback_info
+        self_calls = [ins for ins in self_calls if ins.traceback_info == traceback_info]
+
+    replacements = {}  # tail call -> instructions to replace it with
+    entry = []
+    if self_calls:
+        # A constant receiver of the method can only be the same constant
+        constant_tag = code.get_tag('Constant')
+        constants = set(ins.dest for ins in instructions if isinstance(ins, LOAD_VALUE) and ins.tag == constant_tag)
+        for ins in self_calls:
+            if ins.args[0] in constants:
+                ins.args[0] = 0
+
+        # Arguments that a call passes something else for become variables
+        variables = {}
+        for ins in self_calls:
+            for index, arg in enumerate(ins.args):
+                if arg != index and index not in variables:
+                    variables[index] = code.add_temp()
+        for ins in instructions:
+            for i, arg in enumerate(ins.args):
+                if arg in variables:
+                    ins.args[i] = variables[arg]
+        top_label = code.add_label()
+        entry = [MOVE(local, index) for index, local in sorted(variables.items())]
+        entry.append(LABEL(top_label))
+
+        # The arguments are assigned all at once, so those that are
+        # variables themselves are copied first
+        loop_locals = set(variables.values())
+        for ins in self_calls:
+            copies = []
+            moves = []
+            for index, local in sorted(variables.items()):
+                source = ins.args[index]
+                if source == local:
+                    continue
+                if source in loop_locals:
+                    temp = code.add_temp()
+                    copies.append(MOVE(temp, source))
+                    source = temp
+                moves.append(MOVE(local, source))
+            replacements[ins] = copies + moves + [TAIL_JUMP(top_label, traceback_info)]
+
+    has_stack_objects = any(isinstance(ins, STACK_ALLOC) for ins in instructions)
+    for ins in tail_calls:
+        if ins not in replacements and not ins.traceback_info and len(ins.args) == code.num_args and not has_stack_objects:
+            ins.tail_call = True
+            ins.is_leaf = True  # Nothing in the frame is needed after it
+            replacements[ins] = [ins]
+
+    if replacements:
+        instructions_out = entry
+        dead = False
+        for ins in instructions:
+            if ins.is_label:
+                dead = False
+            elif dead:
+                continue
+            if ins in replacements:
+                instructions_out.extend(replacements[ins])
+                dead = True
+            else:
+                instructions_out.append(ins)
+        code.instructions = instructions_out
@@ -2,9 +2,11 @@
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
 import re
+import sys
 from . import ome_ast as ast
-from .error import OmeParseError
+from .source import Source, SourcePosition
 from .symbol import is_private_symbol, operator_aliases
+from .util import gc_disabled
 
 re_newline = re.compile(r'\r\n|\r|\n')
 re_spaces = re.compile(r'[ \r\n\t]*')
@@ -64,93 +66,193 @@ def parse_string_escapes(string, parse_state):
     parts.append(string[i:])
     return ''.join(parts)
 
-class ParserState(object):
-    def __init__(self, state):
-        self.set_state(state)
-
-    def set_state(self, state):
-        self.stream = state.stream
-        self.stream_name = state.stream_name
-        self.pos = state.pos
-        self.line_pos = state.line_pos
-        self.line_number = state.line_number
-        self.line_indent = state.line_indent
-        self.indent_level = state.indent_level
-        self.indent_line = state.indent_line
-        self.indent_stack = state.indent_stack[:]
-        self.comments = state.comments
-
-    def copy_state(self):
-        return ParserState(self)
-
-    @property
-    def current_line(self):
-        m = re_newline.search(self.stream, self.pos)
-        return self.stream[self.line_pos : m.start() if m else len(self.stream)]
-
-    @property
-    def column(self):
-        return self.pos - self.line_pos
 
-    def error(self, message):
-        raise OmeParseError(message, self)
-
-class Parser(ParserState):
-    def __init__(self, stream, stream_name, tab_width=8):
+re_skip = re.compile(r'(?:[ \r\n\t]+|(?:#|--)[^\r\n]*)*')
+re_token = re.compile('|'.join([
+    '(?P<keyword>{})'.format(re_keyword.pattern),
+    '(?P<name>{})'.format(re_name.pattern),
+    '(?P<number>(?=[0-9]){})'.format(re_number.pattern),
+    "(?P<string>')",
+    '(?P<operator>{})'.format(re_operator.pattern),
+    '(?P<assign>{})'.format(re_assign.pattern),
+    '(?P<logical>&&)',
+    r'(?P<punctuation>[(){}\[\]|;,])',
+]))
+
+comparison_operators = frozenset(['==', '!=', '<=', '>=', '<', '>', '≠', '≤', '≥'])
+addition_operators = frozenset(['+', '-'])
+multiplication_operators = frozenset(['*', '/', '×', '÷'])
+end_tokens = frozenset(['|', ')', '}', ']', 'eof'])
+
+class Token(object):
+    __slots__ = ('kind', 'text', 'pos', 'end', 'line_number', 'column', 'match')
+
+    def __init__(self, kind, text, pos, end, line_number, column, match=None):
+        self.kind = kind
+        self.text = text
+        self.pos = pos
+        self.end = end
+        self.line_number = line_number
+        self.column = column
+        self.match = match
+
+    def __repr__(self):
+        return 'Token({!r}, {!r}, {})'.format(self.kind, self.text, self.pos)
+
+class Tokenizer(object):
+    """
+    Split a source file into tokens in a single pass. Punctuation tokens
+    have their own text as their kind. Anything that is not a token becomes
+    an 'invalid' token, which is reported when the parser gets to it, and
+    the list always ends with an 'eof' token.
+
+    An interpolated string is split into a 'string' token up to the first
+    $, the tokens of the interpolated name or parenthesised expression, and
+    a 'string_next' token for the rest of the string. || is left as two |
+    tokens since | also delimits method signatures.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.tokens = []
+        self.line_number = 1
+        self.line_start = 0
+        self.paren_depths = []  # Nesting of ( in each enclosing interpolation
+
+    def add(self, kind, pos, end, match=None):
+        text = self.stream[pos:end]
+        if kind == 'name':
+            text = sys.intern(text)  # names are repeated throughout the AST
+        token = Token(kind, text, pos, end, self.line_number, pos - self.line_start, match)
+        self.tokens.append(token)
+        return token
+
+    def count_lines(self, pos, text):
+        if '\n' in text or '\r' in text:
+            for m in re_newline.finditer(self.stream, pos, pos + len(text)):
+                self.line_number += 1
+            self.line_start = m.end()
+
+    def skip(self, pos):
+        m = re_skip.match(self.stream, pos)
+        self.count_lines(pos, m.group())
+        return m.end()
+
+    def string(self, kind, pattern, pos):
+        """Add a string and any names interpolated into it. Returns the end position."""
+        while True:
+            m = pattern.match(self.stream, pos)
+            self.add(kind, pos, m.end(), m)
+            self.count_lines(pos, m.group())
+            pos = m.end()
+            if not m.group().endswith('$'):
+                return pos
+            if self.stream.startswith('(', pos):
+                self.add('(', pos, pos + 1)
+                self.paren_depths.append(0)
+                return pos + 1
+            pos = self.skip(pos)
+            m = re_name.match(self.stream, pos)
+            if not m:
+                return pos
+            self.add('name', pos, m.end())
+            kind, pattern, pos = 'string_next', re_string_next, m.end()
+
+    def tokenize(self):
+        stream = self.stream
+        paren_depths = self.paren_depths
+        pos = 0
+        while True:
+            pos = self.skip(pos)
+            if pos >= len(stream):
+                break
+            m = re_token.match(stream, pos)
+            if not m:
+                self.add('invalid', pos, pos + 1)
+                pos += 1
+                continue
+            kind = m.lastgroup
+            if kind == 'string':
+                pos = self.string('string', re_string, pos)
+                continue
+            if kind == 'punctuation':
+                kind = m.group()
+                if paren_depths:
+                    if kind == '(':
+                        paren_depths[-1] += 1
+                    elif kind == ')':
+                        if paren_depths[-1] == 0:
+                            paren_depths.pop()
+                            self.add(kind, pos, m.end())
+                            pos = self.string('string_next', re_string_next, m.end())
+                            continue
+                        paren_depths[-1] -= 1
+            self.add(kind, pos, m.end())
+            pos = m.end()
+        self.add('eof', pos, pos)
+        return self.tokens
+
+def tokenize(stream):
+    return Tokenizer(stream).tokenize()
+
+def check_method_definition(symbol, defined_methods, defined_symbols, parse_state):
+    if symbol in defined_methods:
+        parse_state.error("method '%s' is already defined" % symbol)
+    if symbol in defined_symbols:
+        parse_state.error("method '%s' conflicts with variable definition" % symbol)
+
+def make_block(slots, methods, statements):
+    if not slots and not methods:
+        return ast.EmptyBlock
+    block = ast.Block(slots, methods)
+    if statements:
+        statements.append(block)
+        return ast.Sequence(statements)
+    return block
+
+class Parser(object):
+    def __init__(self, stream, stream_name, first_line=1):
         self.stream = stream
         self.stream_name = stream_name
-        self.pos = 0            # Current position
-        self.line_pos = 0       # Position of the 1st character of the current line
-        self.line_number = 1    # Current line number (starting from 1)
-        self.line_indent = 0    # Indentation level of current line
+        self.source = Source(stream, stream_name, first_line)
+        with gc_disabled():
+            self.tokens = tokenize(stream)
+        self.index = 0          # Index of the next token
+        self.pos = 0            # Current position, used for error messages
         self.indent_level = -1  # Minimum indentation level of current sub-expression
         self.indent_line = -1   # Line number where indentation level begines
         self.indent_stack = []  # Stack of indent levels for outer expressions
-        self.comments = []      # List of comments collected by previous scan()
-        self.tab_width = tab_width
 
-    def match(self, pattern):
+    def position(self):
+        return SourcePosition(self.source, self.pos)
+
+    def error(self, message):
+        self.position().error(message)
+
+    def match(self, kind, values=None):
         """
-        Try to match a regex or string at current position. If the pattern
-        matches, the stream position is advanced the match object is returned.
+        If the next token is of the given kind, and its text is in values if
+        given, then it is consumed and returned.
         """
-        if hasattr(pattern, 'match'):
-            m = pattern.match(self.stream, self.pos)
-            if m:
-                self.pos = m.end()
-                return m
-        elif self.stream[self.pos : self.pos + len(pattern)] == pattern:
-            self.pos += len(pattern)
-            return pattern
-
-    def peek(self, pattern):
-        if hasattr(pattern, 'match'):
-            return pattern.match(self.stream, self.pos)
-        elif self.stream[self.pos : self.pos + len(pattern)] == pattern:
-            return pattern
+        token = self.tokens[self.index]
+        if token.kind == kind and (values is None or token.text in values):
+            self.index += 1
+            self.pos = token.end
+            return token
+
+    def peek(self, kind):
+        return self.tokens[self.index].kind == kind
 
     def scan(self):
         """
-        Scan for the next token by skipping passed any spaces or comments.
+        Move the current position to the start of the next token.
         """
-        self.comments = []
-        while True:
-            spaces = re_newline.sub('\n', self.match(re_spaces).group())
-            new_lines = spaces.count('\n')
-            self.line_number += new_lines
-            if new_lines > 0:
-                indent = spaces.rsplit('\n', 1)[1]
-                self.line_pos = self.pos - len(indent)
-                self.line_indent = len(indent.expandtabs(self.tab_width))
-            m_comment = self.match(re_comment)
-            if m_comment:
-                self.comments.append(m_comment.group(1).strip())
-            else:
-                break
+        self.pos = self.tokens[self.index].pos
 
     def set_indent(self):
-        self.indent_level = self.pos - self.line_pos
-        self.indent_line = self.line_number
+        token = self.tokens[self.index]
+        self.indent_level = token.column
+        self.indent_line = token.line_number
 
     def push_indent(self):
         self.indent_stack.append((self.indent_level, self.indent_line))
@@ -159,37 +261,69 @@ class Parser(ParserState):
         self.indent_level, self.indent_line = self.indent_stack.pop()
 
     def has_more_tokens(self):
-        return (self.pos < len(self.stream)
-            and ((self.pos - self.line_pos) > self.indent_level or self.line_number == self.indent_line))
+        token = self.tokens[self.index]
+        return token.kind != 'eof' and (token.column > self.indent_level or token.line_number == self.indent_line)
 
-    def expr_token(self, pattern):
+    def expr_token(self, kind, values=None):
         self.scan()
         if self.has_more_tokens():
-            return self.match(pattern)
+            return self.match(kind, values)
 
-    def token(self, pattern):
+    def token(self, kind, values=None):
         self.scan()
-        return self.match(pattern)
+        return self.match(kind, values)
 
-    def expect_token(self, pattern, message):
-        m = self.token(pattern)
-        if not m:
+    def expect_token(self, kind, message):
+        token = self.token(kind)
+        if not token:
             self.error(message)
-        return m
+        return token
 
-    def repeat_token(self, pattern):
+    def repeat_token(self, kind):
         while True:
-            m = self.token(pattern)
-            if not m:
+            token = self.token(kind)
+            if not token:
                 break
-            yield m
+            yield token
 
-    def repeat_expr_token(self, pattern):
+    def repeat_expr_token(self, kind, values=None):
         while True:
-            m = self.expr_token(pattern)
-            if not m:
+            token = self.expr_token(kind, values)
+            if not token:
                 break
-            yield m
+            yield token
+
+    def logical_operator(self):
+        self.scan()
+        if self.has_more_tokens():
+            token = self.match('logical')
+            if token:
+                return token.text
+            token = self.tokens[self.index]
+            next_token = self.tokens[self.index + 1]
+            if token.kind == '|' and next_token.kind == '|' and next_token.pos == token.end:
+                self.index += 2
+                self.pos = next_token.end
+                return '||'
+
+    def number(self):
+        """
+        Match a number, including a sign immediately before it. Returns the
+        re_number match.
+        """
+        self.scan()
+        if self.has_more_tokens():
+            start = token = self.tokens[self.index]
+            num_tokens = 1
+            if token.kind == 'operator' and token.text in addition_operators:
+                token = self.tokens[self.index + 1]
+                num_tokens = 2
+                if token.pos != start.end:
+                    return
+            if token.kind == 'number':
+                self.index += num_tokens
+                self.pos = token.end
+                return re_number.match(self.stream, start.pos)
 
     def check_name(self, name, parse_state):
         if name == 'self':
@@ -197,7 +331,11 @@ class Parser(ParserState):
         return name
 
     def argument_name(self, message='expected argument name'):
-        return self.expect_token(re_arg_name, message).group()
+        self.scan()
+        token = self.tokens[self.index]
+        if token.kind != 'name' or token.text.startswith('~'):
+            self.error(message)
+        return self.match('name').text
 
     def check_num_params(self, n, parse_state):
         if n >= 16:
@@ -206,34 +344,34 @@ class Parser(ParserState):
     def signature(self):
         argnames = []
         symbol = ''
-        for m in self.repeat_token(re_keyword):
-            part = m.group()
+        for token in self.repeat_token('keyword'):
+            part = token.text
             if is_private_symbol(part) and symbol:
                 self.error('expected keyword')
             symbol += part
-            parse_state = self.copy_state()
+            parse_state = self.position()
             name = self.argument_name()
             if name in argnames:
                 parse_state.error("duplicate parameter name '%s'" % name)
             argnames.append(name)
-            for m in self.repeat_token(','):
+            for token in self.repeat_token(','):
                 symbol += ','
-                parse_state = self.copy_state()
+                parse_state = self.position()
                 name = self.argument_name()
                 if name in argnames:
                     parse_state.error("duplicate parameter name '%s'" % name)
                 argnames.append(name)
         if not symbol:
-            parse_state = self.copy_state()
-            m = self.match(re_operator)
-            if m:
+            parse_state = self.position()
+            token = self.match('operator')
+            if token:
                 argnames.append(self.argument_name())
-                symbol = operator_aliases.get(m.group(), m.group())
-                if re_comparison_operator.match(symbol):
+                symbol = operator_aliases.get(token.text, token.text)
+                if symbol in comparison_operators:
                     parse_state.error("define compare: or equals: to overload comparison operator")
             else:
-                m = self.expect_token(re_name, 'expected name or keyword')
-                symbol = self.check_name(m.group(), parse_state)
+                token = self.expect_token('name', 'expected name or keyword')
+                symbol = self.check_name(token.text, parse_state)
         self.check_num_params(len(argnames), self)
         return symbol, argnames
 
@@ -242,79 +380,102 @@ class Parser(ParserState):
         prev_indent_line = -1
         while True:
             self.scan()
-            if self.peek(re_end_token) or self.pos >= len(self.stream):
+            token = self.tokens[self.index]
+            if token.kind in end_tokens:
                 break
             self.set_indent()
-            if self.line_number == prev_indent_line:
+            if token.line_number == prev_indent_line:
                 self.error('expected end of statement')
             prev_indent_line = self.indent_line
             yield
             if self.token(';'):
                 prev_indent_line = -1
 
-    def block(self):
-        methods = []
+    def variable_definitions(self):
+        """
+        Parse the variable definitions at the start of a block. Returns the
+        slots, the statements that initialise them and the symbols they define.
+        """
         slots = []
         statements = []
         defined_symbols = set()
-        defined_methods = set()
-        self.push_indent()
         for _ in self.statement_lines():
             self.scan()
-            parse_state = self.copy_state()
-            m = self.token(re_name)
-            if not m:
+            parse_state = self.position()
+            token = self.token('name')
+            if not token:
                 break
-            name = self.check_name(m.group(), parse_state)
+            name = self.check_name(token.text, parse_state)
             if name in defined_symbols:
                 parse_state.error("variable '%s' is already defined" % name)
-            mutable = self.expect_token(re_assign, "expected '=' or ':='").group() == ':='
+            mutable = self.expect_token('assign', "expected '=' or ':='").text == ':='
             statements.append(ast.LocalVariable(name, self.expr()))
             slots.append(ast.BlockVariable(name, mutable, len(slots)))
             defined_symbols.add(name)
             if mutable:
                 defined_symbols.add(name + ':')
+        return slots, statements, defined_symbols
+
+    def method_definitions(self, defined_symbols):
+        """
+        Parse the method definitions of a block. Yields each method and the
+        position after its signature, where errors about it are reported.
+        """
+        defined_methods = set()
         for _ in self.repeat_token('|'):
             symbol, args = self.signature()
-            if symbol in defined_methods:
-                self.error("method '%s' is already defined" % symbol)
-            if symbol in defined_symbols:
-                self.error("method '%s' conflicts with variable definition" % symbol)
+            pos = self.pos
+            check_method_definition(symbol, defined_methods, defined_symbols, self.position())
             self.expect_token('|', "expected '|'")
-            methods.append(ast.Method(symbol, args, self.statements()))
+            yield ast.Method(symbol, args, self.statements()), pos
             defined_methods.add(symbol)
+
+    def block(self):
+        self.push_indent()
+        slots, statements, defined_symbols = self.variable_definitions()
+        methods = [method for method, pos in self.method_definitions(defined_symbols)]
         self.pop_indent()
         self.scan()
-        if self.pos < len(self.stream) and not self.peek('}'):
+        if not self.peek('eof') and not self.peek('}'):
             self.error('expected declaration or end of block')
-        if not slots and not methods:
-            return ast.EmptyBlock
-        block = ast.Block(slots, methods)
-        if statements:
-            statements.append(block)
-            return ast.Sequence(statements)
-        return block
+        return make_block(slots, methods, statements)
 
     def toplevel(self):
-        block = self.block()
-        if self.pos < len(self.stream):
+        with gc_disabled():
+            block = self.block()
+        if not self.peek('eof'):
             self.error('expected declaration or end of file')
         return block
 
+    def toplevel_part(self, first):
+        """
+        Parse part of the top-level block for parse_toplevel(). Only the first
+        part may define variables. Returns a ToplevelPart.
+        """
+        with gc_disabled():
+            self.push_indent()
+            if first:
+                slots, statements, defined_symbols = self.variable_definitions()
+            else:
+                slots, statements, defined_symbols = [], [], set()
+            methods = list(self.method_definitions(defined_symbols))
+            self.pop_indent()
+        self.scan()
+        if not self.peek('eof'):
+            self.error('expected declaration or end of file')
+        return ToplevelPart(self.source, slots, statements, methods)
+
     def statement(self):
-        parse_state = self.copy_state()
-        m = self.token(re_name)
-        if m:
-            name = m.group()
-            m = self.token(re_assign)
-            if m:
-                if m.group() == ':=':
-                    self.error('mutable variables are only allowed in blocks')
-                if is_private_symbol(name):
-                    parse_state.error('local variables cannot be private')
-                self.check_name(name, parse_state)
-                return ast.LocalVariable(name, self.expr())
-        self.set_state(parse_state)
+        self.scan()
+        parse_state = self.position()
+        if self.peek('name') and self.tokens[self.index + 1].kind == 'assign':
+            name = self.match('name').text
+            if self.match('assign').text == ':=':
+                self.error('mutable variables are only allowed in blocks')
+            if is_private_symbol(name):
+                parse_state.error('local variables cannot be private')
+            self.check_name(name, parse_state)
+            return ast.LocalVariable(name, self.expr())
         return self.expr()
 
     def statements(self):
@@ -338,26 +499,26 @@ class Parser(ParserState):
     def keywordexpr(self):
         expr = None
         self.scan()
-        if not self.peek(re_keyword):
+        if not self.peek('keyword'):
             expr = self.cmpexpr()
         symbol = ''
         args = []
         self.scan()
-        parse_state = self.copy_state()
+        parse_state = self.position()
         kw_parse_state = parse_state
-        for m in self.repeat_expr_token(re_keyword):
-            part = m.group()
+        for token in self.repeat_expr_token('keyword'):
+            part = token.text
             if is_private_symbol(part) and symbol:
                 kw_parse_state.error('expected keyword')
             symbol += part
             args.append(self.cmpexpr())
-            for m in self.repeat_expr_token(','):
+            for token in self.repeat_expr_token(','):
                 symbol += ','
                 args.append(self.cmpexpr())
-            kw_parse_state = self.copy_state()
+            kw_parse_state = self.position()
         if args:
             self.check_num_params(len(args), parse_state)
-            expr = ast.Send(expr, symbol, args, parse_state)
+            expr = ast.Send(expr, sys.intern(symbol), args, parse_state)
         return expr
 
     def expr(self):
@@ -366,61 +527,62 @@ class Parser(ParserState):
     def logicalexpr(self):
         lhs = self.keywordexpr()
         self.scan()
-        parse_state = self.copy_state()
-        for m in self.repeat_expr_token(re_logical_operator):
-            op = m.group()
+        parse_state = self.position()
+        while True:
+            op = self.logical_operator()
+            if not op:
+                break
             rhs = ast.Block([], [ast.Method('do', [], self.keywordexpr())])
             lhs = ast.Send(lhs, logical_operator_messages.get(op, op), [rhs], parse_state)
             self.scan()
-            parse_state = self.copy_state()
+            parse_state = self.position()
         return lhs
 
     def cmpexpr(self):
         lhs = self.addexpr()
         self.scan()
-        parse_state = self.copy_state()
-        for m in self.repeat_expr_token(re_comparison_operator):
-            op = m.group()
+        parse_state = self.position()
+        for token in self.repeat_expr_token('operator', comparison_operators):
+            op = token.text
             rhs = self.addexpr()
             lhs = ast.Send(lhs, operator_aliases.get(op, op), [rhs], parse_state)
             self.scan()
-            parse_state = self.copy_state()
+            parse_state = self.position()
         return lhs
 
     def addexpr(self):
         lhs = self.mulexpr()
         self.scan()
-        parse_state = self.copy_state()
-        for m in self.repeat_expr_token(re_addition_operator):
-            op = m.group()
+        parse_state = self.position()
+        for token in self.repeat_expr_token('operator', addition_operators):
+            op = token.text
             rhs = self.mulexpr()
             lhs = ast.Send(lhs, operator_aliases.get(op, op), [rhs], parse_state)
             self.scan()
-            parse_state = self.copy_state()
+            parse_state = self.position()
         return lhs
 
     def mulexpr(self):
         lhs = self.unaryexpr()
         self.scan()
-        parse_state = self.copy_state()
-        for m in self.repeat_expr_token(re_multiplication_operator):
-            op = m.group()
+        parse_state = self.position()
+        for token in self.repeat_expr_token('operator', multiplication_operators):
+            op = token.text
             rhs = self.unaryexpr()
             lhs = ast.Send(lhs, operator_aliases.get(op, op), [rhs], parse_state)
             self.scan()
-            parse_state = self.copy_state()
+            parse_state = self.position()
         return lhs
 
     def unaryexpr(self):
         expr = self.atom()
         while True:
             self.scan()
-            parse_state = self.copy_state()
-            m = self.expr_token(re_name)
-            if not m:
+            parse_state = self.position()
+            token = self.expr_token('name')
+            if not token:
                 break
-            name = m.group()
-            expr = ast.Send(expr, name, [], parse_state)
+            expr = ast.Send(expr, token.text, [], parse_state)
         return expr
 
     def atom(self):
@@ -436,12 +598,11 @@ class Parser(ParserState):
             array = self.array()
             self.expect_token(']', "expected ']'")
             return array
-        parse_state = self.copy_state()
-        m = self.expr_token(re_name)
-        if m:
-            name = m.group()
-            return ast.Send(None, name, [], parse_state)
-        m = self.expr_token(re_number)
+        parse_state = self.position()
+        token = self.expr_token('name')
+        if token:
+            return ast.Send(None, token.text, [], parse_state)
+        m = self.number()
         if m:
             sign, significand, trailing, decimal, exponent = m.groups()
             significand = int(sign + significand, 10)
@@ -451,28 +612,29 @@ class Parser(ParserState):
                 significand = significand * 10**(len(decimal)) + int(decimal, 10)
                 exponent -= len(decimal)
             return ast.Number(significand, exponent, parse_state)
-        str_state = self.copy_state()
+        str_state = self.position()
         parse_state = str_state
-        m = self.expr_token(re_string)
-        if m:
+        token = self.expr_token('string')
+        if token:
+            m = token.match
             s = m.group()
             exprs = []
             while s[-1] == '$':
                 s = parse_string_escapes(m.group(1), parse_state)
                 if len(s) > 0:
                     exprs.append(ast.String(s))
-                if self.match('('):
+                if self.tokens[self.index].pos == self.pos and self.match('('):
                     exprs.append(self.statements())
                     self.expect_token(')', "expected ')'")
                 else:
-                    parse_state = self.copy_state()
-                    m = self.expect_token(re_name, 'expected name or expression')
-                    name = m.group()
-                    exprs.append(ast.Send(None, name, [], parse_state))
-                parse_state = self.copy_state()
-                m = self.match(re_string_next)
-                if not m:
+                    parse_state = self.position()
+                    token = self.expect_token('name', 'expected name or expression')
+                    exprs.append(ast.Send(None, token.text, [], parse_state))
+                parse_state = self.position()
+                token = self.match('string_next')
+                if not token:
                     parse_state.error('error parsing string')
+                m = token.match
                 s = m.group()
             if s[-1] != "'" or (len(s) == 1 and not exprs):
                 self.error('reached end of line while parsing string')
@@ -483,3 +645,86 @@ class Parser(ParserState):
                 exprs.append(ast.String(s))
             return ast.Concat(exprs, str_state)
         self.error('expected expression')
+
+class ToplevelPart(object):
+    """
+    The definitions parsed from part of the top-level block. Each method is
+    paired with the position after its signature in source.
+    """
+
+    def __init__(self, source, slots, statements, methods):
+        self.source = source
+        self.slots = slots
+        self.statements = statements
+        self.methods = methods
+
+# The top-level block is only split into parts when it is at least this many
+# characters per part, since each part costs a round trip to a worker process
+min_part_size = 256 * 1024
+
+# A method definition at column 0. Every | at the start of a line ends the
+# statements before it, so this is where a top-level method begins unless it
+# is inside brackets or a string or closes a signature, in which case parsing
+# the parts fails.
+re_toplevel_method = re.compile(r'^\|', re.MULTILINE)
+
+def split_toplevel(stream, num_parts):
+    """
+    Split the source of a top-level block before method definitions at
+    column 0, into at most num_parts parts of roughly equal size. Returns a
+    list of (start, end, first_line) tuples.
+    """
+    part_size = max(len(stream) // num_parts, min_part_size)
+    parts = []
+    start = 0
+    line_number = 1
+    while start < len(stream):
+        m = re_toplevel_method.search(stream, start + part_size) if len(stream) - start > part_size else None
+        end = m.start() if m else len(stream)
+        parts.append((start, end, line_number))
+        line_number += len(re_newline.findall(stream, start, end))
+        start = end
+    return parts
+
+def parse_toplevel_part(stream, stream_name, first_line, first):
+    return Parser(stream, stream_name, first_line).toplevel_part(first)
+
+def merge_toplevel_parts(parts):
+    """Merge the parts of a top-level block, checking the definitions of each part against those before it."""
+    first = parts[0]
+    defined_symbols = set()
+    for slot in first.slots:
+        defined_symbols.add(slot.name)
+        if slot.mutable:
+            defined_symbols.add(slot.name + ':')
+    defined_methods = set()
+    methods = []
+    for part in parts:
+        for method, pos in part.methods:
+            check_method_definition(method.symbol, defined_methods, defined_symbols, SourcePosition(part.source, pos))
+            methods.append(method)
+            defined_methods.add(method.symbol)
+    return make_block(first.slots, methods, first.statements)
+
+def parse_toplevel(stream, stream_name, jobs=1):
+    """
+    Parse the top-level block of a source file. Large files are split at
+    top-level method definitions and the parts parsed by up to jobs
+    processes. If any part fails to parse, the whole file is parsed again in
+    one piece, so errors are reported exactly as they would be otherwise.
+    """
+    if jobs > 1 and len(stream) >= 2 * min_part_size:
+        parts = split_toplevel(stream, jobs * 4)
+        if len(parts) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            try:
+                with gc_disabled(), ProcessPoolExecutor(min(jobs, len(parts))) as executor:
+                    futures = [executor.submit(parse_toplevel_part, stream[start:end], stream_name, first_line, index == 0)
+                               for index, (start, end, first_line) in enumerate(parts)]
+                    parts = [future.result() for future in futures]
+            except Exception:
+                # Includes trees too deep to send back from the worker
+                return Parser(stream, stream_name).toplevel()
+            with gc_disabled():
+                return merge_toplevel_parts(parts)
+    return Parser(stream, stream_name).toplevel()
@@ -0,0 +1,115 @@
+# ome - Object Message Expressions
+# Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
+
+from .error import OmeError
+from .lowering import get_inline_methods
+from .ome_types import BuiltInMethod
+
+# Messages sent by the runtime itself
+runtime_messages = ('main', 'string')
+
+class ReachableMethods(object):
+    """
+    Find the methods that can be reached from the top-level code, by rapid
+    type analysis.
+
+    The methods of a block can only run once the block has been created,
+    which happens when the code containing it runs, or when the compiler
+    resolves a send to it statically. So a method is reachable if it is
+    called directly from reachable code, or if its symbol is sent from
+    reachable code (or by the runtime or a reachable built-in method) and its
+    block is created by reachable code. Objects of built-in types may be
+    created anywhere, so their tags are always live.
+
+    Dynamic sends are not tracked per send site, since objects also pass
+    through built-in methods, which can only be seen as the messages they
+    send.
+    """
+
+    def __init__(self, builtin, ids):
+        self.sent_messages = set()
+        self.methods = set()      # (tag, symbol) of each reachable method
+        self.live_tags = set()
+        self.tag_methods = {}     # tag -> {symbol: method}
+        self.symbol_tags = {}     # symbol -> tags with a method for it
+        self.message_methods = {} # symbol -> built-in code run when it is sent
+        self.sends = {}           # method -> sends in its code
+        self.blocks = {}          # method -> blocks created by its code
+        self.worklist = []
+
+        for method in builtin.methods:
+            if method.tag_name not in ids.tags:
+                raise OmeError("Unknown tag name '{}' in built-in method '{}'".format(method.tag_name, method.symbol))
+            self.add_method_definition(ids.tags[method.tag_name], method)
+        for method in builtin.messages:
+            self.message_methods.setdefault(method.symbol, []).append(method)
+        for method in builtin.defaults.values():
+            self.message_methods.setdefault(method.symbol, []).append(method)
+        for method in builtin.methods:
+            self.add_tag(ids.tags[method.tag_name])
+
+    def add_method_definition(self, tag, method):
+        self.tag_methods.setdefault(tag, {})[method.symbol] = method
+        self.symbol_tags.setdefault(method.symbol, []).append(tag)
+
+    def add_tag(self, tag):
+        if tag not in self.live_tags:
+            self.live_tags.add(tag)
+            for symbol in self.tag_methods.get(tag, ()):
+                if symbol in self.sent_messages:
+                    self.add_method(tag, symbol)
+
+    def add_message(self, symbol):
+        if symbol not in self.sent_messages:
+            self.sent_messages.add(symbol)
+            for tag in self.symbol_tags.get(symbol, ()):
+                if tag in self.live_tags:
+                    self.add_method(tag, symbol)
+            self.worklist.extend(self.message_methods.get(symbol, ()))
+
+    def add_method(self, tag, symbol):
+        if (tag, symbol) not in self.methods:
+            method = self.tag_methods.get(tag, {}).get(symbol)
+            if method:
+                self.methods.add((tag, symbol))
+                self.worklist.append(method)
+
+    def visit(self, method):
+        if isinstance(method, BuiltInMethod):
+            for symbol in method.sent_messages or ():
+                self.add_message(symbol)
+            return
+        for send in self.sends.get(method, ()):
+            if send.inline_block and not send.inline_fallback:
+                # Compiled to a loop or branches, so the block is never
+                # created and its methods run as part of this one
+                self.worklist.extend(get_inline_methods(send.inline_block, send.symbol).values())
+            elif send.receiver_block:
+                self.add_tag(send.receiver_block.tag_id)
+                self.add_method(send.receiver_block.tag_id, send.symbol)
+            elif send.receiver:
+                self.add_message(send.symbol)
+        for block in self.blocks.get(method, ()):
+            self.add_tag(block.tag_id)
+
+    def find(self, toplevel_method, send_list, block_list):
+        inline_blocks = set()
+        for send in send_list:
+            self.sends.setdefault(send.method, []).append(send)
+            if send.inline_block and not send.inline_fallback:
+                inline_blocks.add(send.inline_block)
+        for block in block_list:
+            if block not in inline_blocks:
+                self.blocks.setdefault(block.parent.find_method(), []).append(block)
+            for method in block.methods:
+                self.add_method_definition(block.tag_id, method)
+        self.worklist.append(toplevel_method)
+        for symbol in runtime_messages:
+            self.add_message(symbol)
+        while self.worklist:
+            self.visit(self.worklist.pop())
+
+def find_reachable_methods(toplevel_method, send_list, block_list, builtin, ids):
+    reachable = ReachableMethods(builtin, ids)
+    reachable.find(toplevel_method, send_list, block_list)
+    return reachable
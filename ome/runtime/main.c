@@ -1,3 +1,20 @@
+OME_RUNTIME_API OME_Value OME_program_main(void)
+{
+    return OME_message_main__0(OME_toplevel(OME_False));
+}
+
+OME_RUNTIME_API OME_Value OME_program_string(OME_Value value)
+{
+    return OME_message_string__0(value);
+}
+
+#ifndef OME_NO_TRACEBACK
+OME_RUNTIME_API const OME_Traceback_Entry *OME_program_traceback_entry(uint32_t index)
+{
+    return &OME_traceback_table[index];
+}
+#endif
+
 int main(int argc, const char *const *argv)
 {
     OME_initialize(argc, argv);
@@ -1,9 +1,79 @@
 #include <stddef.h>
 #include <stdint.h>
 #include <inttypes.h>
+#include <string.h>
+#include <stdlib.h>
+#include <stdio.h>
+#include <assert.h>
 #include <time.h>
 #include <tommath.h>
 
+/*
+ * When OME_SHARED_RUNTIME is defined the runtime is compiled separately
+ * into its own object file and linked with the program, otherwise the
+ * runtime is included in the program translation unit.
+ */
+#ifdef OME_SHARED_RUNTIME
+    #define OME_RUNTIME_API extern
+#else
+    #define OME_RUNTIME_API static
+#endif
+
+/*
+ * When OME_SPLIT_PROGRAM is defined the program is split over multiple
+ * translation units, so methods, dispatchers and data are shared between
+ * them.
+ */
+#ifdef OME_SPLIT_PROGRAM
+    #define OME_PROGRAM_API
+#else
+    #define OME_PROGRAM_API static
+#endif
+
+#define OME_NOINLINE __attribute__((noinline))
+#define OME_LIKELY(e) __builtin_expect((e), 1)
+#define OME_UNLIKELY(e) __builtin_expect((e), 0)
+
+/*
+ * Return the result of a call in tail position from a procedure with a
+ * frame on the stack. Where the C compiler can guarantee that the call is
+ * made with a jump, the frame is freed first so that tail calls use no
+ * more stack. Otherwise the frame is kept until the call returns, so that
+ * deep recursion still gives a Stack-Overflow error instead of crashing.
+ *
+ * Only calls of a method to itself, which are compiled to jumps, run in
+ * constant stack on every compiler. Without musttail (e.g. on gcc) tail
+ * calls to other methods are plain returns that the C compiler may or may
+ * not optimise, so deep mutual recursion can still overflow, particularly
+ * at -O0.
+ */
+#if defined(__clang__) && defined(__has_attribute)
+    #if __has_attribute(musttail)
+        #define OME_MUSTTAIL __attribute__((musttail))
+    #endif
+#endif
+#ifdef OME_MUSTTAIL
+    #define OME_TAIL_RETURN(stack, call) do { \
+        OME_context->stack_pointer = (stack); \
+        OME_MUSTTAIL return call; \
+    } while (0)
+#else
+    #define OME_MUSTTAIL
+    #define OME_TAIL_RETURN(stack, call) do { \
+        OME_Value _result = call; \
+        OME_context->stack_pointer = (stack); \
+        return _result; \
+    } while (0)
+#endif
+
+#ifdef OME_GC_DEBUG
+    #define OME_GC_ASSERT(e) assert(e)
+    #define OME_GC_PRINT(...) printf("ome gc: " __VA_ARGS__)
+#else
+    #define OME_GC_ASSERT(e) do {} while (0)
+    #define OME_GC_PRINT(...) do {} while (0)
+#endif
+
 typedef uint32_t OME_Tag;
 typedef union OME_Value OME_Value;
 typedef struct OME_Traceback_Entry OME_Traceback_Entry;
@@ -247,6 +317,113 @@ static int OME_is_boolean(OME_Value value)
     return OME_is_false(value) || OME_is_true(value);
 }
 
+static int OME_is_small_integer(intptr_t n)
+{
+    return OME_MIN_SMALL_INTEGER <= n && n <= OME_MAX_SMALL_INTEGER;
+}
+
+/*
+ * Fast paths for arithmetic and comparison messages, which the generated
+ * code tries before sending the message. They only handle two small
+ * integers with a small integer result, and return zero otherwise, so that
+ * the message is sent as usual.
+ */
+
+static int OME_small_integers(OME_Value a, OME_Value b)
+{
+    return OME_LIKELY(OME_get_tag(a) == OME_Tag_Small_Integer && OME_get_tag(b) == OME_Tag_Small_Integer);
+}
+
+static int OME_small_integer_add(OME_Value a, OME_Value b, OME_Value *result)
+{
+    if (OME_small_integers(a, b)) {
+        intptr_t n = OME_untag_signed(a) + OME_untag_signed(b);
+        if (OME_LIKELY(OME_is_small_integer(n))) {
+            *result = OME_tag_integer(n);
+            return 1;
+        }
+    }
+    return 0;
+}
+
+static int OME_small_integer_sub(OME_Value a, OME_Value b, OME_Value *result)
+{
+    if (OME_small_integers(a, b)) {
+        intptr_t n = OME_untag_signed(a) - OME_untag_signed(b);
+        if (OME_LIKELY(OME_is_small_integer(n))) {
+            *result = OME_tag_integer(n);
+            return 1;
+        }
+    }
+    return 0;
+}
+
+static int OME_small_integer_mul(OME_Value a, OME_Value b, OME_Value *result)
+{
+    intptr_t n;
+    if (OME_small_integers(a, b) && !__builtin_mul_overflow(OME_untag_signed(a), OME_untag_signed(b), &n)) {
+        if (OME_LIKELY(OME_is_small_integer(n))) {
+            *result = OME_tag_integer(n);
+            return 1;
+        }
+    }
+    return 0;
+}
+
+static int OME_small_integer_equal(OME_Value a, OME_Value b, OME_Value *result)
+{
+    if (OME_small_integers(a, b)) {
+        *result = OME_boolean(OME_untag_signed(a) == OME_untag_signed(b));
+        return 1;
+    }
+    return 0;
+}
+
+static int OME_small_integer_not_equal(OME_Value a, OME_Value b, OME_Value *result)
+{
+    if (OME_small_integers(a, b)) {
+        *result = OME_boolean(OME_untag_signed(a) != OME_untag_signed(b));
+        return 1;
+    }
+    return 0;
+}
+
+static int OME_small_integer_less(OME_Value a, OME_Value b, OME_Value *result)
+{
+    if (OME_small_integers(a, b)) {
+        *result = OME_boolean(OME_untag_signed(a) < OME_untag_signed(b));
+        return 1;
+    }
+    return 0;
+}
+
+static int OME_small_integer_less_equal(OME_Value a, OME_Value b, OME_Value *result)
+{
+    if (OME_small_integers(a, b)) {
+        *result = OME_boolean(OME_untag_signed(a) <= OME_untag_signed(b));
+        return 1;
+    }
+    return 0;
+}
+
+static int OME_small_integer_greater(OME_Value a, OME_Value b, OME_Value *result)
+{
+    if (OME_small_integers(a, b)) {
+        *result = OME_boolean(OME_untag_signed(a) > OME_untag_signed(b));
+        return 1;
+    }
+    return 0;
+}
+
+static int OME_small_integer_greater_equal(OME_Value a, OME_Value b, OME_Value *result)
+{
+    if (OME_small_integers(a, b)) {
+        *result = OME_boolean(OME_untag_signed(a) >= OME_untag_signed(b));
+        return 1;
+    }
+    return 0;
+}
+
 static OME_Value OME_get_slot(OME_Value slots, unsigned int index)
 {
     return OME_untag_slots(slots)[index];
@@ -317,5 +494,98 @@ static OME_Value OME_set_slot(OME_Value slots, unsigned int index, OME_Value val
 #define OME_STATIC_STRING(name, string)\
     static const OME_String name OME_ALIGNED = {sizeof(string)-1, {string}}
 
-static __thread OME_Context *OME_context;
-static OME_Globals OME_globals;
+#define OME_PROGRAM_STRING(name, string)\
+    OME_PROGRAM_API const OME_String name OME_ALIGNED = {sizeof(string)-1, {string}}
+
+OME_RUNTIME_API __thread OME_Context *OME_context;
+OME_RUNTIME_API OME_Globals OME_globals;
+
+// Runtime functions
+
+OME_RUNTIME_API void *OME_allocate_big(OME_Heap *heap, size_t object_size, size_t scan_offset, size_t scan_size);
+OME_RUNTIME_API void OME_ensure_allocate(OME_Heap *heap, size_t size);
+OME_RUNTIME_API OME_Value OME_print(FILE *out, OME_Value value);
+OME_RUNTIME_API void OME_append_traceback(uint32_t entry);
+OME_RUNTIME_API void OME_append_traceback_elided(size_t count);
+OME_RUNTIME_API void OME_reset_traceback(void);
+OME_RUNTIME_API OME_Value OME_concat(OME_Value *strings, unsigned int count);
+OME_RUNTIME_API void OME_initialize(int argc, const char *const *argv);
+OME_RUNTIME_API int OME_thread_main(void);
+
+// Functions defined by the program and called by the runtime
+
+OME_RUNTIME_API OME_Value OME_program_main(void);
+OME_RUNTIME_API OME_Value OME_program_string(OME_Value value);
+#ifndef OME_NO_TRACEBACK
+OME_RUNTIME_API const OME_Traceback_Entry *OME_program_traceback_entry(uint32_t index);
+#endif
+
+// Allocation fast path, inlined into the program
+
+static int OME_is_header_aligned(OME_Header *header)
+{
+    return (((uintptr_t) header + sizeof(OME_Header)) & 0xF) == 0;
+}
+
+static void *OME_allocate(size_t object_size, size_t scan_offset, size_t scan_size)
+{
+    OME_Heap *heap = &OME_context->heap;
+    object_size = (object_size + 7) & ~7;
+    size_t alloc_size = object_size + sizeof(OME_Header);
+    size_t padded_size = alloc_size + sizeof(OME_Header);
+
+    if (OME_UNLIKELY(object_size > OME_MAX_HEAP_OBJECT_SIZE * sizeof(OME_Value))) {
+        return OME_allocate_big(heap, object_size, scan_offset, scan_size);
+    }
+
+    if (OME_UNLIKELY(heap->pointer + padded_size >= heap->limit)) {
+        OME_ensure_allocate(heap, padded_size);
+    }
+
+    OME_Header *header = (OME_Header *) heap->pointer;
+    if (!OME_is_header_aligned(header)) {
+        header->bits = 0;
+        header++;
+    }
+
+    header->size = object_size / sizeof(OME_Value);
+    header->scan_offset = scan_offset;
+    header->scan_size = scan_size;
+
+    heap->pointer = (char *) header + alloc_size;
+
+    void *body = header + 1;
+    OME_GC_ASSERT(OME_untag_pointer(OME_tag_pointer(0, body)) == body);
+    return body;
+}
+
+static void *OME_allocate_data(size_t size)
+{
+    return OME_allocate(size, 0, 0);
+}
+
+static void *OME_allocate_slots(uint32_t num_slots)
+{
+    return OME_allocate(sizeof(OME_Value) * num_slots, 0, num_slots);
+}
+
+static OME_Value *OME_stack_slots(OME_Value *stack)
+{
+    // Objects in a stack frame have a spare word for alignment
+    return (OME_Value *) OME_heap_align((uintptr_t) stack);
+}
+
+static OME_Array *OME_allocate_array(uint32_t num_elems)
+{
+    size_t size = sizeof(OME_Array) + sizeof(OME_Value) * num_elems;
+    OME_Array *array = OME_allocate(size, offsetof(OME_Array, elems) / sizeof(OME_Value), num_elems);
+    array->size = num_elems;
+    return array;
+}
+
+static OME_String *OME_allocate_string(uint32_t size)
+{
+    OME_String *string = OME_allocate_data(sizeof(OME_String) + size + 1);
+    string->size = size;
+    return string;
+}
@@ -1,16 +1,12 @@
-#include <string.h>
-#include <stdlib.h>
-#include <stdio.h>
-#include <assert.h>
-
 #ifdef OME_PLATFORM_POSIX
     #include <unistd.h>
     #include <sys/mman.h>
 #endif
 
-#define OME_NOINLINE __attribute__((noinline))
-#define OME_LIKELY(e) __builtin_expect((e), 1)
-#define OME_UNLIKELY(e) __builtin_expect((e), 0)
+#ifdef OME_SHARED_RUNTIME
+__thread OME_Context *OME_context;
+OME_Globals OME_globals;
+#endif
 
 static uint64_t OME_cycle_count(void)
 {
@@ -54,14 +50,6 @@ static void OME_memory_free(void *addr, size_t size)
 #define OME_MIN_HEAP_SIZE 0x1000
 #define OME_MAX_HEAP_SIZE ((1L << 32) * 16)
 
-#ifdef OME_GC_DEBUG
-    #define OME_GC_ASSERT(e) assert(e)
-    #define OME_GC_PRINT(...) printf("ome gc: " __VA_ARGS__)
-#else
-    #define OME_GC_ASSERT(e) do {} while (0)
-    #define OME_GC_PRINT(...) do {} while (0)
-#endif
-
 #ifdef OME_GC_STATS
     #define OME_GC_TIMER_START() clock_t _OME_gc_start_time = clock()
     #define OME_GC_TIMER_END(timer) do { timer += clock() - _OME_gc_start_time; } while (0)
@@ -70,11 +58,6 @@ static void OME_memory_free(void *addr, size_t size)
     #define OME_GC_TIMER_END(timer)
 #endif
 
-static int OME_is_header_aligned(OME_Header *header)
-{
-    return (((uintptr_t) header + sizeof(OME_Header)) & 0xF) == 0;
-}
-
 static void OME_set_heap_base(OME_Heap *heap, char *heap_base, size_t size)
 {
     size &= ~(OME_HEAP_ALIGNMENT - 1);
@@ -528,7 +511,7 @@ static void OME_collect_big_objects(OME_Heap *heap)
 }
 
 OME_NOINLINE
-static void *OME_allocate_big(OME_Heap *heap, size_t object_size, size_t scan_offset, size_t scan_size)
+OME_RUNTIME_API void *OME_allocate_big(OME_Heap *heap, size_t object_size, size_t scan_offset, size_t scan_size)
 {
     if (object_size > OME_MAX_BIG_OBJECT_SIZE * sizeof(OME_Value)) {
         fprintf(stderr, "ome: invalid object object size %ld\n", object_size);
@@ -584,7 +567,7 @@ static void *OME_allocate_big(OME_Heap *heap, size_t object_size, size_t scan_of
 }
 
 OME_NOINLINE
-static void OME_ensure_allocate(OME_Heap *heap, size_t size)
+OME_RUNTIME_API void OME_ensure_allocate(OME_Heap *heap, size_t size)
 {
     if (heap->pointer + size >= heap->limit) {
         OME_collect(heap);
@@ -604,67 +587,10 @@ static void OME_ensure_allocate(OME_Heap *heap, size_t size)
     }
 }
 
-static void *OME_allocate(size_t object_size, size_t scan_offset, size_t scan_size)
-{
-    OME_Heap *heap = &OME_context->heap;
-    object_size = (object_size + 7) & ~7;
-    size_t alloc_size = object_size + sizeof(OME_Header);
-    size_t padded_size = alloc_size + sizeof(OME_Header);
-
-    if (OME_UNLIKELY(object_size > OME_MAX_HEAP_OBJECT_SIZE * sizeof(OME_Value))) {
-        return OME_allocate_big(heap, object_size, scan_offset, scan_size);
-    }
-
-    if (OME_UNLIKELY(heap->pointer + padded_size >= heap->limit)) {
-        OME_ensure_allocate(heap, padded_size);
-    }
-
-    OME_Header *header = (OME_Header *) heap->pointer;
-    if (!OME_is_header_aligned(header)) {
-        header->bits = 0;
-        header++;
-    }
-
-    header->size = object_size / sizeof(OME_Value);
-    header->scan_offset = scan_offset;
-    header->scan_size = scan_size;
-
-    heap->pointer = (char *) header + alloc_size;
-
-    void *body = header + 1;
-    OME_GC_ASSERT(OME_untag_pointer(OME_tag_pointer(0, body)) == body);
-    return body;
-}
-
-static void *OME_allocate_data(size_t size)
-{
-    return OME_allocate(size, 0, 0);
-}
-
-static void *OME_allocate_slots(uint32_t num_slots)
-{
-    return OME_allocate(sizeof(OME_Value) * num_slots, 0, num_slots);
-}
-
-static OME_Array *OME_allocate_array(uint32_t num_elems)
-{
-    size_t size = sizeof(OME_Array) + sizeof(OME_Value) * num_elems;
-    OME_Array *array = OME_allocate(size, offsetof(OME_Array, elems) / sizeof(OME_Value), num_elems);
-    array->size = num_elems;
-    return array;
-}
-
-static OME_String *OME_allocate_string(uint32_t size)
-{
-    OME_String *string = OME_allocate_data(sizeof(OME_String) + size + 1);
-    string->size = size;
-    return string;
-}
-
-static OME_Value OME_print(FILE *out, OME_Value value)
+OME_RUNTIME_API OME_Value OME_print(FILE *out, OME_Value value)
 {
     if (OME_get_tag(value) != OME_Tag_String) {
-        value = OME_message_string__0(value);
+        value = OME_program_string(value);
         if (OME_is_error(value)) {
             return value;
         }
@@ -677,7 +603,7 @@ static OME_Value OME_print(FILE *out, OME_Value value)
     return OME_Empty;
 }
 
-static void OME_append_traceback(uint32_t entry)
+OME_RUNTIME_API void OME_append_traceback(uint32_t entry)
 {
 #ifndef OME_NO_TRACEBACK
     uint32_t *traceback = &OME_context->traceback[-1];
@@ -688,7 +614,22 @@ static void OME_append_traceback(uint32_t entry)
 #endif
 }
 
-static void OME_reset_traceback(void)
+/*
+ * Calls of a method to itself in tail position are made with a jump, so
+ * the entries they would have appended are replaced by one entry that only
+ * records how many more times the entry appended after it was repeated.
+ */
+#define OME_TRACEBACK_ELIDED 0x80000000U
+
+OME_RUNTIME_API void OME_append_traceback_elided(size_t count)
+{
+    if (count > ~OME_TRACEBACK_ELIDED) {
+        count = ~OME_TRACEBACK_ELIDED;
+    }
+    OME_append_traceback(OME_TRACEBACK_ELIDED | (uint32_t) count);
+}
+
+OME_RUNTIME_API void OME_reset_traceback(void)
 {
 #ifndef OME_NO_TRACEBACK
     size_t size = OME_context->stack_end - OME_context->stack_limit;
@@ -713,7 +654,11 @@ static void OME_print_traceback(FILE *out, OME_Value error)
         fputs("Traceback (most recent call last):\n", out);
     }
     for (; cur < end; cur++) {
-        OME_Traceback_Entry const *tb = &OME_traceback_table[*cur];
+        if (*cur & OME_TRACEBACK_ELIDED) {
+            fprintf(out, "  (%" PRIu32 " more tail calls elided)\n", *cur & ~OME_TRACEBACK_ELIDED);
+            continue;
+        }
+        OME_Traceback_Entry const *tb = OME_program_traceback_entry(*cur);
         fprintf(out, "  File \"%s\", line %d, in |%s|\n", tb->stream_name, tb->line_number, tb->method_name);
 #ifndef OME_NO_SOURCE_TRACEBACK
         if (use_ansi) fputs("\x1b[1m", out);
@@ -733,13 +678,13 @@ static void OME_print_traceback(FILE *out, OME_Value error)
 }
 
 OME_NOINLINE
-static OME_Value OME_concat(OME_Value *strings, unsigned int count)
+OME_RUNTIME_API OME_Value OME_concat(OME_Value *strings, unsigned int count)
 {
     size_t size = 0;
     for (unsigned int i = 0; i < count; i++) {
         OME_Value string = strings[i];
         if (OME_get_tag(string) != OME_Tag_String) {
-            string = OME_message_string__0(string);
+            string = OME_program_string(string);
             if (OME_is_error(string)) {
                 return string;
             }
@@ -764,7 +709,7 @@ static OME_Value OME_concat(OME_Value *strings, unsigned int count)
     return OME_tag_pointer(OME_Tag_String, output);
 }
 
-static void OME_initialize(int argc, const char *const *argv)
+OME_RUNTIME_API void OME_initialize(int argc, const char *const *argv)
 {
     OME_globals.argv = malloc(sizeof(OME_Array) + sizeof(OME_Value) * argc);
     OME_globals.argv->size = argc;
@@ -779,7 +724,7 @@ static void OME_initialize(int argc, const char *const *argv)
     OME_globals.cycles_per_ms = OME_estimate_cycles_per_ms();
 }
 
-static int OME_thread_main(void)
+OME_RUNTIME_API int OME_thread_main(void)
 {
     const size_t stack_size = (0x1000 - sizeof(OME_Context)) / sizeof(OME_Value);
 
@@ -791,7 +736,7 @@ static int OME_thread_main(void)
 
     OME_context = context;
 
-    OME_Value value = OME_message_main__0(OME_toplevel(OME_False));
+    OME_Value value = OME_program_main();
     if (OME_is_error(value)) {
         OME_print_traceback(stderr, value);
     }
@@ -0,0 +1,184 @@
+# ome - Object Message Expressions
+# Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
+
+import json
+import os
+import signal
+import socket
+import sys
+from .util import get_cache_dir
+
+def get_default_socket_path():
+    return os.path.join(get_cache_dir('ome'), 'server.sock')
+
+def get_client_args(argv):
+    """Remove the client options from the command line arguments."""
+    args = []
+    socket_path = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '--connect':
+            pass
+        elif arg == '--socket' and i + 1 < len(argv):
+            socket_path = argv[i + 1]
+            i += 1
+        elif arg.startswith('--socket='):
+            socket_path = arg[len('--socket='):]
+        else:
+            args.append(arg)
+        i += 1
+    return args, socket_path or get_default_socket_path()
+
+def receive_all(conn):
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+def connect(socket_path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except OSError:
+        conn.close()
+        return None
+    return conn
+
+def run_client(argv):
+    """
+    Run a compile on the server and return its exit status. If no server is
+    running the compile runs in this process instead.
+    """
+    args, socket_path = get_client_args(argv)
+    conn = connect(socket_path) if hasattr(socket, 'AF_UNIX') else None
+    if not conn:
+        from .__main__ import main
+        try:
+            main(args)
+        except SystemExit as e:
+            return e.code
+        return 0
+    with conn:
+        request = json.dumps({'argv': args, 'cwd': os.getcwd(), 'env': dict(os.environ)})
+        sys.stdout.flush()
+        sys.stderr.flush()
+        socket.send_fds(conn, [request.encode('utf8')], [0, 1, 2])
+        conn.shutdown(socket.SHUT_WR)
+        response = receive_all(conn)
+    try:
+        return int(response)
+    except ValueError:
+        print('ome: lost connection to server', file=sys.stderr)
+        return 1
+
+def client_main(argv=None):
+    sys.exit(run_client(sys.argv[1:] if argv is None else argv))
+
+def handle_request(conn):
+    from . import terminal
+    from .__main__ import main
+    from .util import is_ansi_terminal
+
+    data, fds, flags, addr = socket.recv_fds(conn, 65536, 3)
+    request = json.loads((data + receive_all(conn)).decode('utf8'))
+    for fd, std_fd in zip(fds, (0, 1, 2)):
+        os.dup2(fd, std_fd)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    terminal.stdout.is_ansi = is_ansi_terminal(sys.stdout)
+    terminal.stderr.is_ansi = is_ansi_terminal(sys.stderr)
+
+    status = 0
+    try:
+        main(request['argv'])
+    except SystemExit as e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            status = 1
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.sendall(str(status).encode('ascii'))
+
+def warm_up(verbose):
+    """Load everything that does not depend on the request."""
+    import platform
+    from . import build
+    from .__main__ import main  # import everything needed to handle a request
+    from .target import target_map
+    for target_name in target_map:
+        target = build.get_target(target_name)
+        target.get_builtin(get_cache_dir('ome'))
+        try:
+            backend = build.get_backend(target, platform.system())
+            if verbose:
+                print('ome: found backend {} {}'.format(backend.name, backend.version), file=sys.stderr)
+        except Exception:
+            pass
+
+def run_server(socket_path=None, verbose=False):
+    """
+    Keep the compiler loaded with the built-in table and backend versions,
+    and fork a child for each request. The client sends its arguments,
+    working directory and environment along with its stdin, stdout and
+    stderr, so the child writes diagnostics straight to the client's
+    terminal, then sends back the exit status.
+    """
+    from .error import OmeError
+    from .util import make_path, remove
+
+    if not hasattr(socket, 'AF_UNIX'):
+        raise OmeError('server mode is not supported on this platform')
+    socket_path = socket_path or get_default_socket_path()
+    conn = connect(socket_path)
+    if conn:
+        conn.close()
+        raise OmeError('server is already running on {}'.format(socket_path))
+    remove(socket_path)
+    make_path(os.path.dirname(os.path.abspath(socket_path)))
+
+    warm_up(verbose)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(64)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    if verbose:
+        print('ome: listening on', socket_path, file=sys.stderr)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    try:
+        while True:
+            conn, addr = server.accept()
+            if os.fork() == 0:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                server.close()
+                try:
+                    handle_request(conn)
+                finally:
+                    os._exit(0)
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        remove(socket_path)
@@ -1,26 +1,84 @@
+def is_list(node):
+    return isinstance(node, (list, tuple))
+
+def write_sexpr_flat(out, node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, (list, tuple)):
+            out.append(str(node))
+        else:
+            stack.append(')')
+            for index in range(len(node) - 1, 0, -1):
+                stack.append(node[index])
+                stack.append(' ')
+            if node:
+                stack.append(node[0])
+            out.append('(')
+
 def format_sexpr_flat(node):
-    if not isinstance(node, (list, tuple)):
-        return str(node)
-    else:
-        return '(' + ' '.join(format_sexpr_flat(x) for x in node) + ')'
+    out = []
+    write_sexpr_flat(out, node)
+    return ''.join(out)
+
+def get_flat_forms(node, max_width):
+    """
+    Get the flat form of each list in node, keyed by id. Only lists shorter
+    than max_width have their flat form stored as a string, since no others
+    fit on one line. For the rest only the length of the flat form is stored.
+    """
+    lists = [node]
+    for x in lists:  # Parents are visited before children
+        for y in x:
+            if isinstance(y, (list, tuple)):
+                lists.append(y)
+    flat = {}
+    for x in reversed(lists):
+        parts = [flat[id(y)] if isinstance(y, (list, tuple)) else str(y) for y in x]
+        if all(isinstance(part, str) for part in parts):
+            s = '(' + ' '.join(parts) + ')'
+            flat[id(x)] = s if len(s) < max_width else len(s)
+        else:
+            flat[id(x)] = len(parts) + 1 + sum(part if isinstance(part, int) else len(part) for part in parts)
+    return flat
 
 def format_sexpr(node, indent_level=0, max_width=80):
-    if not isinstance(node, (list, tuple)):
+    # A list is written on one line if its flat form fits, otherwise each
+    # element goes on its own line. The multi-line form of a list is never
+    # shorter than its flat form, so a list fits on one line exactly when its
+    # flat form does, and the flat form of each list is only computed once.
+    if not is_list(node):
         return str(node)
-    if len(node) == 0:
-        return '()'
-    xs = [format_sexpr(x, indent_level, max_width) for x in node]
-    width = indent_level + (len(xs) - 1) + sum(len(x) for x in xs) + 2
-    if width < max_width:
-        return '(' + ' '.join(xs) + ')'
-    else:
+    flat = get_flat_forms(node, max_width)
+    out = []
+    stack = [(node, indent_level, max_width)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            out.append(item)
+            continue
+        node, indent_level, max_width = item
+        if not is_list(node):
+            out.append(str(node))
+            continue
+        s = flat[id(node)]
+        if not node or (isinstance(s, str) and indent_level + len(s) < max_width):
+            out.append(s if isinstance(s, str) else '()')
+            continue
         line_indent = '\n' + ' ' * (indent_level + 2)
-        xs = [format_sexpr(x, indent_level + 2, max_width) for x in node[:-1]]
-        if xs:
-            xs.append(format_sexpr(node[-1], indent_level + 2, max_width - 1))
+        xs = [(x, indent_level + 2, max_width) for x in node[:-1]]
+        xs.append((node[-1], indent_level + 2, max_width - 1))
+        parts = ['(']
         if node[0] in ('method', 'send', 'call', 'local'):
             x = format_sexpr_flat(node[1])
             width = len(node[0]) + len(x) + 2
             if width < max_width:
-                return '(' + node[0] + ' ' + x + line_indent + line_indent.join(xs[2:]) + ')'
-        return '(' + line_indent.join(xs) + ')'
+                parts += [node[0] + ' ' + x, line_indent]
+                xs = xs[2:]
+        for index, x in enumerate(xs):
+            if index > 0:
+                parts.append(line_indent)
+            parts.append(x)
+        parts.append(')')
+        stack.extend(reversed(parts))
+    return ''.join(out)
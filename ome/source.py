@@ -0,0 +1,66 @@
+# ome - Object Message Expressions
+# Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
+
+import re
+from bisect import bisect_right
+from .error import OmeParseError
+
+re_newline = re.compile(r'\r\n|\r|\n')
+
+class Source(object):
+    """
+    The text of a source file. Positions are character offsets into the
+    text; line numbers and columns are computed from an index of line start
+    offsets, which is built the first time it is needed.
+    """
+
+    def __init__(self, text, name, first_line=1):
+        self.text = text
+        self.name = name
+        self.first_line = first_line
+        self._line_starts = None
+
+    @property
+    def line_starts(self):
+        if self._line_starts is None:
+            self._line_starts = [0]
+            self._line_starts.extend(m.end() for m in re_newline.finditer(self.text))
+        return self._line_starts
+
+    def line_start(self, pos):
+        return self.line_starts[bisect_right(self.line_starts, pos) - 1]
+
+    def line_number(self, pos):
+        return bisect_right(self.line_starts, pos) - 1 + self.first_line
+
+    def line_text(self, pos):
+        m = re_newline.search(self.text, pos)
+        return self.text[self.line_start(pos) : m.start() if m else len(self.text)]
+
+class SourcePosition(object):
+    """A position in a source file, for error messages and tracebacks."""
+
+    __slots__ = ('source', 'pos')
+
+    def __init__(self, source, pos):
+        self.source = source
+        self.pos = pos
+
+    @property
+    def stream_name(self):
+        return self.source.name
+
+    @property
+    def line_number(self):
+        return self.source.line_number(self.pos)
+
+    @property
+    def column(self):
+        return self.pos - self.source.line_start(self.pos)
+
+    @property
+    def current_line(self):
+        return self.source.line_text(self.pos)
+
+    def error(self, message):
+        raise OmeParseError(message, self)
@@ -1,8 +1,8 @@
 # ome - Object Message Expressions
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
-from . import lang_c
-
+# Targets are imported by name on first use so that only the selected
+# target's code generator and backends are loaded.
 target_map = {
-    'c': lang_c,
+    'c': '.lang_c',
 }
@@ -1,19 +1,20 @@
 # ome - Object Message Expressions
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
-from .backend_clang import ClangBuilder
-from .backend_gcc import GCCBuilder
-from .backend_file import FileBuilder
 from .builtin import *
 from .codegen import *
-from .packages import packages
 
 name = 'C'
 
+# Backend classes are (module, class name) pairs imported by build.get_backend
 backends = {
-    'clang': ClangBuilder,
-    'gcc': GCCBuilder,
-    'file': FileBuilder,
+    'clang': ('.backend_clang', 'ClangBuilder'),
+    'gcc': ('.backend_gcc', 'GCCBuilder'),
+    'file': ('.backend_file', 'FileBuilder'),
 }
 
 backend_preference = ['clang', 'gcc']
+
+def get_packages():
+    from .packages import packages
+    return packages
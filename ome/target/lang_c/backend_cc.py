@@ -3,8 +3,11 @@
 
 import os
 import platform
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from ...cache import Cache, get_hash
 from ...error import OmeError
-from ...util import temporary_file, find_executable
+from ...util import temporary_file, temporary_dir, find_executable, make_path, remove
 
 def find_musl_path(path):
     if path:
@@ -52,7 +55,7 @@ class CCArgsBuilder(object):
             args.append('-static' if build_options.static else '-pie')
             args.extend(self.link_args)
             args.extend(self.variant_link_args.get((build_options.platform, build_options.variant), []))
-            args.append(infile)
+            args.extend(infile if isinstance(infile, list) else [infile])
             for obj in build_options.objects:
                 args.append(obj)
             for lib_dir in build_options.library_dirs:
@@ -82,17 +85,138 @@ class CCBuilder(object):
     def output_name(self, infile, build_options):
         return os.path.splitext(infile)[0] + (self.exe_extension if build_options.link else self.obj_extension)
 
+    def get_cache(self, build_options):
+        if build_options.cache_dir:
+            return Cache(os.path.join(build_options.cache_dir, 'objects'))
+
+    def get_cache_key(self, *parts):
+        return get_hash(self.name, self.version, self.tools['CC'], *parts)
+
+    def get_link_cache_key(self, object_key, build_options):
+        parts = [object_key, build_options.variant]
+        parts.extend(self.get_build_args(build_options, '', '', True))
+        for path in build_options.objects:
+            try:
+                st = os.stat(path)
+                parts.append('{}:{}:{}'.format(path, st.st_size, st.st_mtime_ns))
+            except OSError:
+                parts.append(path)
+        return self.get_cache_key('executable', *parts)
+
+    def print_cached(self, build_options, what):
+        if build_options.verbose:
+            print('ome: using cached', what)
+
+    def get_object_cache_key(self, infile, build_options, input):
+        return self.get_cache_key('object', input, *self.get_build_args(build_options, infile, '', False))
+
+    def compile_object(self, shell, infile, outfile, build_options, input=None, cache=None):
+        """
+        Compile infile (or input if infile is '-') to an object file. If a
+        cache is given the object is looked up and stored keyed on the input
+        and the compiler arguments.
+        """
+        command = [self.tools['CC']] + self.get_build_args(build_options, infile, outfile, False)
+        with build_options.timer.time('cc'):
+            if not cache:
+                shell.run(command, input=input)
+                return
+            key = self.get_object_cache_key(infile, build_options, input)
+            if cache.get_file(key, outfile):
+                self.print_cached(build_options, 'object file')
+            else:
+                shell.run(command, input=input)
+                cache.put_file(key, outfile)
+
+    def link(self, shell, objfiles, outfile, build_options):
+        with build_options.timer.time('link'):
+            shell.run([self.tools['CC']] + self.get_build_args(build_options, objfiles, outfile, True))
+        if build_options.release and platform.system() == 'Linux':
+            with build_options.timer.time('strip'):
+                shell.run('strip', '--strip-all', '--remove-section=.comment', '--remove-section=.note', outfile)
+
     def build_file(self, shell, infile, outfile, build_options, input=None):
-        command = [self.tools['CC']]
+        cache = self.get_cache(build_options) if input is not None else None
         if build_options.link:
+            if cache:
+                object_key = self.get_object_cache_key(infile, build_options, input)
+                link_key = self.get_link_cache_key(object_key, build_options)
+                if cache.get_file(link_key, outfile):
+                    self.print_cached(build_options, 'executable')
+                    return
             with temporary_file(prefix='.ome-build.', suffix='.o') as objfile:
-                shell.run(command + self.get_build_args(build_options, infile, objfile, False), input=input)
-                if build_options.link:
-                    shell.run(command + self.get_build_args(build_options, objfile, outfile, True))
-                    if build_options.release and platform.system() == 'Linux':
-                        shell.run('strip', '--strip-all', '--remove-section=.comment', '--remove-section=.note', outfile)
+                self.compile_object(shell, infile, objfile, build_options, input, cache)
+                self.link(shell, objfile, outfile, build_options)
+                if cache:
+                    cache.put_file(link_key, outfile)
         else:
-            shell.run(command + self.get_build_args(build_options, infile, outfile, False), input=input)
+            self.compile_object(shell, infile, outfile, build_options, input, cache)
+
+    def build_units(self, shell, units, outfile, build_options):
+        """
+        Compile each translation unit to an object file concurrently, using
+        up to build_options.jobs compiler processes, then link them.
+        """
+        cache = self.get_cache(build_options)
+        if cache:
+            object_key = get_hash(*(self.get_object_cache_key('-', build_options, unit) for unit in units))
+            link_key = self.get_link_cache_key(object_key, build_options)
+            if cache.get_file(link_key, outfile):
+                self.print_cached(build_options, 'executable')
+                return
+        with temporary_dir('.ome-build') as build_dir:
+            objfiles = [os.path.join(build_dir, 'unit{}{}'.format(index, self.obj_extension)) for index in range(len(units))]
+            with ThreadPoolExecutor(build_options.jobs) as executor:
+                futures = [executor.submit(self.compile_object, shell, '-', objfile, build_options, unit, cache)
+                           for unit, objfile in zip(units, objfiles)]
+                for future in futures:
+                    future.result()
+            self.link(shell, objfiles, outfile, build_options)
+            if cache:
+                cache.put_file(link_key, outfile)
+
+    def compile_stream(self, shell, write_code, outfile, build_options):
+        command = [self.tools['CC']] + self.get_build_args(build_options, '-', outfile, False)
+        with build_options.timer.time('cc'):
+            with shell.pipe(command) as f:
+                write_code(f)
+
+    def build_stream(self, shell, write_code, outfile, build_options):
+        """
+        Compile the code written by write_code(file) through a pipe, so the
+        compiler parses the code while it is being generated. Nothing is
+        cached because the code is not known until it has all been written.
+        """
+        if build_options.link:
+            with temporary_file(prefix='.ome-build.', suffix='.o') as objfile:
+                self.compile_stream(shell, write_code, objfile, build_options)
+                self.link(shell, objfile, outfile, build_options)
+        else:
+            self.compile_stream(shell, write_code, outfile, build_options)
+
+    def build_runtime(self, shell, code, prefix_dir, build_options):
+        """
+        Compile the shared runtime to an object file in prefix_dir, unless it
+        has already been built with the same compiler and arguments. Returns
+        the path of the object file.
+        """
+        key = self.get_cache_key('runtime', code, *self.get_build_args(build_options, '-', '', False))
+        runtime_dir = os.path.join(prefix_dir, 'runtime')
+        path = os.path.join(runtime_dir, 'ome-runtime-{}{}'.format(key[:32], self.obj_extension))
+        if os.path.exists(path):
+            return path
+        if build_options.verbose:
+            print('ome: building runtime')
+        make_path(runtime_dir)
+        fd, temp_path = tempfile.mkstemp(prefix='.ome-build.', suffix=self.obj_extension, dir=runtime_dir)
+        os.close(fd)
+        try:
+            with build_options.timer.time('runtime'):
+                shell.run([self.tools['CC']] + self.get_build_args(build_options, '-', temp_path, False), input=code)
+            os.replace(temp_path, path)
+        finally:
+            remove(temp_path)
+        return path
 
     def build_string(self, shell, code, outfile, build_options):
         self.build_file(shell, '-', outfile, build_options, input=code)
@@ -18,3 +18,7 @@ class FileBuilder(object):
     def build_string(self, shell, code, outfile, build_options):
         with open(outfile, 'wb') as f:
             f.write(code)
+
+    def build_stream(self, shell, write_code, outfile, build_options):
+        with open(outfile, 'wb') as f:
+            write_code(f)
@@ -2,9 +2,13 @@
 # Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
 
 import os
-from ... import runtime
+import sys
+from ... import baseparser, cpreparser, ome_types, runtime, source
+from ... import parser as ome_parser
+from ...cache import Cache, get_hash
 from ...cpreparser import CPreParser
 from ...ome_types import BuiltIn, BuiltInMethod
+from ...version import version
 
 constant_string_method = '''
     OME_STATIC_STRING(s, "{name}");
@@ -27,20 +31,56 @@ def emit_builtin_code(out):
 def emit_builtin_main(out):
     out.write(runtime.main)
 
-def get_builtin():
+builtin_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'builtins'))
+parser_modules = [baseparser, cpreparser, ome_parser, ome_types, source, sys.modules[__name__]]
+
+def get_builtin_filenames():
+    return sorted(
+        os.path.join(builtin_path, filename)
+        for filename in os.listdir(builtin_path)
+        if filename.endswith('.c'))
+
+def get_builtin_cache_key(filenames):
+    parts = ['builtin', '{}.{}.{}'.format(*version)]
+    for filename in filenames + [module.__file__ for module in parser_modules]:
+        st = os.stat(filename)
+        parts.append('{}:{}:{}'.format(filename, st.st_size, st.st_mtime_ns))
+    return get_hash(*parts)
+
+def parse_builtin(filenames):
     builtin = BuiltIn()
-    builtin_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'builtins'))
-    for filename in os.listdir(builtin_path):
-        if filename.endswith('.c'):
-            filename = os.path.join(builtin_path, filename)
-            with open(filename, encoding='utf8') as f:
-                source = f.read()
-            parser = CPreParser(source, filename)
-            parser.parse(builtin)
+    for filename in filenames:
+        with open(filename, encoding='utf8') as f:
+            source = f.read()
+        parser = CPreParser(source, filename)
+        parser.parse(builtin)
     for name in builtin.constant_names:
         builtin.methods.append(BuiltInMethod(name, 'show', ['_0'], [], constant_string_method.format(name=name)))
     return builtin
 
+_builtin = None
+
+def get_builtin(cache_dir=None):
+    """
+    Get the built-in methods and types parsed from the builtins directory.
+    The result is memoized and, if cache_dir is given, stored in the cache
+    keyed on the size and modification time of the builtin sources and the
+    parser modules.
+    """
+    global _builtin
+    if _builtin is None:
+        filenames = get_builtin_filenames()
+        if cache_dir:
+            cache = Cache(os.path.join(cache_dir, 'builtin'))
+            key = get_builtin_cache_key(filenames)
+            _builtin = cache.load(key)
+            if _builtin is None:
+                _builtin = parse_builtin(filenames)
+                cache.store(key, _builtin)
+        else:
+            _builtin = parse_builtin(filenames)
+    return _builtin
+
 if __name__ == '__main__':
     for method in get_builtin().methods:
         print(method.tag_name, method.symbol, method.sent_messages)
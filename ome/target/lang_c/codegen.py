@@ -5,8 +5,9 @@ from ... import optimise
 from ...constants import MIN_CONSTANT_TAG
 from ...dispatcher import DispatcherGenerator
 from ...emit import ProcedureCodeEmitter
-from ...instructions import CONCAT
+from ...instructions import CALL, CONCAT, MOVE, STACK_ALLOC, TAIL_JUMP
 from ...symbol import symbol_to_label, symbol_arity
+from ...timing import null_timer
 from .cstring import literal_c_string
 from .stackalloc import allocate_stack_slots
 
@@ -25,41 +26,92 @@ def make_lookup_label(symbol):
 def make_method_label(tag, symbol):
     return 'OME_method_{}_{}'.format(tag, symbol_to_label(symbol))
 
+# Messages with an inline fast path for small integers, tried before the
+# message is sent
+small_integer_operations = {
+    '+': 'OME_small_integer_add',
+    '-': 'OME_small_integer_sub',
+    '*': 'OME_small_integer_mul',
+    '==': 'OME_small_integer_equal',
+    '!=': 'OME_small_integer_not_equal',
+    '<': 'OME_small_integer_less',
+    '<=': 'OME_small_integer_less_equal',
+    '>': 'OME_small_integer_greater',
+    '>=': 'OME_small_integer_greater_equal',
+}
+
 def literal_integer(value, suffix=''):
     return '{}{}{}'.format(value, suffix, '' if -0x80000000 <= value <= 0x7fffffff else 'L')
 
+def format_tag_test(local, tag):
+    if tag >= MIN_CONSTANT_TAG:
+        return 'OME_equal(_{}, OME_tag_unsigned(OME_Tag_Constant, {}))'.format(local, tag - MIN_CONSTANT_TAG)
+    return 'OME_get_tag(_{}) == {}'.format(local, tag)
+
 def format_function_definition_with_arg_names(name, argnames):
-    return 'static OME_Value {}({})'.format(name, ', '.join('OME_Value {}'.format(arg) for arg in argnames))
+    return 'OME_PROGRAM_API OME_Value {}({})'.format(name, ', '.join('OME_Value {}'.format(arg) for arg in argnames))
 
 def format_function_definition(name, num_args):
     return format_function_definition_with_arg_names(name, ('_{}'.format(n) for n in range(num_args)))
 
 def format_function_declaration(name, num_args):
-    return 'static OME_Value {}({})'.format(name, ', '.join('OME_Value' for n in range(num_args)))
+    return 'OME_PROGRAM_API OME_Value {}({})'.format(name, ', '.join('OME_Value' for n in range(num_args)))
 
 def format_dispatch_call(name, num_args):
     return '{}({})'.format(name, ', '.join('_{}'.format(n) for n in range(num_args)))
 
+def has_fast_path(ins):
+    return isinstance(ins, CALL) and ins.symbol in small_integer_operations
+
 class ProcedureCodegen(object):
-    def __init__(self, emit):
+    def __init__(self, emit, timer=null_timer):
         self.emit = emit
+        self.timer = timer
 
     def optimise(self, code):
-        code.instructions = optimise.eliminate_aliases(code.instructions)
-        code.instructions = optimise.move_constants_to_usage_points(code.instructions, code.num_args)
-        optimise.renumber_locals(code.instructions, code.num_args)
-        optimise.find_live_sets(code.instructions)
+        with self.timer.time('eliminate_aliases'):
+            code.instructions = optimise.eliminate_aliases(code.instructions)
+        with self.timer.time('move_constants_to_usage_points'):
+            code.instructions = optimise.move_constants_to_usage_points(code.instructions, code.num_args)
+        with self.timer.time('renumber_locals'):
+            optimise.renumber_locals(code.instructions, code.num_args)
+        with self.timer.time('find_live_sets'):
+            optimise.find_live_sets(code.instructions)
         self.is_leaf = all(ins.is_leaf for ins in code.instructions)
         if not self.is_leaf:
-            self.stack_size = allocate_stack_slots(code.instructions, code.num_args)
+            with self.timer.time('allocate_stack_slots'):
+                self.stack_size = allocate_stack_slots(code.instructions, code.num_args, has_fast_path)
         else:
             self.stack_size = 0
+        # Objects allocated in the frame go above the saved locals, with a
+        # spare word so that their slots can be aligned like heap objects
+        self.stack_objects = []
+        for ins in code.instructions:
+            if isinstance(ins, STACK_ALLOC):
+                ins.stack_slot = self.stack_size
+                self.stack_size += ins.size + 1
+                self.stack_objects.append(ins)
+        self.variables = sorted(set(ins.dest for ins in code.instructions if isinstance(ins, MOVE)))
+        # All calls of the method itself that became jumps have the same
+        # traceback entry, which errors get once with the number of jumps
+        self.tail_traceback_info = None
+        for ins in code.instructions:
+            if isinstance(ins, TAIL_JUMP) and ins.traceback_info:
+                self.tail_traceback_info = ins.traceback_info
+        # The fast paths take the address of the local for their result,
+        # which musttail does not allow
+        self.has_address_taken = any(has_fast_path(ins) for ins in code.instructions)
         self.has_stack = self.stack_size > 0 or any(isinstance(ins, CONCAT) for ins in code.instructions)
 
     def begin(self, name, num_args):
         self.emit(format_function_definition(name, num_args))
         self.emit('{')
         self.emit.indent()
+        # Locals assigned by MOVE may be assigned on more than one path
+        for local in self.variables:
+            self.emit('OME_Value _{};'.format(local))
+        if self.tail_traceback_info:
+            self.emit('size_t _tail_calls = 0;')
         if self.has_stack:
             self.emit('OME_Value * const _stack = OME_context->stack_pointer;')
             if self.stack_size > 0:
@@ -68,6 +120,11 @@ class ProcedureCodegen(object):
                     self.emit('return OME_error(OME_Stack_Overflow);')
                 self.emit('}')
                 self.emit('OME_context->stack_pointer = &_stack[{}];'.format(self.stack_size))
+            # The collector scans the whole frame, so objects in it must not
+            # hold stale values before they are created
+            for ins in self.stack_objects:
+                for slot in range(ins.stack_slot, ins.stack_slot + ins.size + 1):
+                    self.emit('_stack[{}] = OME_False;'.format(slot))
 
     def end(self):
         self.emit.dedent()
@@ -86,15 +143,40 @@ class ProcedureCodegen(object):
             self.emit('OME_context->stack_pointer = _stack;')
         self.emit('return {};'.format(ret))
 
+    def emit_tail_call(self, label, args):
+        call = '{}({})'.format(label, args)
+        if self.has_address_taken:
+            self.emit('{')
+            with self.emit.indented():
+                self.emit('OME_Value _result = {};'.format(call))
+                self.emit_return('_result')
+            self.emit('}')
+        elif self.stack_size > 0:
+            self.emit('OME_TAIL_RETURN(_stack, {});'.format(call))
+        else:
+            self.emit('OME_MUSTTAIL return {};'.format(call))
+
+    def emit_error_return(self, error, traceback_info=None):
+        self.emit_append_traceback(traceback_info)
+        if self.tail_traceback_info:
+            self.emit('if (_tail_calls > 0) {')
+            with self.emit.indented():
+                self.emit('if (_tail_calls > 1) OME_append_traceback_elided(_tail_calls - 1);')
+                self.emit_append_traceback(self.tail_traceback_info)
+            self.emit('}')
+        self.emit_return(error)
+
     def emit_append_traceback(self, traceback_info):
-        if traceback_info:
+        if isinstance(traceback_info, tuple):
+            for info in traceback_info:
+                self.emit_append_traceback(info)
+        elif traceback_info:
             self.emit('OME_append_traceback({});'.format(traceback_info.index))
 
     def emit_error_check(self, error, traceback_info=None):
         self.emit('if (OME_is_error(_{})) {{'.format(error))
         with self.emit.indented():
-            self.emit_append_traceback(traceback_info)
-            self.emit_return('_{}'.format(error))
+            self.emit_error_return('_{}'.format(error), traceback_info)
         self.emit('}')
 
     def LOAD_VALUE(self, ins):
@@ -106,6 +188,9 @@ class ProcedureCodegen(object):
     def ALLOC(self, ins):
         self.emit('OME_Value _{} = OME_tag_pointer({}, OME_allocate_slots({}));'.format(ins.dest, ins.tag, ins.size))
 
+    def STACK_ALLOC(self, ins):
+        self.emit('OME_Value _{} = OME_tag_pointer({}, OME_stack_slots(&_stack[{}]));'.format(ins.dest, ins.tag, ins.stack_slot))
+
     def ARRAY(self, ins):
         self.emit('OME_Value _{} = OME_tag_pointer({}, OME_allocate_array({}));'.format(ins.dest, ins.tag, ins.size));
 
@@ -120,22 +205,63 @@ class ProcedureCodegen(object):
                 else:
                     self.emit('if (_tag != {}) {{'.format(ins.check_tag))
                 with self.emit.indented():
-                    self.emit_append_traceback(ins.traceback_info)
-                    self.emit_return('OME_error(OME_Type_Error)')
+                    self.emit_error_return('OME_error(OME_Type_Error)', ins.traceback_info)
+                self.emit('}')
+            self.emit('}')
+        args = ', '.join('_{}'.format(x) for x in ins.args)
+        fast_path = small_integer_operations.get(ins.symbol)
+        if ins.tail_call:
+            if fast_path:
+                self.emit('OME_Value _{};'.format(ins.dest))
+                self.emit('if ({}(_{}, _{}, &_{})) {{'.format(fast_path, ins.args[0], ins.args[1], ins.dest))
+                with self.emit.indented():
+                    self.emit_return('_{}'.format(ins.dest))
+                self.emit('}')
+            if ins.tag_labels:
+                (tag, label), (other_tag, other_label) = ins.tag_labels
+                self.emit('if ({}) {{'.format(format_tag_test(ins.args[0], tag)))
+                with self.emit.indented():
+                    self.emit_tail_call(label, args)
                 self.emit('}')
+                self.emit_tail_call(other_label, args)
+            else:
+                self.emit_tail_call(ins.call_label, args)
+            return
+        if fast_path or ins.tag_labels:
+            self.emit('OME_Value _{};'.format(ins.dest))
+        if fast_path:
+            self.emit('if (!{}(_{}, _{}, &_{})) {{'.format(fast_path, ins.args[0], ins.args[1], ins.dest))
+            self.emit.indent()
+            for local, slot in ins.slow_path_save_list:
+                self.emit('_stack[{}] = _{};'.format(slot, local))
+            for slot in ins.slow_path_clear_list:
+                self.emit('_stack[{}] = OME_False;'.format(slot))
+        if ins.tag_labels:
+            (tag, label), (other_tag, other_label) = ins.tag_labels
+            self.emit('if ({}) {{'.format(format_tag_test(ins.args[0], tag)))
+            with self.emit.indented():
+                self.emit('_{} = {}({});'.format(ins.dest, label, args))
+            self.emit('} else {')
+            with self.emit.indented():
+                self.emit('_{} = {}({});'.format(ins.dest, other_label, args))
             self.emit('}')
-        self.emit('OME_Value _{} = {}({});'.format(
-            ins.dest,
-            ins.call_label,
-            ', '.join('_{}'.format(x) for x in ins.args)))
+        elif fast_path:
+            self.emit('_{} = {}({});'.format(ins.dest, ins.call_label, args))
+        else:
+            self.emit('OME_Value _{} = {}({});'.format(ins.dest, ins.call_label, args))
         if ins.check_error:
             self.emit_error_check(ins.dest, ins.traceback_info)
+        if fast_path:
+            for local, slot in ins.slow_path_load_list:
+                self.emit('_{} = _stack[{}];'.format(local, slot))
+            self.emit.dedent()
+            self.emit('}')
 
     def CONCAT(self, ins):
         stack_size = self.stack_size + len(ins.args)
         self.emit('if (&_stack[{}] >= OME_context->stack_limit) {{'.format(stack_size + 1))
         with self.emit.indented():
-            self.emit_return('OME_error(OME_Stack_Overflow)')
+            self.emit_error_return('OME_error(OME_Stack_Overflow)')
         self.emit('}')
         self.emit('OME_context->stack_pointer = &_stack[{}];'.format(stack_size))
         for index, arg in enumerate(ins.args):
@@ -156,6 +282,27 @@ class ProcedureCodegen(object):
     def RETURN(self, ins):
         self.emit_return('_{}'.format(ins.source))
 
+    def MOVE(self, ins):
+        self.emit('_{} = _{};'.format(ins.dest, ins.source))
+
+    def LABEL(self, ins):
+        self.emit.unindented('L{}: ;'.format(ins.label))
+
+    def JUMP(self, ins):
+        self.emit('goto L{};'.format(ins.label))
+
+    def TAIL_JUMP(self, ins):
+        if ins.traceback_info:
+            self.emit('_tail_calls++;')
+        self.emit('goto L{};'.format(ins.label))
+
+    def BRANCH(self, ins):
+        self.emit('if (OME_is_true(_{})) goto L{};'.format(ins.value, ins.true_label))
+        self.emit('if (OME_is_false(_{})) goto L{};'.format(ins.value, ins.false_label))
+
+    def ERROR(self, ins):
+        self.emit_error_return('OME_error(OME_{})'.format(ins.error), ins.traceback_info)
+
 class DispatchCodegen(object):
     def __init__(self, emit, symbol, has_default_method):
         self.emit = emit
@@ -206,7 +353,7 @@ class DispatchCodegen(object):
 
 class LookupDispatchCodegen(DispatchCodegen):
     def begin(self):
-        self.emit('static OME_Method_{} {}(OME_Value _0)'.format(self.num_args - 1, make_lookup_label(self.symbol)))
+        self.emit('OME_PROGRAM_API OME_Method_{} {}(OME_Value _0)'.format(self.num_args - 1, make_lookup_label(self.symbol)))
         self.emit('{')
         self.emit.indent()
 
@@ -255,7 +402,7 @@ class DataTable(object):
 
     def emit(self, out):
         for string, index in sorted(self.strings.items(), key=lambda x: x[1]):
-            out.write('OME_STATIC_STRING(OME_static_string_{}, {});\n'.format(index, literal_c_string(string)))
+            out.write('OME_PROGRAM_STRING(OME_static_string_{}, {});\n'.format(index, literal_c_string(string)))
 
         mp_digit_mod = 1<<60
         for value, index in sorted(self.large_integers.items(), key=lambda x: x[1]):
@@ -267,10 +414,16 @@ class DataTable(object):
                 value = value // mp_digit_mod
                 if value == 0:
                     break
-            out.write('static const OME_Large_Integer OME_static_large_integer_{} OME_ALIGNED = {{{}, {}, {{{}}}}};\n'.format(
+            out.write('OME_PROGRAM_API const OME_Large_Integer OME_static_large_integer_{} OME_ALIGNED = {{{}, {}, {{{}}}}};\n'.format(
                 index, len(digits), sign,
                 ', '.join(literal_integer(d, 'U') for d in digits)))
 
+    def emit_declarations(self, out):
+        for index in sorted(self.strings.values()):
+            out.write('extern const OME_String OME_static_string_{};\n'.format(index))
+        for index in sorted(self.large_integers.values()):
+            out.write('extern const OME_Large_Integer OME_static_large_integer_{};\n'.format(index))
+
 def emit_traceback_table(out, traceback_entries, include_source=True):
     out.write('static const OME_Traceback_Entry OME_traceback_table[] = {\n')
     for tb in traceback_entries:
@@ -299,7 +452,7 @@ def emit_function_declaration(out, name, num_args):
     out.write(';\n')
 
 def emit_lookup_declaration(out, name, num_args):
-    out.write('static OME_Method_{} {}(OME_Value);\n'.format(num_args - 1, name))
+    out.write('OME_PROGRAM_API OME_Method_{} {}(OME_Value);\n'.format(num_args - 1, name))
 
 def emit_method_declarations(out, messages, methods):
     emit_function_declaration(out, 'OME_toplevel', 1)
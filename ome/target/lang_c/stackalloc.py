@@ -4,23 +4,40 @@
 class StackAllocator(object):
     """
     Generates a list of variables to load and save on the stack for each instruction.
+
+    Calls for which has_fast_path() is true only call out on their slow path,
+    so their locals are saved and reloaded on that path alone and stay valid
+    after the call.
     """
-    def __init__(self, instructions, num_args):
+    def __init__(self, instructions, num_args, has_fast_path=lambda ins: False):
         self.stack_size = 0
         self.non_heap_locals = set()
         self.valid_heap_locals = set(range(num_args))
         self.saved_heap_locals = {}
         self.free_stack_slots = set()
         self.cleared_stack_slots = set()
+        self.changed_heap_locals = set()  # saved locals assigned again since
 
         for ins in instructions:
             self.forget_locals(ins.live_set)
             ins.load_list = self.load_locals(ins.args)
 
-            if not ins.is_leaf:
-                ins.save_list, ins.clear_list = self.save_locals(ins.live_set_after - {ins.dest})
+            if has_fast_path(ins):
+                self.spill_on_slow_path(ins)
+            elif not ins.is_leaf:
+                ins.save_list = self.save_locals(ins.live_set_after - {ins.dest})
+                ins.clear_list = self.clear_free_slots()
+                self.valid_heap_locals.clear()
+            elif ins.is_jump or ins.is_label:
+                # Locals are loaded from the stack after a label, so they are
+                # saved on every path that leads to it
+                ins.save_list = self.save_locals(ins.live_set_after)
+                if ins.is_label:
+                    self.valid_heap_locals.clear()
 
             if hasattr(ins, 'dest'):
+                if ins.dest in self.saved_heap_locals:
+                    self.changed_heap_locals.add(ins.dest)
                 if ins.dest_from_heap:
                     self.valid_heap_locals.add(ins.dest)
                 else:
@@ -37,10 +54,14 @@ class StackAllocator(object):
 
     def save_locals(self, locals):
         save_list = []
-        clear_list = []
         locals = sorted(x for x in locals if isinstance(x, int))
         for local in locals:
-            if local not in self.saved_heap_locals and local not in self.non_heap_locals:
+            if local in self.non_heap_locals:
+                continue
+            if local in self.changed_heap_locals:
+                self.changed_heap_locals.remove(local)
+                save_list.append((local, self.saved_heap_locals[local]))
+            elif local not in self.saved_heap_locals:
                 if self.free_stack_slots:
                     slot = min(self.free_stack_slots)
                     self.free_stack_slots.remove(slot)
@@ -50,11 +71,22 @@ class StackAllocator(object):
                 self.saved_heap_locals[local] = slot
                 save_list.append((local, slot))
                 self.cleared_stack_slots.add(slot)
-        self.valid_heap_locals.clear()
+        return save_list
+
+    def spill_on_slow_path(self, ins):
+        live = sorted(x for x in ins.live_set_after - {ins.dest} if x in self.valid_heap_locals)
+        ins.slow_path_save_list = self.save_locals(live)
+        ins.slow_path_clear_list = sorted(self.free_stack_slots - self.cleared_stack_slots)
+        ins.slow_path_load_list = [(local, self.saved_heap_locals[local]) for local in live]
+        # The slots are not written on the fast path, so the next call saves them again
+        self.changed_heap_locals.update(local for local, slot in ins.slow_path_save_list)
+
+    def clear_free_slots(self):
+        clear_list = []
         for slot in sorted(self.free_stack_slots - self.cleared_stack_slots):
             clear_list.append(slot)
             self.cleared_stack_slots.add(slot)
-        return save_list, clear_list
+        return clear_list
 
     def forget_locals(self, live_set):
         dead_set = set(self.saved_heap_locals.keys())
@@ -62,9 +94,10 @@ class StackAllocator(object):
         for local in sorted(dead_set):
             slot = self.saved_heap_locals[local]
             del self.saved_heap_locals[local]
+            self.changed_heap_locals.discard(local)
             self.free_stack_slots.add(slot)
             if slot in self.cleared_stack_slots:
                 self.cleared_stack_slots.remove(slot)
 
-def allocate_stack_slots(instructions, num_args):
-    return StackAllocator(instructions, num_args).stack_size
+def allocate_stack_slots(instructions, num_args, has_fast_path=lambda ins: False):
+    return StackAllocator(instructions, num_args, has_fast_path).stack_size
@@ -0,0 +1,163 @@
+# ome - Object Message Expressions
+# Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
+
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def get_max_rss(children=False):
+    """Get the peak resident set size in bytes, or 0 if unknown."""
+    if not resource:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class PassStats(object):
+    """
+    The memory figures are the largest amounts a single run of the pass
+    added: how far it raised the peak RSS of the compiler and its children,
+    and the peak of traced Python allocations above what was allocated when
+    it started.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.time = 0.0
+        self.rss_growth = 0
+        self.child_rss_growth = 0
+        self.traced_peak = 0
+
+    def merge(self, other):
+        self.count += other.count
+        self.time += other.time
+        self.rss_growth = max(self.rss_growth, other.rss_growth)
+        self.child_rss_growth = max(self.child_rss_growth, other.child_rss_growth)
+        self.traced_peak = max(self.traced_peak, other.traced_peak)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'count': self.count,
+            'time': self.time,
+            'rss_growth': self.rss_growth,
+            'child_rss_growth': self.child_rss_growth,
+            'traced_peak': self.traced_peak,
+        }
+
+class PassFrame(object):
+    """The state of a pass that is running."""
+
+    def __init__(self, tracing):
+        self.nested_time = 0.0
+        self.rss = get_max_rss()
+        self.child_rss = get_max_rss(children=True)
+        self.traced = 0
+        self.traced_peak = 0  # peak before the last nested pass reset it
+        if tracing:
+            import tracemalloc
+            self.traced = self.traced_peak = tracemalloc.get_traced_memory()[0]
+
+class PassTimer(object):
+    """
+    Accumulate the wall time and memory growth of each compiler pass.
+    Nested passes are excluded from the time of the pass that contains them,
+    so the times add up to the total, but not from its memory. The peak
+    Python allocation of each pass is only recorded if tracemalloc is
+    tracing (e.g. PYTHONTRACEMALLOC=1).
+    """
+
+    def __init__(self):
+        self.passes = {}
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {'passes': self.passes, 'start_time': self.start_time}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def time(self, name):
+        import tracemalloc
+        stack = self._local.__dict__.setdefault('stack', [])
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # Keep the peak of the pass this one is nested in before resetting it
+            if stack:
+                stack[-1].traced_peak = max(stack[-1].traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        frame = PassFrame(tracing)
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            traced_peak = 0
+            if tracing:
+                traced_peak = max(frame.traced_peak, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1].nested_time += elapsed
+                stack[-1].traced_peak = max(stack[-1].traced_peak, traced_peak)
+            with self._lock:
+                stats = self.passes.get(name)
+                if not stats:
+                    stats = self.passes[name] = PassStats(name)
+                stats.count += 1
+                stats.time += elapsed - frame.nested_time
+                stats.rss_growth = max(stats.rss_growth, get_max_rss() - frame.rss)
+                stats.child_rss_growth = max(stats.child_rss_growth, get_max_rss(children=True) - frame.child_rss)
+                if tracing:
+                    stats.traced_peak = max(stats.traced_peak, traced_peak - frame.traced)
+
+    def merge(self, other):
+        with self._lock:
+            for name, other_stats in other.passes.items():
+                stats = self.passes.get(name)
+                if not stats:
+                    stats = self.passes[name] = PassStats(name)
+                stats.merge(other_stats)
+
+    def total_time(self):
+        return time.perf_counter() - self.start_time
+
+    def report(self, out):
+        total = self.total_time()
+        out.write('===== pass timing (total {:.3f}s) =====\n'.format(total))
+        out.write('{:>10} {:>6} {:>7} {:>11} {:>11}  {}\n'.format('time (s)', '%', 'count', '+rss (MB)', '+child (MB)', 'pass'))
+        for stats in self.passes.values():
+            out.write('{:>10.4f} {:>6.1f} {:>7} {:>11.1f} {:>11.1f}  {}\n'.format(
+                stats.time, 100.0 * stats.time / total if total else 0.0, stats.count,
+                stats.rss_growth / 2**20, stats.child_rss_growth / 2**20, stats.name))
+
+    def to_json(self):
+        import json
+        return json.dumps({
+            'total_time': self.total_time(),
+            'passes': [stats.to_dict() for stats in self.passes.values()],
+        }, indent=2)
+
+class NullTimer(object):
+    """Timer that does nothing, used when --time-passes is not given."""
+
+    _context = nullcontext()
+
+    def time(self, name):
+        return self._context
+
+    def merge(self, other):
+        pass
+
+null_timer = NullTimer()
@@ -0,0 +1,36 @@
+# ome - Object Message Expressions
+# Copyright (c) 2015-2016 Luke McCarthy <luke@iogopro.co.uk>
+
+def run_pass(name, node, arg=None):
+    """
+    Run a pass over the AST using an explicit work stack instead of the
+    Python call stack, so the depth of the tree is limited only by memory.
+
+    Each node class implements the pass as a method named enter_<name>,
+    called as node.enter_<name>(arg, stack, results). It does the work for
+    the node itself and pushes the rest onto the stack as (step, arg) pairs,
+    where step is either a child's enter_<name> method or a method of the
+    node to call once its children are done. The stack is last in, first
+    out, so work runs in the reverse of the order it is pushed.
+
+    Passes that compute a value for each node (a replacement node, an
+    s-expression or the local holding the value of an expression) append
+    it to results exactly once per node, and the steps that run after the
+    children pop their values. The value of the root node is returned.
+    """
+    stack = [(getattr(node, 'enter_' + name), arg)]
+    results = []
+    pop = stack.pop
+    while stack:
+        step, arg = pop()
+        step(arg, stack, results)
+    if results:
+        return results.pop()
+
+def pop_results(results, count):
+    """Pop the values of the last count nodes visited, in the order visited."""
+    if count == 0:
+        return []
+    values = results[-count:]
+    del results[-count:]
+    return values
@@ -1,9 +1,8 @@
-import hashlib
+import gc
 import os
 import platform
 import stat
 import sys
-import tempfile
 from contextlib import contextmanager
 
 def is_terminal(file):
@@ -28,8 +27,23 @@ def make_path(path):
     if not os.path.isdir(path):
         os.makedirs(path)
 
+@contextmanager
+def gc_disabled():
+    """
+    Disable the cyclic garbage collector while building a large structure
+    that creates no garbage, so it doesn't repeatedly scan the new objects.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
 @contextmanager
 def temporary_file(prefix=None, suffix=None):
+    import tempfile
     fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix)
     try:
         yield path
@@ -38,10 +52,12 @@ def temporary_file(prefix=None, suffix=None):
         remove(path)
 
 def temporary_dir(prefix):
+    import tempfile
     uid = '-{}'.format(os.getuid()) if hasattr(os, 'getuid') else ''
     return tempfile.TemporaryDirectory(prefix=prefix + uid)
 
 def get_file_hash(path):
+    import hashlib
     m = hashlib.sha256()
     with open(path, 'rb') as f:
         m.update(f.read())
@@ -0,0 +1,102 @@
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+tests_dir = os.path.dirname(__file__)
+root_dir = os.path.abspath(os.path.join(tests_dir, '..'))
+sys.path.append(root_dir)
+
+from ome import parser
+
+# The parser before the source was tokenized in one pass
+default_baseline = 'f966be9^'
+
+method_template = '''\
+|method{n}: x with: y|
+    # compute something
+    total = x + y * {n} - (x modulo: 7)
+    for: {{i := 0; sum := total |while| i < {n} |do|
+        sum: sum + (i == 3 if: {{|then| 1 |else| -2}})
+        i: i + 1
+    }}
+    print: 'method{n} $total $(x + y)\\n'
+    [total; x; y] size > 2 && (total >= 0 || y <= 100)
+'''
+
+def generate_source(num_lines):
+    lines_per_method = method_template.count('\n')
+    methods = [method_template.format(n=n) for n in range(max(num_lines // lines_per_method, 1))]
+    methods.append('|main| method0: 1 with: 2\n')
+    return ''.join(methods)
+
+def load_baseline_parser(rev):
+    """Load ome/parser.py from a git revision, to compare with the current parser."""
+    source = subprocess.check_output(['git', 'show', rev + ':ome/parser.py'], cwd=root_dir)
+    spec = importlib.util.spec_from_loader('ome.baseline_parser', loader=None)
+    module = importlib.util.module_from_spec(spec)
+    module.__package__ = 'ome'
+    exec(compile(source, 'ome/parser.py@' + rev, 'exec'), module.__dict__)
+    return module
+
+def get_parse(parser_module, jobs=1):
+    if jobs > 1:
+        return lambda source: parser_module.parse_toplevel(source, '<bench>', jobs)
+    return lambda source: parser_module.Parser(source, '<bench>').toplevel()
+
+def measure(parse, source, num_runs):
+    best = None
+    for i in range(num_runs):
+        start = time.perf_counter()
+        parse(source)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def measure_memory(parse, source):
+    """Return the memory held by the AST and the peak memory while parsing, in bytes."""
+    tracemalloc.start()
+    try:
+        ast = parse(source)
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size, peak
+
+def run_benchmark(sizes, baseline, jobs, num_runs, memory):
+    sys.setrecursionlimit(10000)
+    parsers = [('current', get_parse(parser))]
+    if jobs > 1:
+        parsers.append(('jobs={}'.format(jobs), get_parse(parser, jobs)))
+    if baseline:
+        parsers.append((baseline, get_parse(load_baseline_parser(baseline))))
+    header = '{:>10} {:>12} {:>10} {:>14}'.format('lines', 'parser', 'time (s)', 'lines/sec')
+    if memory:
+        header += ' {:>10} {:>10}'.format('ast (MB)', 'peak (MB)')
+    print(header)
+    for size in sizes:
+        source = generate_source(size)
+        num_lines = source.count('\n')
+        for name, parse in parsers:
+            elapsed = measure(parse, source, num_runs)
+            line = '{:>10} {:>12} {:>10.3f} {:>14,.0f}'.format(num_lines, name, elapsed, num_lines / elapsed)
+            if memory:
+                size, peak = measure_memory(parse, source)
+                line += ' {:>10.1f} {:>10.1f}'.format(size / 2**20, peak / 2**20)
+            print(line)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Measure parser throughput on generated source files.')
+    argparser.add_argument('--lines', type=int, nargs='+', default=[10000, 100000, 1000000])
+    argparser.add_argument('--baseline', metavar='REV', default=default_baseline,
+                           help='also measure the parser from this git revision (default: {})'.format(default_baseline))
+    argparser.add_argument('--no-baseline', dest='baseline', action='store_const', const=None,
+                           help='only measure the current parser')
+    argparser.add_argument('--jobs', type=int, default=1, help='also measure parsing with this many processes')
+    argparser.add_argument('--runs', type=int, default=1)
+    argparser.add_argument('--memory', action='store_true', help='also measure the memory used by the AST (slow)')
+    args = argparser.parse_args()
+    run_benchmark(args.lines, args.baseline, args.jobs, args.runs, args.memory)
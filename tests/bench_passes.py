@@ -0,0 +1,95 @@
+import argparse
+import os
+import sys
+
+tests_dir = os.path.dirname(__file__)
+root_dir = os.path.abspath(os.path.join(tests_dir, '..'))
+sys.path.append(root_dir)
+
+from bench_parser import generate_source
+from ome.build import get_target
+from ome.compiler import Program, parse_string
+from ome.ome_types import CompileOptions
+from ome.sexpr import format_sexpr
+from ome.timing import PassTimer
+
+def generate_chain_source(depth):
+    """Generate a program whose main method is a single expression nested depth sends deep."""
+    return '|main| (' + ' + '.join(['1'] * depth) + ') string\n'
+
+def generate_nested_source(depth, statements=10):
+    """
+    Generate a program with blocks nested depth deep. Each block refers to the
+    arguments of the blocks around it, which become closure variables, and
+    calls their methods.
+    """
+    def generate_block(level):
+        lines = ['{|m%d: a%d|' % (level, level)]
+        for n in range(statements):
+            refs = ' + '.join('a%d' % ((level * 7 + n * 3 + i) % level) for i in range(4))
+            lines.append('b%d-%d = a%d + %s' % (level, n, level, refs))
+            lines.append('print: (m%d: b%d-%d) string' % ((level + n) % level + 1, level, n))
+        if level < depth:
+            lines.append('%s m%d: b%d-0' % (generate_block(level + 1), level + 1, level))
+        else:
+            lines.append('b%d-0' % level)
+        return '\n'.join(lines) + '}'
+    return '|main|\n    a0 = 1\n    %s m1: a0\n' % generate_block(1)
+
+def generate_nested_methods_source(depth):
+    """
+    Generate a program with blocks nested depth deep, where each block calls
+    the methods of every block around it but has no closure variables.
+    """
+    def generate_block(level):
+        lines = ['{|m%d: a%d|' % (level, level)]
+        lines += ['print: (m%d: 1) string' % n for n in range(1, level)]
+        if level < depth:
+            lines.append('%s m%d: 1' % (generate_block(level + 1), level + 1))
+        else:
+            lines.append('1')
+        return '\n'.join(lines) + '}'
+    return '|main|\n    %s m1: 1\n' % generate_block(1)
+
+def measure_passes(source, target, num_runs):
+    """Return the best time of each pass over the AST, or None if the passes hit the recursion limit."""
+    best = {}
+    for i in range(num_runs):
+        options = CompileOptions()
+        options.timer = PassTimer()
+        ast = parse_string(source)
+        try:
+            Program(ast, target, '<bench>', options)
+            with options.timer.time('format_sexpr'):
+                format_sexpr(ast.sexpr())
+        except RecursionError:
+            return None
+        for stats in options.timer.passes.values():
+            best[stats.name] = min(best.get(stats.name, stats.time), stats.time)
+    return best
+
+def run_benchmark(sizes, depths, nesting, num_runs):
+    target = get_target('c')
+    target.get_builtin()
+    programs = [('{} lines'.format(size), generate_source(size)) for size in sizes]
+    programs += [('depth {}'.format(depth), generate_chain_source(depth)) for depth in depths]
+    programs += [('closures {}'.format(depth), generate_nested_source(depth)) for depth in nesting]
+    programs += [('methods {}'.format(depth), generate_nested_methods_source(depth)) for depth in nesting]
+    print('{:>14} {:>24} {:>10}'.format('program', 'pass', 'time (s)'))
+    for name, source in programs:
+        times = measure_passes(source, target, num_runs)
+        if times is None:
+            print('{:>14} {:>24} {:>10}'.format(name, '', 'recursion limit exceeded'))
+            continue
+        for pass_name, elapsed in times.items():
+            print('{:>14} {:>24} {:>10.3f}'.format(name, pass_name, elapsed))
+        print('{:>14} {:>24} {:>10.3f}'.format(name, 'total', sum(times.values())))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Measure the time taken by each pass over the AST.')
+    argparser.add_argument('--lines', type=int, nargs='+', default=[10000, 100000])
+    argparser.add_argument('--depth', type=int, nargs='+', default=[100, 50000])
+    argparser.add_argument('--nesting', type=int, nargs='+', default=[10, 50])
+    argparser.add_argument('--runs', type=int, default=3)
+    args = argparser.parse_args()
+    run_benchmark(args.lines, args.depth, args.nesting, args.runs)
@@ -0,0 +1,84 @@
+import os
+import statistics
+import subprocess
+import sys
+
+tests_dir = os.path.dirname(__file__)
+root_dir = os.path.abspath(os.path.join(tests_dir, '..'))
+sys.path.append(root_dir)
+
+from ome.terminal import stderr
+
+# Import time budget in milliseconds for the commands below, on top of the
+# interpreter's own startup imports. These are well above the measured times
+# so that only real regressions (a heavy module being imported eagerly
+# again) trip them.
+budgets = [
+    (['--version'], 100),
+    (['--print-ast', os.path.join(root_dir, 'examples', 'hello-people.ome')], 100),
+]
+
+# Modules that must not be imported by --version or --print-ast
+lazy_modules = [
+    'concurrent.futures',
+    'ome.optimise',
+    'ome.package',
+    'ome.server',
+    'ome.target.lang_c',
+    'tarfile',
+    'urllib.request',
+]
+
+num_runs = 7
+
+def fail(message):
+    stderr.bold()
+    stderr.colour('red')
+    stderr.write('error: ')
+    stderr.reset()
+    stderr.write(message + '\n')
+    sys.exit(1)
+
+def get_import_time(args):
+    """Run python with -X importtime and return the total import time in ms."""
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                             cwd=root_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    total = 0
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            if not name.startswith('  ') and cumulative_us.strip().isdigit():
+                total += int(cumulative_us)
+    return total / 1000
+
+def get_imported_modules(args):
+    code = ('import sys\n'
+            'from ome.__main__ import main\n'
+            'try:\n'
+            '    main({!r})\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'print(\'\\n\'.join(sys.modules))\n').format(args)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root_dir, universal_newlines=True)
+    return set(output.splitlines())
+
+def get_median_import_time(args):
+    return statistics.median(get_import_time(args) for i in range(num_runs))
+
+def run_benchmark():
+    baseline = get_median_import_time(['-c', 'pass'])
+    for args, budget in budgets:
+        command = ' '.join(['ome'] + [os.path.basename(arg) for arg in args])
+        modules = get_imported_modules(args)
+        for module in lazy_modules:
+            if module in modules:
+                fail('{} imports {}'.format(command, module))
+        import_time = get_median_import_time(['-m', 'ome'] + args) - baseline
+        print('{}: {:.1f}ms (budget {}ms)'.format(command, import_time, budget))
+        if import_time > budget:
+            fail('{} import time is over budget'.format(command))
+    print('Startup benchmark passed')
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -1,8 +1,12 @@
 import sys
 import os
+import subprocess
+import tempfile
 
 tests_dir = os.path.dirname(__file__)
-sys.path.append(os.path.abspath(os.path.join(tests_dir, '..')))
+root_dir = os.path.abspath(os.path.join(tests_dir, '..'))
+programs_dir = os.path.join(tests_dir, 'programs')
+sys.path.append(root_dir)
 
 from ome.parser import Parser
 from ome.sexpr import format_sexpr_flat
@@ -40,9 +44,59 @@ def run_tests(filename, test_func):
 def test_parse_expr(input, expected):
     return format_sexpr_flat(Parser(input, '').expr().sexpr())
 
+def fail_program(filename, message, output):
+    stderr.bold()
+    stderr.colour('red')
+    stderr.write('error: ')
+    stderr.reset()
+    stderr.bold()
+    stderr.write('{} in {}\n'.format(message, filename))
+    stderr.reset()
+    stderr.write(output)
+    sys.exit(1)
+
+def run_program_tests():
+    """
+    Build and run each program in the programs directory and compare what it
+    writes to stdout followed by what it writes to stderr with the .out file
+    of the same name. The .args file of the same name, if there is one, has
+    more arguments for the compiler. They are skipped if there is no working
+    backend, and a program is skipped if the backend it asks for is missing.
+    """
+    env = dict(os.environ, PYTHONPATH=root_dir)
+    with tempfile.TemporaryDirectory() as build_dir:
+        for filename in sorted(os.listdir(programs_dir)):
+            name, ext = os.path.splitext(filename)
+            if ext != '.ome':
+                continue
+            executable = os.path.join(build_dir, name)
+            args = [sys.executable, '-m', 'ome', filename, '--output', executable]
+            args_filename = os.path.join(programs_dir, name + '.args')
+            if os.path.exists(args_filename):
+                with open(args_filename, encoding='utf8') as f:
+                    args.extend(f.read().split())
+            process = subprocess.run(args, cwd=programs_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     universal_newlines=True)
+            if process.returncode != 0:
+                if 'could not find a working backend' in process.stderr:
+                    print('Skipping program tests: no working backend')
+                    return
+                if 'is not available' in process.stderr or "backend tool '" in process.stderr:
+                    print('Skipping {}: {}'.format(filename, process.stderr.strip()))
+                    continue
+                fail_program(filename, 'build failed', process.stderr)
+            process = subprocess.run([executable], cwd=programs_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     universal_newlines=True)
+            with open(os.path.join(programs_dir, name + '.out'), encoding='utf8') as f:
+                expected = f.read()
+            actual = process.stdout + process.stderr
+            if actual != expected:
+                fail_program(filename, 'unexpected output', 'expected:\n{}actual:\n{}'.format(expected, actual))
+
 def run_all_tests():
     run_tests('parse_expr.txt', test_parse_expr)
     run_tests('parse_number.txt', test_parse_expr)
+    run_program_tests()
     print('All tests passed successfully!')
 
 if __name__ == '__main__':